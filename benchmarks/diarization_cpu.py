@@ -0,0 +1,153 @@
+"""CPU diarization benchmark: real-time factor and DER of the default and fast CPU modes.
+
+Runs the real pyannote pipeline (needs HUGGING_FACE_TOKEN and the model terms
+accepted) on the same audio once per mode, each in a fresh process so the
+mode's settings apply from import. The reference is an RTTM file; without
+`--audio` a synthetic recording and its schedule are used instead (tones,
+not speech, so its DER only shows whether the modes agree).
+
+    python -m benchmarks.diarization_cpu --audio meeting.wav --reference meeting.rttm --output cpu.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--audio", help="media file to diarize (default: a synthetic recording)")
+    parser.add_argument("--reference", help="RTTM file with the reference diarization of --audio")
+    parser.add_argument("--duration", type=float, default=600, help="seconds of synthetic audio")
+    parser.add_argument("--speakers", type=int, default=3, help="speakers in the synthetic audio")
+    parser.add_argument("--modes", default="default,fast", help="comma-separated DIARIZATION_CPU_MODE values")
+    parser.add_argument("--model", help="DIARIZATION_MODEL to benchmark (default: the configured one)")
+    parser.add_argument("--threads", type=int, default=0, help="DIARIZATION_CPU_THREADS")
+    parser.add_argument("--embedding-batch-size", type=int, default=0)
+    parser.add_argument("--segmentation-batch-size", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=2, help="runs per mode; the fastest one is reported")
+    parser.add_argument("--collar", type=float, default=0.0, help="DER collar in seconds")
+    parser.add_argument("--workdir", help="where generated audio and logs go (default: a temp dir)")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    return parser.parse_args(argv)
+
+
+def schedule_reference(schedule):
+    from pyannote.core import Annotation, Segment
+
+    reference = Annotation()
+    for track, (start, end, speaker) in enumerate(schedule):
+        reference[Segment(start, end), track] = f"speaker_{speaker}"
+    return reference
+
+
+def run_mode(mode, args, audio_path, schedule, results):
+    """Runs in a fresh process: loads the pipeline in `mode` and diarizes the audio `args.repeat` times."""
+    os.environ.update({
+        "DIARIZATION_CPU_MODE": mode,
+        "DIARIZATION_DEVICE": "cpu",
+        "DIARIZATION_CPU_THREADS": str(args.threads),
+        "DIARIZATION_EMBEDDING_BATCH_SIZE": str(args.embedding_batch_size),
+        "DIARIZATION_SEGMENTATION_BATCH_SIZE": str(args.segmentation_batch_size),
+    })
+    if args.model:
+        os.environ["DIARIZATION_MODEL"] = args.model
+    sys.path.insert(0, REPO_ROOT)
+    from pyannote.metrics.diarization import DiarizationErrorRate
+    from src.core.checkpoint import read_rttm
+    from src.core.diarization import diarize_audio, pin_cpu_threads, registry
+    from src.core.media_decoder import decode_media
+
+    pin_cpu_threads()
+    audio = decode_media(audio_path, "benchmark")
+    started = time.perf_counter()
+    registry.get()
+    load_seconds = time.perf_counter() - started
+
+    seconds = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        hypothesis = diarize_audio(audio)
+        seconds.append(time.perf_counter() - started)
+
+    reference = read_rttm(args.reference) if args.reference else schedule_reference(schedule)
+    metric = DiarizationErrorRate(collar=args.collar)
+    details = metric(reference, hypothesis, detailed=True)
+    total = details["total"] or 1.0
+    best = min(seconds)
+    results.put({
+        "mode": mode,
+        "audio_seconds": round(audio.duration, 3),
+        "load_seconds": round(load_seconds, 3),
+        "diarization_seconds": [round(value, 3) for value in seconds],
+        # Wall seconds per second of audio; below 1 is faster than real time
+        "rtf": round(best / audio.duration, 4),
+        "der": round(details["diarization error rate"], 4),
+        "missed_detection": round(details["missed detection"] / total, 4),
+        "false_alarm": round(details["false alarm"] / total, 4),
+        "confusion": round(details["confusion"] / total, 4),
+        "speakers": len(hypothesis.labels()),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="diarization-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+
+    schedule = None
+    if args.audio:
+        audio_path = os.path.abspath(args.audio)
+        if not args.reference:
+            sys.exit("--reference is required with --audio")
+        args.reference = os.path.abspath(args.reference)
+    else:
+        from .synthetic import generate
+        audio_path, schedule = generate(os.path.join(workdir, "recording"), args.duration, args.speakers)
+    # The logger writes its logs into the working directory
+    os.chdir(workdir)
+
+    # A fresh interpreter per mode, so quantization and thread settings never leak between modes
+    context = multiprocessing.get_context("spawn")
+    modes = []
+    for mode in args.modes.split(","):
+        results = context.Queue()
+        process = context.Process(target=run_mode, args=(mode, args, audio_path, schedule, results))
+        process.start()
+        while True:
+            try:
+                modes.append(results.get(timeout=1))
+                break
+            except queue.Empty:
+                if not process.is_alive() and results.empty():
+                    sys.exit(f"Mode {mode} failed with exit code {process.exitcode}")
+        process.join()
+
+    baseline = modes[0]
+    for result in modes[1:]:
+        result["speedup"] = round(baseline["rtf"] / max(result["rtf"], 1e-9), 2)
+        result["der_change"] = round(result["der"] - baseline["der"], 4)
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+        "workdir": workdir,
+        "modes": modes,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""Local stand-ins for the cloud services and the diarization model.
+
+Everything here is configured through BENCH_* environment variables so the
+fakes also work inside forked RQ work horses.
+"""
+import asyncio
+import collections
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+from datetime import timedelta
+
+import numpy as np
+
+from .synthetic import SAMPLE_RATE, SPEAKER_FREQUENCIES
+
+
+def record(kind, **fields):
+    """Appends one event to the JSON-lines file shared by all benchmark processes."""
+    path = os.getenv("BENCH_RECORD_PATH")
+    if not path:
+        return
+    line = json.dumps({"kind": kind, "pid": os.getpid(), "ts": time.time(), **fields}, default=str)
+    with open(path, "a") as f:
+        f.write(line + "\n")
+
+
+# --- Firestore -------------------------------------------------------------
+
+def install_fake_firestore():
+    """Replaces src.services.firebase_service before anything imports it.
+
+    The real module initializes Firebase lazily, on first use, with the real
+    credentials; the fake records every write instead.
+    """
+    module = types.ModuleType("src.services.firebase_service")
+    latency = float(os.getenv("BENCH_FIRESTORE_LATENCY", "0.02"))
+
+    def update_firestore(doc_ref, data):
+        time.sleep(latency)
+        record("firestore", ref=doc_ref, data=data)
+
+    def update_firestore_batch(updates):
+        time.sleep(latency)
+        for doc_ref, data in updates:
+            record("firestore", ref=doc_ref, data=data)
+
+    def update_firestore_async(doc_ref, data, on_commit=None):
+        update_firestore(doc_ref, data)
+        if on_commit is not None:
+            on_commit()
+
+    module.update_firestore = update_firestore
+    module.update_firestore_batch = update_firestore_batch
+    module.update_firestore_async = update_firestore_async
+    module.flush_firestore = lambda timeout=30, discard=None: True
+    module.init_firebase = lambda: None
+    module.transcript_fields = lambda doc_ref, transcript: {"transcript": transcript}
+    sys.modules["src.services.firebase_service"] = module
+    return module
+
+
+# --- Storage ---------------------------------------------------------------
+
+class FakeBlob:
+    def __init__(self, media_dir, base_url, path):
+        self.name = path
+        self._file = os.path.join(media_dir, path)
+        self._url = f"{base_url}/{path}"
+        self.md5_hash = None
+        if os.path.exists(self._file):
+            with open(self._file, "rb") as f:
+                self.md5_hash = hashlib.md5(f.read()).hexdigest()
+
+    def generate_signed_url(self, **kwargs):
+        return self._url
+
+
+class FakeBucket:
+    def __init__(self, media_dir, base_url):
+        self.media_dir = media_dir
+        self.base_url = base_url
+
+    def blob(self, path):
+        return FakeBlob(self.media_dir, self.base_url, path)
+
+    def get_blob(self, path):
+        return self.blob(path)
+
+
+class FakeStorage:
+    """Stands in for firebase_admin.storage; gs:// objects are served by the local MediaServer."""
+
+    def __init__(self, media_dir, base_url):
+        self._bucket = FakeBucket(media_dir, base_url)
+
+    def bucket(self, name=None):
+        return self._bucket
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer:
+    """Serves the synthetic media over HTTP on localhost."""
+
+    def __init__(self, directory):
+        handler = functools.partial(_QuietHandler, directory=directory)
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+
+
+# --- Speech ----------------------------------------------------------------
+
+def _words(samples, sample_rate):
+    """Finds voiced runs of at least 0.1 s and returns them as (start, end) seconds."""
+    frame = sample_rate // 10
+    frames = len(samples) // frame
+    if frames == 0:
+        return []
+    energy = np.abs(samples[:frames * frame].astype(np.float32)).reshape(frames, frame).mean(axis=1)
+    voiced = energy > 500
+    words, start = [], None
+    for index, is_voiced in enumerate(voiced):
+        if is_voiced and start is None:
+            start = index
+        elif not is_voiced and start is not None:
+            words.append((start / 10, index / 10))
+            start = None
+    if start is not None:
+        words.append((start / 10, frames / 10))
+    return words
+
+
+class FakeSpeechBackend:
+    """Speech backend with configurable latency, error rate and quota.
+
+    Latency is BENCH_SPEECH_LATENCY seconds per call plus
+    BENCH_SPEECH_LATENCY_PER_SECOND per second of audio. Calls beyond
+    BENCH_SPEECH_QUOTA_PER_MINUTE in the last minute (0 = no quota, counted per
+    process) fail like an exhausted project quota. Every voiced run in the
+    audio is returned as one word with its time offsets.
+    """
+
+    def __init__(self):
+        self.latency = float(os.getenv("BENCH_SPEECH_LATENCY", "0.3"))
+        self.latency_per_second = float(os.getenv("BENCH_SPEECH_LATENCY_PER_SECOND", "0.02"))
+        self.error_rate = float(os.getenv("BENCH_SPEECH_ERROR_RATE", "0"))
+        self.quota_per_minute = int(os.getenv("BENCH_SPEECH_QUOTA_PER_MINUTE", "0"))
+        self._calls = collections.deque()
+
+    def _over_quota(self):
+        if not self.quota_per_minute:
+            return False
+        now = time.monotonic()
+        while self._calls and now - self._calls[0] >= 60:
+            self._calls.popleft()
+        if len(self._calls) >= self.quota_per_minute:
+            return True
+        self._calls.append(now)
+        return False
+
+    @staticmethod
+    def _samples(config, content):
+        from google.cloud import speech
+        if config.encoding == speech.RecognitionConfig.AudioEncoding.LINEAR16:
+            return np.frombuffer(content, dtype="<i2")
+        import soundfile
+        return soundfile.read(io.BytesIO(content), dtype="int16")[0]
+
+    def _response(self, samples, sample_rate):
+        words = [
+            types.SimpleNamespace(
+                word=f"w{int(start * 10)}",
+                start_time=timedelta(seconds=start),
+                end_time=timedelta(seconds=end),
+            )
+            for start, end in _words(samples, sample_rate)
+        ]
+        alternative = types.SimpleNamespace(transcript=" ".join(w.word for w in words), words=words)
+        return types.SimpleNamespace(results=[types.SimpleNamespace(alternatives=[alternative])] if words else [])
+
+    async def recognize(self, config, content):
+        samples = self._samples(config, content)
+        audio_seconds = len(samples) / config.sample_rate_hertz
+        started = time.perf_counter()
+        over_quota = self._over_quota()
+        await asyncio.sleep(self.latency + self.latency_per_second * audio_seconds)
+        if over_quota or random.random() < self.error_rate:
+            record("speech", audio_seconds=audio_seconds, bytes=len(content), error=True,
+                   latency=time.perf_counter() - started)
+            try:
+                from google.api_core.exceptions import ResourceExhausted
+            except ImportError:
+                raise RuntimeError("RESOURCE_EXHAUSTED (fake)")
+            raise ResourceExhausted("Quota exceeded (fake)")
+        record("speech", audio_seconds=audio_seconds, bytes=len(content), error=False,
+               latency=time.perf_counter() - started)
+        return self._response(samples, config.sample_rate_hertz)
+
+    async def long_running_recognize(self, config, uri, timeout):
+        raise RuntimeError("The fake Speech backend has no long-running recognition; "
+                           "keep SPEECH_SYNC_MAX_SECONDS under 60")
+
+
+# --- Diarization -----------------------------------------------------------
+
+class FakeDiarizationPipeline:
+    """Labels speakers by the dominant pitch of each 0.25 s frame.
+
+    Sleeps BENCH_DIARIZATION_RTF seconds per second of audio to stand in for
+    the model's compute time.
+    """
+
+    def __init__(self):
+        self.realtime_factor = float(os.getenv("BENCH_DIARIZATION_RTF", "0.05"))
+
+    def _samples(self, audio_input):
+        if isinstance(audio_input, dict):
+            waveform = audio_input["waveform"]
+            return np.asarray(waveform[0]), audio_input["sample_rate"]
+        from src.core.audio_buffer import AudioBuffer
+        audio = AudioBuffer.from_wav(str(audio_input))
+        return audio.samples.astype(np.float32) / 32768.0, audio.sample_rate
+
+    def __call__(self, audio_input, hook=None, **kwargs):
+        return self.apply(audio_input, hook=hook, **kwargs)
+
+    def apply(self, audio_input, hook=None, return_embeddings=False):
+        from pyannote.core import Annotation, Segment
+
+        samples, sample_rate = self._samples(audio_input)
+        duration = len(samples) / sample_rate
+        started = time.perf_counter()
+
+        frame = sample_rate // 4
+        frames = len(samples) // frame
+        labels = []
+        frequencies = np.fft.rfftfreq(frame, 1 / sample_rate)
+        for index in range(frames):
+            chunk = samples[index * frame:(index + 1) * frame]
+            if np.sqrt(np.mean(chunk ** 2)) < 0.02:
+                labels.append(None)
+                continue
+            dominant = frequencies[np.argmax(np.abs(np.fft.rfft(chunk)))]
+            labels.append(int(np.argmin([abs(dominant - f) for f in SPEAKER_FREQUENCIES])))
+        # Bridge the short pauses between syllables of the same speaker
+        for index in range(1, len(labels) - 1):
+            if labels[index] is None:
+                following = next((label for label in labels[index + 1:index + 3] if label is not None), None)
+                if labels[index - 1] is not None and labels[index - 1] == following:
+                    labels[index] = following
+        if hook:
+            hook("segmentation", None)
+
+        # Like the real pipeline, labels are local to this call: numbered by first appearance
+        speakers = list(dict.fromkeys(label for label in labels if label is not None))
+        labels = [None if label is None else f"SPEAKER_{speakers.index(label):02d}" for label in labels]
+
+        annotation = Annotation()
+        start = None
+        for index, label in enumerate(labels + [None]):
+            if start is not None and label != labels[start]:
+                annotation[Segment(start / 4, index / 4)] = labels[start]
+                start = None
+            if label is not None and start is None:
+                start = index
+
+        remaining = self.realtime_factor * duration - (time.perf_counter() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+        if hook:
+            hook("embeddings", None)
+            hook("discrete_diarization", None)
+        if return_embeddings:
+            # A noisy one-hot vector of the true speaker, one row per label in labels() order
+            rng = np.random.default_rng(len(samples))
+            embeddings = np.eye(len(SPEAKER_FREQUENCIES))[speakers] + rng.normal(0, 0.1, (len(speakers), len(SPEAKER_FREQUENCIES)))
+            order = [f"SPEAKER_{index:02d}" for index in range(len(speakers))]
+            return annotation, embeddings[[order.index(label) for label in annotation.labels()]]
+        return annotation
@@ -0,0 +1,267 @@
+"""Offline end-to-end benchmark of the processing pipeline.
+
+Generates synthetic multi-speaker recordings, serves them from a local HTTP
+server behind a fake Storage bucket, and runs `process_media` with fake
+Speech, Firestore and diarization backends at several concurrency levels,
+either in threads (`--mode direct`) or through RQ workers (`--mode rq`, needs
+a local Redis at REDIS_URL). Writes a JSON report with throughput, per-stage
+latency and memory figures.
+
+    python -m benchmarks.run --duration 600 --jobs 8 --concurrency 1,2,4 --output report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = "benchmark-bucket"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=300, help="seconds of audio per recording")
+    parser.add_argument("--speakers", type=int, default=3)
+    parser.add_argument("--format", choices=("wav", "mp3", "mp4"), default="wav")
+    parser.add_argument("--recordings", type=int, default=2, help="distinct recordings to generate")
+    parser.add_argument("--jobs", type=int, default=4, help="jobs per concurrency level")
+    parser.add_argument("--concurrency", default="1,2,4", help="comma-separated concurrency levels")
+    parser.add_argument("--mode", choices=("direct", "rq"), default="direct")
+    parser.add_argument("--speech-latency", type=float, default=0.3)
+    parser.add_argument("--speech-latency-per-second", type=float, default=0.02)
+    parser.add_argument("--speech-error-rate", type=float, default=0.0)
+    parser.add_argument("--speech-quota", type=int, default=0,
+                        help="requests per minute the fake Speech accepts before RESOURCE_EXHAUSTED (0 = unlimited)")
+    parser.add_argument("--speech-rate-limit", type=float, default=0,
+                        help="SPEECH_QUOTA_PER_MINUTE of the shared token bucket (0 = off; needs Redis)")
+    parser.add_argument("--speech-encoding", choices=("LINEAR16", "FLAC", "OGG_OPUS"), default="FLAC")
+    parser.add_argument("--diarization-rtf", type=float, default=0.05,
+                        help="fake diarization seconds per second of audio")
+    parser.add_argument("--diarization-workers", type=int, default=0,
+                        help="diarize every file in this many processes (parallel mode)")
+    parser.add_argument("--stage-slots", type=int, default=0,
+                        help="staged execution: jobs downloading and diarizing at once (0 = off); "
+                             "concurrency levels above it overlap the stages of different jobs")
+    parser.add_argument("--firestore-latency", type=float, default=0.02)
+    parser.add_argument("--workdir", help="where media and job files go (default: a temp dir)")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    """Points the application at the fakes; must run before any src module is imported."""
+    os.environ.update({
+        "BENCH_RECORD_PATH": os.path.join(workdir, "records.jsonl"),
+        "BENCH_SPEECH_LATENCY": str(args.speech_latency),
+        "BENCH_SPEECH_LATENCY_PER_SECOND": str(args.speech_latency_per_second),
+        "BENCH_SPEECH_ERROR_RATE": str(args.speech_error_rate),
+        "BENCH_SPEECH_QUOTA_PER_MINUTE": str(args.speech_quota),
+        "SPEECH_QUOTA_PER_MINUTE": str(args.speech_rate_limit),
+        "BENCH_DIARIZATION_RTF": str(args.diarization_rtf),
+        "BENCH_FIRESTORE_LATENCY": str(args.firestore_latency),
+        "SPEECH_BACKEND": "benchmarks.fakes:FakeSpeechBackend",
+        "SPEECH_AUDIO_ENCODING": args.speech_encoding,
+        "RESULT_CACHE_ENABLED": "false",
+        "FIREBASE_STORAGE_BUCKET": BUCKET,
+        "HUGGING_FACE_TOKEN": os.getenv("HUGGING_FACE_TOKEN", "offline"),
+        "DIARIZATION_DEVICE": "cpu",
+        "JOB_SCRATCH_DIR": os.path.join(workdir, "scratch"),
+        "JOB_CHECKPOINT_DIR": os.path.join(workdir, "checkpoints"),
+        "STAGE_LOCK_DIR": os.path.join(workdir, "stages"),
+        "DIARIZATION_PARALLEL_WORKERS": str(args.diarization_workers),
+        "DIARIZATION_PARALLEL_MIN_SECONDS": "0",
+    })
+
+
+def install_fakes(media_dir):
+    from .fakes import FakeDiarizationPipeline, FakeStorage, MediaServer, install_fake_firestore
+
+    install_fake_firestore()
+    from src.core import media_processor
+    from src.core.diarization import default_device, default_model_name, registry
+
+    server = MediaServer(media_dir)
+    media_processor.storage = FakeStorage(media_dir, server.base_url)
+    registry.register(default_model_name(), default_device(), FakeDiarizationPipeline())
+    return server
+
+
+def prepare_media(args, media_dir):
+    from .synthetic import generate
+
+    recordings = []
+    for index in range(args.recordings):
+        path, _ = generate(os.path.join(media_dir, f"recording_{index}"), args.duration,
+                           args.speakers, seed=index, media_format=args.format)
+        recordings.append(path)
+    return recordings
+
+
+def job_urls(recordings, media_dir, level, jobs):
+    """Links every job to a recording under its own name, so every job is a distinct URL."""
+    urls = []
+    for index in range(jobs):
+        source = recordings[index % len(recordings)]
+        name = f"c{level}_job{index}{os.path.splitext(source)[1]}"
+        link = os.path.join(media_dir, name)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(source, link)
+        urls.append((f"gs://{BUCKET}/{name}", f"benchmark/c{level}_job{index}"))
+    return urls
+
+
+def run_direct(urls, concurrency):
+    from src.core.media_processor import process_media
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(process_media, url, ref, "en-US") for url, ref in urls]
+        for future in futures:
+            future.result()
+
+
+def _rq_worker(queue_name):
+    from redis import Redis
+    from rq import Queue, Worker
+
+    connection = Redis.from_url(os.environ["REDIS_URL"])
+    Worker([Queue(queue_name, connection=connection)], connection=connection).work(burst=True)
+
+
+def run_rq(urls, concurrency):
+    from redis import Redis
+    from rq import Queue
+    # Imported before forking so the work horses inherit the patched modules
+    import src.tasks  # noqa: F401
+    from src.services.job_events import mark_queued_written
+    from src.services.rate_limiter import LIMIT_KEY
+
+    connection = Redis.from_url(os.environ["REDIS_URL"])
+    # Start every run at the maximum Speech concurrency, not at a limit an earlier run lowered
+    connection.delete(LIMIT_KEY)
+    queue = Queue(f"benchmark-{uuid.uuid4().hex[:8]}", connection=connection)
+    with connection.pipeline(transaction=False) as pipe:
+        for url, ref in urls:
+            job = queue.enqueue("src.tasks.process_media_task", url, ref, "en-US", False, job_timeout=7200)
+            # Nothing writes a QUEUED status here, so the jobs are marked as the API marks them after its write
+            mark_queued_written(job.id, connection=pipe)
+        pipe.execute()
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_rq_worker, args=(queue.name,)) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue.delete(delete_jobs=True)
+
+
+def _summary(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype=float)
+    return {
+        "mean": round(float(values.mean()), 3),
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "max": round(float(values.max()), 3),
+    }
+
+
+def summarize(records_path, concurrency, jobs, wall_seconds):
+    events = []
+    if os.path.exists(records_path):
+        with open(records_path) as f:
+            events = [json.loads(line) for line in f]
+
+    finals = {}
+    for event in events:
+        if event["kind"] == "firestore" and event["data"].get("status") in ("DONE", "ERROR"):
+            finals[event["ref"]] = event["data"]
+    done = [data for data in finals.values() if data["status"] == "DONE"]
+    stages = {}
+    for data in done:
+        for stage, seconds in data["metadata"].get("timings", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+    speech = [event for event in events if event["kind"] == "speech"]
+    audio_seconds = sum(data["metadata"]["duration"] for data in done)
+
+    return {
+        "concurrency": concurrency,
+        "jobs": jobs,
+        "completed": len(done),
+        "failed": len(finals) - len(done),
+        "wall_seconds": round(wall_seconds, 3),
+        "jobs_per_hour": round(len(done) * 3600 / wall_seconds, 2) if wall_seconds else None,
+        "audio_seconds_per_wall_second": round(audio_seconds / wall_seconds, 2) if wall_seconds else None,
+        "job_seconds": _summary([data["metadata"]["processing_time"] for data in done]),
+        "stage_seconds": {stage: _summary(values) for stage, values in sorted(stages.items())},
+        "speech_requests": len(speech),
+        "speech_errors": sum(1 for event in speech if event["error"]),
+        "speech_successes_per_minute": (round(sum(1 for event in speech if not event["error"]) * 60 / wall_seconds, 1)
+                                        if wall_seconds else None),
+        "speech_request_audio_seconds": _summary([event["audio_seconds"] for event in speech]),
+        "speech_latency_seconds": _summary([event["latency"] for event in speech]),
+        "speech_bytes": sum(event["bytes"] for event in speech),
+        "firestore_writes": sum(1 for event in events if event["kind"] == "firestore"),
+        "job_peak_rss_mb": _summary([data["metadata"].get("peak_rss_mb", 0) for data in done]),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="transcript-bench-"))
+    media_dir = os.path.join(workdir, "media")
+    jobs_dir = os.path.join(workdir, "jobs")
+    os.makedirs(media_dir, exist_ok=True)
+    os.makedirs(jobs_dir, exist_ok=True)
+
+    configure_environment(args, workdir)
+    sys.path.insert(0, REPO_ROOT)
+    # The logger writes its logs into the working directory
+    os.chdir(jobs_dir)
+
+    server = install_fakes(media_dir)
+    recordings = prepare_media(args, media_dir)
+    records_path = os.environ["BENCH_RECORD_PATH"]
+
+    runs = []
+    for level in [int(value) for value in args.concurrency.split(",")]:
+        urls = job_urls(recordings, media_dir, level, args.jobs)
+        if os.path.exists(records_path):
+            os.remove(records_path)
+        if args.stage_slots:
+            from src.core.stages import configure_stages
+            configure_stages(args.stage_slots, jobs_per_slot=-(-level // args.stage_slots))
+        started = time.perf_counter()
+        if args.mode == "rq":
+            run_rq(urls, level)
+        else:
+            run_direct(urls, level)
+        runs.append(summarize(records_path, level, args.jobs, time.perf_counter() - started))
+    server.close()
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+        "workdir": workdir,
+        "runs": runs,
+        "benchmark_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
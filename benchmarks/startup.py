@@ -0,0 +1,105 @@
+"""Startup cost of the API and worker entry points.
+
+Imports each entry point in a fresh interpreter and reports the import time,
+the peak RSS afterwards and which heavy libraries were loaded. Nothing
+connects to Redis or Firebase while importing. `--preload` also measures the
+worker supervisor's preload (Firebase and the diarization model), which needs
+the real credentials.
+
+    python -m benchmarks.startup --repeat 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules each entry point loads before it serves requests or forks workers
+ENTRY_POINTS = {
+    "api": ["src.app"],
+    "worker": ["src.worker", "src.tasks"],
+}
+HEAVY_MODULES = (
+    "torch", "pyannote.audio", "pyannote.core", "numpy", "firebase_admin",
+    "google.cloud.firestore", "google.cloud.speech", "google.cloud.storage",
+)
+
+_PROBE = """
+import importlib, json, resource, sys, time
+started = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module(name)
+imported = time.perf_counter() - started
+if {preload!r}:
+    from src.worker import preload
+    preload()
+print(json.dumps({{
+    "import_seconds": imported,
+    "total_seconds": time.perf_counter() - started,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+    "heavy": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument("--preload", action="store_true", help="also run the worker's preload")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    return parser.parse_args(argv)
+
+
+def probe(modules, preload=False):
+    """Runs one fresh interpreter that imports `modules` and returns its measurements.
+
+    It runs in a temporary directory, so the logs and metric files written on
+    import do not end up in the repository.
+    """
+    code = _PROBE.format(modules=modules, preload=preload, heavy=HEAVY_MODULES)
+    with tempfile.TemporaryDirectory(prefix="startup-bench-") as workdir:
+        env = dict(os.environ)
+        env.setdefault("REDIS_URL", "redis://localhost:6379")
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+        env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(workdir, "metrics")
+        completed = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env,
+                                   capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure(modules, repeat, preload=False):
+    runs = [probe(modules, preload) for _ in range(repeat)]
+    return {
+        "modules": modules,
+        "import_seconds_median": round(statistics.median(run["import_seconds"] for run in runs), 3),
+        "import_seconds_max": round(max(run["import_seconds"] for run in runs), 3),
+        "total_seconds_median": round(statistics.median(run["total_seconds"] for run in runs), 3),
+        "peak_rss_mb": round(max(run["peak_rss_mb"] for run in runs), 1),
+        "loaded_modules": runs[-1]["modules"],
+        "heavy_modules": runs[-1]["heavy"],
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        "python": sys.version.split()[0],
+        # An interpreter that imports nothing, to put the figures below in perspective
+        "baseline": measure([], args.repeat),
+    }
+    for name, modules in ENTRY_POINTS.items():
+        report[name] = measure(modules, args.repeat, preload=args.preload and name == "worker")
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
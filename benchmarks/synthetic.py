@@ -0,0 +1,86 @@
+"""Synthetic multi-speaker recordings for offline benchmarks.
+
+Every speaker is a tone at its own pitch, amplitude-modulated like syllables,
+so the fake diarization pipeline can tell speakers apart by frequency and the
+fake Speech backend can find "words" by energy.
+"""
+import json
+import random
+import subprocess
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+SPEAKER_FREQUENCIES = (180.0, 310.0, 440.0, 570.0, 700.0, 830.0)
+
+
+def conversation_schedule(duration, speakers=3, seed=0, long_turn_ratio=0.05):
+    """Returns (start, end, speaker index) turns covering `duration` seconds.
+
+    Turns are mostly short with rapid turn-taking; a small share are long
+    monologues, to exercise request packing and splitting.
+    """
+    rng = random.Random(seed)
+    schedule = []
+    position = 0.0
+    speaker = 0
+    while position < duration:
+        if rng.random() < long_turn_ratio:
+            length = rng.uniform(60, 150)
+        else:
+            length = rng.uniform(0.8, 15)
+        end = min(position + length, duration)
+        schedule.append((round(position, 3), round(end, 3), speaker))
+        position = end + rng.uniform(0.2, 1.2)
+        speaker = (speaker + rng.randrange(1, speakers)) % speakers if speakers > 1 else 0
+    return schedule
+
+
+def render(schedule, duration, sample_rate=SAMPLE_RATE):
+    """Renders a schedule to int16 mono samples."""
+    samples = np.zeros(int(duration * sample_rate), dtype=np.float32)
+    for start, end, speaker in schedule:
+        first, last = int(start * sample_rate), int(end * sample_rate)
+        t = np.arange(last - first, dtype=np.float32) / sample_rate
+        frequency = SPEAKER_FREQUENCIES[speaker % len(SPEAKER_FREQUENCIES)]
+        # ~3 syllables per second with short pauses between "words"
+        envelope = np.clip(np.sin(2 * np.pi * 1.5 * t), 0, None) ** 0.5
+        samples[first:last] = 0.4 * envelope * np.sin(2 * np.pi * frequency * t)
+    return (samples * 32767).astype(np.int16)
+
+
+def write_wav(path, samples, sample_rate=SAMPLE_RATE):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def to_container(wav_path, output_path, media_format):
+    """Encodes a WAV into another container with ffmpeg (mp4 gets a small video track)."""
+    if media_format == "mp4":
+        command = [
+            "ffmpeg", "-nostdin", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", "color=size=320x240:rate=5",
+            "-i", wav_path, "-shortest", "-c:v", "libx264", "-preset", "ultrafast",
+            "-c:a", "aac", "-ar", "44100", "-ac", "2", "-movflags", "+faststart", output_path,
+        ]
+    else:
+        command = ["ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", wav_path, output_path]
+    subprocess.run(command, check=True)
+
+
+def generate(path_prefix, duration, speakers=3, seed=0, media_format="wav"):
+    """Writes a synthetic recording and its ground truth; returns (media path, schedule)."""
+    schedule = conversation_schedule(duration, speakers, seed)
+    wav_path = f"{path_prefix}.wav"
+    write_wav(wav_path, render(schedule, duration))
+    with open(f"{path_prefix}.json", "w") as f:
+        json.dump(schedule, f)
+    if media_format == "wav":
+        return wav_path, schedule
+    media_path = f"{path_prefix}.{media_format}"
+    to_container(wav_path, media_path, media_format)
+    return media_path, schedule
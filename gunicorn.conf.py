@@ -1,5 +1,6 @@
 # Gunicorn configuration file
 import multiprocessing
+import os
 
 # Server socket
 bind = "0.0.0.0:5012"
@@ -7,7 +8,9 @@ backlog = 2048
 
 # Worker processes
 workers = 1
-worker_class = "sync"
+# Threads, so open job streams (Server-Sent Events) don't block other requests
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
 worker_connections = 1000
 timeout = 7200  # 2 hours timeout for long-running transcription tasks
 keepalive = 2
@@ -1,59 +1,159 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from dotenv import load_dotenv
 import os
 import multiprocessing
 import atexit
+import json
+import math
+import time
+import uuid
 from datetime import datetime, timezone
-from rq import Worker
-from .tasks import q
+from functools import partial
+from rq import Queue, Retry
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from .queues import PROCESS_MEDIA_TASK, all_queues, q, redis_conn, size_class, size_class_queues
 from .utils.logger import logger
-from .services.firebase_service import update_firestore
+# Multiprocess metrics must be set up before prometheus_client is imported
+from .utils.metrics_dir import setup_metrics_dir
+setup_metrics_dir()
+from .utils.metrics import archive_dead_processes, metrics_response
+from .utils.notification import queue_counts as notification_counts
+from .services.admission import MAX_ETA_SECONDS, Backlog, job_timeout, probe_duration
+from .services.firebase_service import BATCH_LIMIT, update_firestore_async, update_firestore_batch
+from .services.job_events import JobEvents, iter_job_events, job_events_exist, mark_queued_written, publish_queued
+from .services.result_cache import get_result_cache
 
  # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
 
+# Merge the metric files that exited processes left behind before the last restart
+archive_dead_processes()
+
 logger.info(f"Flask app connecting to Redis at {os.getenv('REDIS_URL')}")
 
-def run_worker():
-    """Function to start the worker in a separate process."""
-    worker = Worker([q], connection=q.connection)
-    logger.info(f"Starting worker for queues: {', '.join(worker.queue_names())}")
-    worker.work()
+# Failed or timed-out jobs are requeued this many times; they resume from their checkpoint
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", "2"))
+# Seconds between keep-alive comments on idle job streams, and the reconnect delay sent to clients
+SSE_KEEPALIVE_SECONDS = int(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_RETRY_MS = 3000
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+# Health responses are reused for this many seconds, so frequent probes cost one computation
+HEALTH_CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", "2"))
+# Default and largest page size of /api/jobs
+JOBS_PAGE_SIZE = 50
+JOBS_PAGE_MAX = 500
 
 worker_process = None
+# (expiry, body) of the last health response
+_health = None
 
 def start_worker():
     global worker_process
     if worker_process is None or not worker_process.is_alive():
-        worker_process = multiprocessing.Process(target=run_worker)
+        # Imported here so the API process itself never loads the processing modules
+        from .worker import run_supervisor
+        worker_process = multiprocessing.Process(target=run_supervisor)
         worker_process.start()
-        logger.info(f"Started worker process with PID: {worker_process.pid}")
+        logger.info(f"Started worker supervisor process with PID: {worker_process.pid}")
 
 def stop_worker():
     global worker_process
     if worker_process and worker_process.is_alive():
-        logger.info(f"Terminating worker process with PID: {worker_process.pid}")
+        logger.info(f"Terminating worker supervisor process with PID: {worker_process.pid}")
         worker_process.terminate()
         worker_process.join()
 
+def _retry():
+    # Retried jobs are requeued right away, so no RQ scheduler is needed
+    return Retry(max=JOB_MAX_RETRIES) if JOB_MAX_RETRIES > 0 else None
+
+JOB_STATES = ("queued", "started", "finished", "failed", "deferred", "scheduled", "canceled")
+
+def _registry(queue, state):
+    return getattr(queue, f"{state}_job_registry")
+
+def _state_totals(queues, state):
+    """Number of jobs in `state` on each queue, from O(1) Redis commands sent in one round trip.
+
+    Registry counts may include entries that have expired but were not cleaned up yet.
+    """
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            if state == "queued":
+                pipe.llen(queue.key)
+            else:
+                pipe.zcard(_registry(queue, state).key)
+        return pipe.execute()
+
+def _job_counts():
+    """Job count per state over all queues, plus the length of every queue."""
+    queues = all_queues()
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for state in JOB_STATES:
+            for queue in queues:
+                if state == "queued":
+                    pipe.llen(queue.key)
+                else:
+                    pipe.zcard(_registry(queue, state).key)
+        counts = pipe.execute()
+    totals = {state: sum(counts[index * len(queues):(index + 1) * len(queues)])
+              for index, state in enumerate(JOB_STATES)}
+    return totals, {queue.name: length for queue, length in zip(queues, counts[:len(queues)])}
+
+def _timestamp(value):
+    # RQ stores naive UTC datetimes
+    return value.replace(tzinfo=timezone.utc).isoformat() if value else None
+
+def _job_summary(job):
+    meta = job.meta or {}
+    state = job.get_status(refresh=False)
+    return {
+        "job_id": job.id,
+        "queue": job.origin,
+        "state": getattr(state, "value", state),
+        "status": meta.get("status"),
+        "stage": meta.get("stage"),
+        "progress": meta.get("progress"),
+        "firestore_ref": job.args[1] if len(job.args) > 1 else None,
+        "enqueued_at": _timestamp(job.enqueued_at),
+        "started_at": _timestamp(job.started_at),
+        "ended_at": _timestamp(job.ended_at),
+    }
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Checks the status of the queue."""
+    """Checks the status of the queue with constant-cost counters."""
+    global _health
+    if _health is not None and time.monotonic() < _health[0]:
+        return jsonify(_health[1]), 200
     try:
-        queue_length = len(q)
-        return jsonify({
+        counts, queue_lengths = _job_counts()
+        cache = get_result_cache()
+        body = {
             "status": "ok",
             "queue_name": q.name,
-            "queue_length": queue_length,
-            "queued_job_ids": q.job_ids,
-            "failed_job_count": q.failed_job_registry.count,
-        }), 200
+            "queue_length": counts["queued"],
+            "queues": queue_lengths,
+            "failed_job_count": counts["failed"],
+            "jobs": counts,
+            "result_cache": cache.stats() if cache else None,
+            "notifications": notification_counts(redis_conn),
+        }
+        _health = (time.monotonic() + HEALTH_CACHE_SECONDS, body)
+        return jsonify(body), 200
     except Exception as e:
         logger.error(f"Health check failed: {e}", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this host's API and worker processes."""
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
+
 @app.route('/api/transcribe', methods=['POST'])
 def transcribe():
     data = request.get_json()
@@ -73,21 +173,263 @@ def transcribe():
         logger.error("media_url or firestore_ref is missing")
         return jsonify({"error": "media_url and firestore_ref are required"}), 400
 
-    # Record the time the request was received in Firestore
     try:
+        duration = _duration(data.get('duration'))
+    except ValueError:
+        return jsonify({"error": "duration must be a finite non-negative number of seconds"}), 400
+    if duration is None:
+        duration = probe_duration(media_url)
+
+    # Admission: route by duration and turn the job away if the backlog ahead of it is too long
+    job_class = size_class(duration)
+    backlog = Backlog()
+    eta = backlog.eta(job_class, duration)
+    if not backlog.admits(eta):
+        logger.warning(f"[{firestore_ref}] Rejected {job_class} job, estimated completion in {eta:.0f}s")
+        return _backlog_full(eta)
+    backlog.add(job_class, duration)
+    backlog.save()
+    queue = size_class_queues[job_class]
+
+    # The ID is fixed up front so the client can follow /api/jobs/<job_id>/stream right away
+    job_id = uuid.uuid4().hex
+    JobEvents(job_id).status("QUEUED")
+
+    # Enqueued in the request, so a Redis error fails it and the client can retry
+    logger.info(f"Enqueuing {job_class} task for {media_url} with notification={notification}")
+    queue.enqueue(PROCESS_MEDIA_TASK, media_url, firestore_ref, language, notification,
+                  job_id=job_id, job_timeout=job_timeout(duration), retry=_retry(),
+                  meta={"size_class": job_class, "duration": duration})
+    logger.info(f"Task enqueued. Current {queue.name} queue length: {len(queue)}")
+
+    # Record the time the request was received in Firestore. The write goes
+    # through the write-behind writer; the job waits for its mark before writing
+    # its own statuses, so they can never be overwritten by QUEUED.
+    received_time = datetime.now(timezone.utc)
+    update_firestore_async(firestore_ref, {"received_at": received_time, "status": "QUEUED"},
+                           on_commit=partial(mark_queued_written, job_id))
+    logger.info(f"[{firestore_ref}] Request received at {received_time}, status QUEUED scheduled.")
+
+    return jsonify({
+        "message": "Processing started",
+        "job_id": job_id,
+        "size_class": job_class,
+        "duration": duration,
+        "eta_seconds": round(eta),
+    })
+
+@app.route('/api/transcribe/batch', methods=['POST'])
+def transcribe_batch():
+    """Queues many media files at once.
+
+    QUEUED statuses are written with batched Firestore writes and all jobs are
+    enqueued in a single Redis pipeline once they are written. Returns a job ID
+    or an error per item.
+    """
+    data = request.get_json(silent=True) or {}
+    api_key = data.get('api_key')
+    items = data.get('items')
+
+    # API key validation (placeholder)
+    if not api_key:
+        logger.warning("API key is missing")
+        return jsonify({"error": "API key is missing"}), 401
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {BATCH_MAX_ITEMS} items are allowed per batch"}), 413
+
+    results = [None] * len(items)
+    valid = []
+    backlog = Backlog()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('media_url') or not item.get('firestore_ref'):
+            results[index] = {"index": index, "error": "media_url and firestore_ref are required"}
+            continue
+        # Batch items are not probed; without a duration they are treated as long jobs
+        try:
+            duration = _duration(item.get('duration'))
+        except ValueError:
+            results[index] = {"index": index, "error": "duration must be a finite non-negative number of seconds"}
+            continue
+        job_class = size_class(duration)
+        eta = backlog.eta(job_class, duration)
+        if not backlog.admits(eta):
+            results[index] = {"index": index, "error": "Backlog is full", "eta_seconds": round(eta)}
+            continue
+        backlog.add(job_class, duration)
+        valid.append((index, item, job_class, duration, eta))
+    backlog.save()
+
+    logger.info(f"Received batch of {len(items)} items, {len(valid)} valid")
+    if valid:
+        # All jobs are enqueued in one pipeline, then the QUEUED statuses are
+        # committed in groups of BATCH_LIMIT documents before the response
         received_time = datetime.now(timezone.utc)
-        update_firestore(firestore_ref, {"received_at": received_time, "status": "QUEUED"})
-        logger.info(f"[{firestore_ref}] Request received at {received_time}, status set to QUEUED.")
-    except Exception as e:
-        logger.error(f"[{firestore_ref}] Failed to update Firestore on request received: {e}", exc_info=True)
-        # The process is not interrupted, the error is only logged
+        job_datas = {}
+        for index, item, job_class, duration, eta in valid:
+            job_id = uuid.uuid4().hex
+            job_datas.setdefault(job_class, []).append(Queue.prepare_data(
+                PROCESS_MEDIA_TASK,
+                args=(item['media_url'], item['firestore_ref'], item.get('language', 'en-US'),
+                      item.get('notification', False)),
+                timeout=job_timeout(duration),
+                job_id=job_id,
+                retry=_retry(),
+                meta={"size_class": job_class, "duration": duration},
+            ))
+            results[index] = {"index": index, "firestore_ref": item['firestore_ref'], "job_id": job_id,
+                              "size_class": job_class, "eta_seconds": round(eta)}
+
+        publish_queued([results[entry[0]]["job_id"] for entry in valid])
+
+        with redis_conn.pipeline() as pipe:
+            for job_class, datas in job_datas.items():
+                size_class_queues[job_class].enqueue_many(datas, pipeline=pipe)
+            pipe.execute()
+        logger.info(f"Batch of {len(valid)} tasks enqueued")
+
+        status = {"received_at": received_time, "status": "QUEUED"}
+        for offset in range(0, len(valid), BATCH_LIMIT):
+            group = [(index, item) for index, item, *_ in valid[offset:offset + BATCH_LIMIT]]
+            try:
+                update_firestore_batch([(item['firestore_ref'], status) for _, item in group])
+                written = True
+            except Exception as e:
+                logger.error(f"Failed to write {len(group)} QUEUED statuses, retrying them in the background: {e}",
+                             exc_info=True)
+                written = False
+            # Only the group whose commit failed goes to the write-behind writer for retries
+            with redis_conn.pipeline() as pipe:
+                for index, item in group:
+                    results[index]["status_written"] = written
+                    if written:
+                        mark_queued_written(results[index]["job_id"], connection=pipe)
+                    else:
+                        update_firestore_async(item['firestore_ref'], status,
+                                               on_commit=partial(mark_queued_written, results[index]["job_id"]))
+                pipe.execute()
+
+    return jsonify({"message": "Processing started", "results": results})
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Lists the jobs in one state a page at a time; only the requested page is read from Redis."""
+    state = request.args.get("state", "queued")
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = min(max(1, int(request.args.get("limit", JOBS_PAGE_SIZE))), JOBS_PAGE_MAX)
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+
+    if state not in JOB_STATES:
+        return jsonify({"error": f"state must be one of: {', '.join(JOB_STATES)}"}), 400
+    queues = all_queues()
+    if request.args.get("queue"):
+        queues = [queue for queue in queues if queue.name == request.args["queue"]]
+        if not queues:
+            return jsonify({"error": f"queue must be one of: {', '.join(queue.name for queue in all_queues())}"}), 400
+
+    # The queues are paged through one after another, in the order workers serve them
+    totals = _state_totals(queues, state)
+    total = sum(totals)
+    job_ids = []
+    skip = offset
+    for queue, queue_total in zip(queues, totals):
+        if len(job_ids) >= limit:
+            break
+        if skip >= queue_total:
+            skip -= queue_total
+            continue
+        count = limit - len(job_ids)
+        if state == "queued":
+            job_ids += queue.get_job_ids(skip, count)
+        else:
+            job_ids += _registry(queue, state).get_job_ids(skip, skip + count - 1)
+        skip = 0
+
+    jobs = [
+        _job_summary(job) if job is not None else {"job_id": job_id, "state": None}
+        for job_id, job in zip(job_ids, Job.fetch_many(job_ids, connection=q.connection))
+    ]
+    return jsonify({
+        "state": state,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "next_offset": offset + len(job_ids) if offset + len(job_ids) < total else None,
+        "jobs": jobs,
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """State, status, stage and progress of one job, from its RQ job hash."""
+    try:
+        job = Job.fetch(job_id, connection=q.connection)
+    except NoSuchJobError:
+        return jsonify({"error": "Job not found"}), 404
+    summary = _job_summary(job)
+    summary.update({
+        "language": job.args[2] if len(job.args) > 2 else None,
+        "retries_left": job.retries_left,
+        "error_message": (job.meta or {}).get("error_message"),
+        "updated_at": (job.meta or {}).get("updated_at"),
+    })
+    return jsonify(summary)
+
+def _duration(value):
+    """Client-supplied duration in seconds, or None. Raises ValueError unless it is a finite non-negative number."""
+    if value is None:
+        return None
+    try:
+        duration = float(value)
+    except TypeError:
+        raise ValueError(value)
+    if not (math.isfinite(duration) and duration >= 0):
+        raise ValueError(value)
+    return duration
+
+def _backlog_full(eta):
+    # Retry once enough of the backlog ahead of the job should have drained
+    retry_after = max(1, math.ceil(eta - MAX_ETA_SECONDS))
+    response = jsonify({"error": "Backlog is full", "eta_seconds": round(eta), "retry_after": retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+def _sse(event, data, event_id=None):
+    frame = f"id: {event_id}\n" if event_id else ""
+    return f"{frame}event: {event}\ndata: {data}\n\n"
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def job_stream(job_id):
+    """Server-Sent Events stream of a job's status, progress and transcript lines.
+
+    Replays the job's events from the start (or after Last-Event-ID on a
+    reconnect), then follows them until the job is DONE or ERROR.
+    """
+    if not job_events_exist(job_id) and not Job.exists(job_id, connection=q.connection):
+        return jsonify({"error": "Job not found"}), 404
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "0"
 
-    logger.info(f"Enqueuing task for {media_url} with notification={notification}")
-    # Increase timeout to 2 hours (7200 seconds) for processing large files
-    q.enqueue('src.tasks.process_media_task', media_url, firestore_ref, language, notification, job_timeout=7200)
-    logger.info(f"Task enqueued. Current queue length: {len(q)}")
+    def stream():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        for event_id, event, data in iter_job_events(job_id, last_id, block_seconds=SSE_KEEPALIVE_SECONDS):
+            if event_id is not None:
+                yield _sse(event, data, event_id)
+                continue
+            # Nothing new: end the stream if the job died without publishing a final status
+            try:
+                status = Job.fetch(job_id, connection=q.connection).get_status()
+            except NoSuchJobError:
+                status = None if job_events_exist(job_id) else "expired"
+            if status in ("failed", "stopped", "canceled", "expired"):
+                yield _sse("status", json.dumps({"status": "ERROR", "error_message": f"Job {status}"}))
+                return
+            yield ": keepalive\n\n"
 
-    return jsonify({"message": "Processing started"})
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 if __name__ == '__main__':
     # This block only runs when called directly (development mode)
@@ -0,0 +1,129 @@
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# A merged speaker turn: `ranges` is a list of (start, end) offsets in seconds
+# into the shared AudioBuffer, so no audio is copied until it is sent.
+Segment = namedtuple("Segment", ["speaker", "start", "end", "ranges"])
+
+
+def _read_wav_header(f, name):
+    """Reads RIFF chunks up to the data chunk.
+
+    Returns (data chunk size, sample_rate, channels, bits) with `f` positioned
+    at the start of the samples.
+    """
+    riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        raise ValueError(f"{name} is not a RIFF/WAVE file")
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError(f"{name} has no data chunk")
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", f.read(16))
+            f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError(f"{name} has data before fmt chunk")
+            audio_format, channels, sample_rate, _, _, bits = fmt
+            if audio_format not in (1, 0xFFFE) or bits != 16:
+                raise ValueError(f"{name} is not 16-bit PCM (format {audio_format}, {bits} bits)")
+            return chunk_size, sample_rate, channels, bits
+        else:
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def read_wav_format(f):
+    """Returns (sample_rate, channels, bits) of a 16-bit PCM WAV stream, e.g. the first downloaded bytes.
+
+    Raises ValueError if it is not one.
+    """
+    try:
+        _, sample_rate, channels, bits = _read_wav_header(f, "stream")
+    except struct.error as e:
+        raise ValueError(f"Truncated WAV header: {e}")
+    return sample_rate, channels, bits
+
+
+def _find_data_chunk(path):
+    """Returns (offset, size, sample_rate, channels, bits) of the PCM data in a WAV file."""
+    with open(path, "rb") as f:
+        chunk_size, sample_rate, channels, bits = _read_wav_header(f, path)
+        offset = f.tell()
+    # Streamed WAV headers may carry a placeholder size, trust the file length instead
+    size = min(chunk_size, os.path.getsize(path) - offset)
+    return offset, size, sample_rate, channels, bits
+
+
+class AudioBuffer:
+    """Mono 16-bit PCM audio held once, either in memory or memory-mapped from a WAV file."""
+
+    def __init__(self, samples, sample_rate=16000):
+        self.samples = samples
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_wav(cls, path):
+        offset, size, sample_rate, channels, _ = _find_data_chunk(path)
+        if channels != 1:
+            raise ValueError(f"{path} has {channels} channels, expected mono")
+        samples = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(size // 2,))
+        return cls(samples, sample_rate)
+
+    @classmethod
+    def from_pcm(cls, data, sample_rate=16000):
+        """Wraps raw mono LINEAR16 bytes (e.g. decoded by ffmpeg) without copying them."""
+        return cls(np.frombuffer(data, dtype="<i2", count=len(data) // 2), sample_rate)
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def _index(self, seconds):
+        return min(max(int(round(seconds * self.sample_rate)), 0), len(self.samples))
+
+    def view(self, start, end):
+        """Returns a zero-copy view of the samples between `start` and `end` seconds."""
+        return self.samples[self._index(start):self._index(end)]
+
+    def pcm_bytes(self, ranges):
+        """Returns raw LINEAR16 bytes for a list of (start, end) ranges, copying the audio once."""
+        views = [self.view(start, end) for start, end in ranges]
+        if not views:
+            return b""
+        if len(views) == 1:
+            return views[0].tobytes()
+        return np.concatenate(views).tobytes()
+
+    def ranges_duration(self, ranges):
+        return sum(self._index(end) - self._index(start) for start, end in ranges) / self.sample_rate
+
+
+def iter_merged_segments(turns):
+    """Merges consecutive (start, end, speaker) turns of the same speaker into Segments.
+
+    Works on any iterable, so segments are yielded as soon as the speaker changes.
+    """
+    current = None
+    for start, end, speaker in turns:
+        if current is not None and current.speaker == speaker:
+            current.ranges.append((start, end))
+            current = current._replace(end=end)
+        else:
+            if current is not None:
+                yield current
+            current = Segment(speaker, start, end, [(start, end)])
+    # Don't forget the last segment
+    if current is not None:
+        yield current
+
+
+def merge_speaker_turns(diarization):
+    """Merges consecutive turns of the same speaker in a pyannote Annotation."""
+    turns = ((turn.start, turn.end, speaker) for turn, _, speaker in diarization.itertracks(yield_label=True))
+    return list(iter_merged_segments(turns))
@@ -0,0 +1,50 @@
+import io
+import os
+
+import numpy as np
+import soundfile
+
+from ..utils.logger import logger
+
+# Encoding of the audio sent to Speech: LINEAR16 (raw PCM), FLAC (lossless)
+# or OGG_OPUS (lossy, smallest). Payloads are encoded in-process with libsndfile.
+SPEECH_AUDIO_ENCODING = os.getenv("SPEECH_AUDIO_ENCODING", "FLAC").upper()
+
+# libsndfile container and subtype for each Speech encoding
+_FORMATS = {
+    "FLAC": ("FLAC", "PCM_16"),
+    "OGG_OPUS": ("OGG", "OPUS"),
+}
+# Opus only supports these input rates, and Speech requires one of them for OGG_OPUS
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+_unsupported = set()
+
+
+def encode_audio(pcm, sample_rate, encoding=SPEECH_AUDIO_ENCODING):
+    """Encodes mono LINEAR16 bytes for a Speech request.
+
+    Returns (payload, encoding). Falls back to LINEAR16 when the encoding is
+    unknown or not supported by the installed libsndfile (logged once), so a
+    request is never lost to an encoder problem.
+    """
+    if encoding == "LINEAR16" or encoding in _unsupported:
+        return pcm, "LINEAR16"
+    if encoding not in _FORMATS or (encoding == "OGG_OPUS" and sample_rate not in OPUS_SAMPLE_RATES):
+        _fallback(encoding, f"not supported at {sample_rate} Hz")
+        return pcm, "LINEAR16"
+
+    container, subtype = _FORMATS[encoding]
+    try:
+        output = io.BytesIO()
+        soundfile.write(output, np.frombuffer(pcm, dtype="<i2"), sample_rate, format=container, subtype=subtype)
+    except Exception as e:
+        _fallback(encoding, e)
+        return pcm, "LINEAR16"
+    return output.getvalue(), encoding
+
+
+def _fallback(encoding, reason):
+    if encoding not in _unsupported:
+        _unsupported.add(encoding)
+        logger.warning(f"Cannot encode Speech audio as {encoding} ({reason}), sending LINEAR16 instead")
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import wave
+
+from pyannote.core import Annotation, Segment
+
+from .audio_buffer import AudioBuffer
+from ..utils.logger import logger
+
+# Stage results of unfinished jobs are kept here so a retried job can resume.
+# Should be on local disk that survives worker restarts (not tmpfs shared with scratch files).
+CHECKPOINTS_ENABLED = os.getenv("JOB_CHECKPOINTS", "true").lower() in ("1", "true", "yes")
+CHECKPOINT_DIR = os.getenv("JOB_CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "transcript-checkpoints"))
+# Work areas of jobs that were never retried are removed after this many hours
+CHECKPOINT_TTL_HOURS = float(os.getenv("JOB_CHECKPOINT_TTL_HOURS", "24"))
+
+
+def _write_atomic(path, write):
+    # Written next to the target and renamed, so a crash never leaves a half-written artifact
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_rttm(path):
+    """Reads the SPEAKER lines of an RTTM file into an Annotation."""
+    annotation = Annotation()
+    with open(path) as f:
+        for track, line in enumerate(f):
+            fields = line.split()
+            if not fields or fields[0] != "SPEAKER":
+                continue
+            start, duration, speaker = float(fields[3]), float(fields[4]), fields[7]
+            annotation[Segment(start, start + duration), track] = speaker
+    return annotation
+
+
+class JobCheckpoint:
+    """Work area of one job that persists the result of every completed stage.
+
+    Holds the decoded audio (`audio.wav`), the download facts (`manifest.json`),
+    the diarization (`diarization.rttm`) and one line per transcribed request
+    piece (`transcripts.jsonl`). The area is keyed by the RQ job ID, which a
+    retry keeps, so the retry finds it and skips whatever is already done,
+    while concurrent jobs with the same inputs never share an area.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def open(cls, job_id, model_version):
+        # The model is part of the key, so a retry after a model change starts over
+        key = hashlib.sha256(f"{job_id}|{model_version}".encode()).hexdigest()
+        return cls(os.path.join(CHECKPOINT_DIR, key[:32]))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def load_manifest(self):
+        try:
+            with open(self._file("manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_audio(self, audio, manifest):
+        """Stores the decoded audio and `manifest`; returns the audio memory-mapped from the checkpoint."""
+        def write(f):
+            with wave.open(f, "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(audio.sample_rate)
+                wav.writeframes(memoryview(audio.samples).cast("B"))
+
+        _write_atomic(self._file("audio.wav"), write)
+        _write_atomic(self._file("manifest.json"), lambda f: f.write(json.dumps(manifest).encode()))
+        return AudioBuffer.from_wav(self._file("audio.wav"))
+
+    def load_audio(self):
+        """Returns (AudioBuffer, manifest) of a previous attempt, or (None, None)."""
+        manifest = self.load_manifest()
+        if manifest is None or not os.path.exists(self._file("audio.wav")):
+            return None, None
+        return AudioBuffer.from_wav(self._file("audio.wav")), manifest
+
+    def save_diarization(self, turns):
+        """Stores (start, end, speaker) turns as RTTM."""
+        lines = "".join(
+            f"SPEAKER job 1 {start:.3f} {end - start:.3f} <NA> <NA> {speaker} <NA> <NA>\n"
+            for start, end, speaker in turns
+        )
+        _write_atomic(self._file("diarization.rttm"), lambda f: f.write(lines.encode()))
+
+    def load_diarization(self):
+        """Returns the stored diarization as an Annotation, or None."""
+        try:
+            return read_rttm(self._file("diarization.rttm"))
+        except OSError:
+            return None
+
+    @staticmethod
+    def piece_key(piece):
+        # Rounded, not truncated: RTTM keeps milliseconds, so this matches across attempts
+        return f"{round(piece.segment.start * 1000)}:{piece.index}"
+
+    def load_transcripts(self):
+        """Returns {piece key: text} of every request piece transcribed by a previous attempt."""
+        transcripts = {}
+        try:
+            with open(self._file("transcripts.jsonl")) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by a crash
+                        continue
+                    transcripts[record["key"]] = record["text"]
+        except OSError:
+            pass
+        return transcripts
+
+    def record_transcripts(self, pieces):
+        """Appends (piece, text) results; safe to call from any thread."""
+        lines = "".join(json.dumps({"key": self.piece_key(piece), "text": text}) + "\n" for piece, text in pieces)
+        with self._lock, open(self._file("transcripts.jsonl"), "a") as f:
+            f.write(lines)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def open_checkpoint(firestore_ref, job_id, model_version):
+    """Returns the job's checkpoint, or None when checkpoints are disabled or unavailable.
+
+    Without a job ID (outside RQ) there is no retry to resume, so the area is unique to the call.
+    """
+    if not CHECKPOINTS_ENABLED:
+        return None
+    try:
+        prune_checkpoints()
+        return JobCheckpoint.open(job_id or uuid.uuid4().hex, model_version)
+    except OSError as e:
+        logger.warning(f"[{firestore_ref}] Job checkpoints unavailable: {e}")
+        return None
+
+
+def prune_checkpoints(max_age_hours=CHECKPOINT_TTL_HOURS):
+    """Removes work areas that have not been touched for `max_age_hours`."""
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+    cutoff = time.time() - max_age_hours * 3600
+    for entry in os.scandir(CHECKPOINT_DIR):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                logger.info(f"Removed stale job checkpoint {entry.name}")
+        except OSError:
+            pass
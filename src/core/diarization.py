@@ -1,34 +1,577 @@
-from pyannote.audio import Pipeline
+from pyannote.core import Annotation, Segment
+from .audio_buffer import AudioBuffer
 from ..utils.logger import logger
+from ..utils.metrics import DiarizationStepTimer
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import inspect
+import multiprocessing
 import os
+import threading
+import time
+import numpy as np
 import torch
 
-def diarize_audio(audio_path):
-    # Hook function for tracking progress
-    # Added **kwargs to accept any additional arguments
-    def hook(step_name: str, step_artefact, **kwargs):
-        # `step_artefact` can be different: slider, number, etc.
-        # Only the step name is logged for simplicity.
-        logger.info(f"Diarization step '{step_name}' completed.")
-
-    # Get Hugging Face token from environment variables
-    hf_token = os.getenv("HUGGING_FACE_TOKEN")
-    if not hf_token:
-        raise ValueError("HUGGING_FACE_TOKEN environment variable is not set")
-        
-    pipeline = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization@2.1",
-        use_auth_token=hf_token
-    )
-    
+DEFAULT_MODEL = "pyannote/speaker-diarization@2.1"
+
+# Rolling-window settings for the pipelined (streaming) and parallel diarization modes
+STREAM_WINDOW_SECONDS = float(os.getenv("DIARIZATION_WINDOW_SECONDS", "300"))
+STREAM_OVERLAP_SECONDS = float(os.getenv("DIARIZATION_WINDOW_OVERLAP_SECONDS", "30"))
+# Parallel mode: files at least this long are diarized window by window in
+# this many forked processes (0 or 1 disables it; CPU only)
+PARALLEL_WORKERS = int(os.getenv("DIARIZATION_PARALLEL_WORKERS", "0"))
+PARALLEL_MIN_SECONDS = float(os.getenv("DIARIZATION_PARALLEL_MIN_SECONDS", "1800"))
+# Max cosine distance between speaker embeddings of two windows to treat them as one speaker
+STITCH_THRESHOLD = float(os.getenv("DIARIZATION_STITCH_THRESHOLD", "0.6"))
+# CPU mode: "fast" applies dynamic int8 quantization to the segmentation and
+# embedding models and pins every worker to its own share of the cores
+CPU_FAST_MODE = os.getenv("DIARIZATION_CPU_MODE", "default").lower() == "fast"
+# Torch intra-op threads per worker (0: the worker's share of the cores, or torch's default for a single worker)
+CPU_THREADS = int(os.getenv("DIARIZATION_CPU_THREADS", "0"))
+# Inference batch sizes of the pipeline (0 keeps the pipeline's own)
+EMBEDDING_BATCH_SIZE = int(os.getenv("DIARIZATION_EMBEDDING_BATCH_SIZE", "0"))
+SEGMENTATION_BATCH_SIZE = int(os.getenv("DIARIZATION_SEGMENTATION_BATCH_SIZE", "0"))
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded diarization pipelines.
+
+    Pipelines are keyed by (model name, device) and evicted in LRU order once
+    more than `max_models` variants are loaded. Load and inference timings are
+    accumulated so the cold-start cost can be compared with the actual work.
+    """
+
+    def __init__(self, max_models=1):
+        self.max_models = max(1, max_models)
+        self._pipelines = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {
+            "loads": 0,
+            "hits": 0,
+            "evictions": 0,
+            "load_time_total": 0.0,
+            "last_load_time": None,
+            "inferences": 0,
+            "inference_time_total": 0.0,
+            "last_inference_time": None,
+        }
+
+    def get(self, model_name=None, device=None):
+        """Returns a loaded pipeline, loading it on first use."""
+        model_name = model_name or default_model_name()
+        device = device or default_device()
+        key = (model_name, str(device))
+
+        with self._lock:
+            pipeline = self._pipelines.get(key)
+            if pipeline is not None:
+                self._pipelines.move_to_end(key)
+                self.metrics["hits"] += 1
+                return pipeline
+
+            pipeline = self._load(model_name, device)
+            self._pipelines[key] = pipeline
+            while len(self._pipelines) > self.max_models:
+                evicted_key, _ = self._pipelines.popitem(last=False)
+                self.metrics["evictions"] += 1
+                logger.info(f"Evicted diarization pipeline {evicted_key[0]} on {evicted_key[1]} from registry.")
+            return pipeline
+
+    def register(self, model_name, device, pipeline):
+        """Adds an already built pipeline, e.g. a local stand-in for benchmarks."""
+        with self._lock:
+            self._pipelines[(model_name, str(device))] = pipeline
+            self._pipelines.move_to_end((model_name, str(device)))
+
+    def _load(self, model_name, device):
+        # Get Hugging Face token from environment variables
+        hf_token = os.getenv("HUGGING_FACE_TOKEN")
+        if not hf_token:
+            raise ValueError("HUGGING_FACE_TOKEN environment variable is not set")
+
+        logger.info(f"Loading diarization pipeline {model_name} on {device}...")
+        started = time.perf_counter()
+        # Imported on first load: pyannote.audio pulls in most of its training stack
+        from pyannote.audio import Pipeline
+        pipeline = Pipeline.from_pretrained(model_name, use_auth_token=hf_token)
+        if str(device) != "cpu":
+            pipeline.to(torch.device(device))
+        elif CPU_FAST_MODE:
+            quantize_pipeline(pipeline)
+        set_batch_sizes(pipeline, EMBEDDING_BATCH_SIZE, SEGMENTATION_BATCH_SIZE)
+        elapsed = time.perf_counter() - started
+
+        self.metrics["loads"] += 1
+        self.metrics["load_time_total"] += elapsed
+        self.metrics["last_load_time"] = round(elapsed, 3)
+        logger.info(f"Diarization pipeline {model_name} loaded on {device} in {elapsed:.2f}s.")
+        return pipeline
+
+    def record_inference(self, elapsed):
+        with self._lock:
+            self.metrics["inferences"] += 1
+            self.metrics["inference_time_total"] += elapsed
+            self.metrics["last_inference_time"] = round(elapsed, 3)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["loaded"] = [f"{name}@{device}" for name, device in self._pipelines]
+        stats["load_time_total"] = round(stats["load_time_total"], 3)
+        stats["inference_time_total"] = round(stats["inference_time_total"], 3)
+        return stats
+
+
+def default_model_name():
+    return os.getenv("DIARIZATION_MODEL", DEFAULT_MODEL)
+
+
+def default_device():
+    device = os.getenv("DIARIZATION_DEVICE")
+    if device:
+        return device
     # Check for GPU and move model to it
     if torch.cuda.is_available():
-        logger.info("GPU detected, moving diarization pipeline to CUDA device.")
-        pipeline.to(torch.device("cuda"))
-    else:
-        logger.info("No GPU detected, running diarization on CPU.")
-    
+        return "cuda"
+    return "cpu"
+
+
+def _quantizable_models(pipeline):
+    """Returns (name, torch module) of the pipeline's segmentation and embedding models."""
+    models = []
+    segmentation = getattr(pipeline, "_segmentation", None)
+    if isinstance(getattr(segmentation, "model", None), torch.nn.Module):
+        models.append(("segmentation", segmentation.model))
+    embedding = getattr(pipeline, "_embedding", None)
+    # pyannote embedding models are kept in `model_`, SpeechBrain ones (2.x pipelines) in `classifier_.mods`
+    for model in (getattr(embedding, "model_", None), getattr(getattr(embedding, "classifier_", None), "mods", None)):
+        if isinstance(model, torch.nn.Module):
+            models.append(("embedding", model))
+            break
+    return models
+
+
+def quantize_pipeline(pipeline):
+    """Applies dynamic int8 quantization to the LSTM and linear layers of the pipeline's models, in place.
+
+    Weights are stored as int8 and activations are quantized on the fly, so
+    no calibration data is needed. Convolutions stay in float32.
+    """
+    for name, model in _quantizable_models(pipeline):
+        torch.quantization.quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        logger.info(f"Quantized the {name} model to int8 (dynamic).")
+
+
+def set_batch_sizes(pipeline, embedding_batch_size=0, segmentation_batch_size=0):
+    """Overrides the pipeline's inference batch sizes; 0 keeps the current one."""
+    if embedding_batch_size and hasattr(pipeline, "embedding_batch_size"):
+        pipeline.embedding_batch_size = embedding_batch_size
+    segmentation = getattr(pipeline, "_segmentation", None)
+    if segmentation_batch_size and hasattr(segmentation, "batch_size"):
+        # Set on the inference object itself: 2.x pipelines only read their attribute when built
+        segmentation.batch_size = segmentation_batch_size
+
+
+def pin_cpu_threads(slot=0, slots=1):
+    """Sizes torch's thread pools for worker `slot` of `slots` on this host.
+
+    Each of several workers gets its share of the cores as intra-op threads
+    (DIARIZATION_CPU_THREADS overrides it), so together they never run more
+    threads than there are cores. In fast mode the worker is also bound to its
+    share of the cores. Call in a freshly forked worker before it runs the
+    model; only applies to CPU diarization.
+    """
+    if not (CPU_FAST_MODE or CPU_THREADS or slots > 1) or str(default_device()) != "cpu":
+        return
+    try:
+        cores = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = list(range(os.cpu_count() or 1))
+    share = max(1, len(cores) // max(1, slots))
+    if CPU_FAST_MODE and len(cores) >= slots > 1:
+        cores = cores[slot * share:(slot + 1) * share]
+        os.sched_setaffinity(0, cores)
+    threads = CPU_THREADS or share
+    torch.set_num_threads(threads)
+    try:
+        # Pipeline steps run one after another, so one inter-op thread is enough
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only possible before the inter-op pool has started
+        pass
+    logger.info(f"Diarization uses {threads} threads on {len(cores)} cores (PID {os.getpid()})")
+
+
+registry = ModelRegistry(max_models=int(os.getenv("DIARIZATION_MAX_MODELS", "1")))
+
+
+def warm_up(model_name=None, device=None):
+    """Loads the default pipeline so the first job does not pay for it."""
+    registry.get(model_name, device)
+    logger.info(f"Diarization registry warmed up: {registry.stats()}")
+
+
+def _log_step(step_name, elapsed):
+    # Only the step name and its duration are logged for simplicity.
+    logger.info(f"Diarization step '{step_name}' completed in {elapsed:.2f}s.")
+
+
+def _apply_pipeline(pipeline, audio_input, **kwargs):
+    # The hook tracks progress and records how long each pipeline step takes
+    hook = DiarizationStepTimer(on_step=_log_step)
+    started = time.perf_counter()
+    diarization = pipeline(audio_input, hook=hook, **kwargs)
+    elapsed = time.perf_counter() - started
+    registry.record_inference(elapsed)
+    return diarization, elapsed
+
+
+def diarize_audio(audio, model_name=None, device=None):
+    """Diarizes an AudioBuffer (passed to pyannote as a waveform, so it is not decoded again) or a file path."""
+    pipeline = registry.get(model_name, device)
+    if isinstance(audio, AudioBuffer):
+        audio = _window_input(audio, 0, audio.duration)
+
     logger.info("Applying diarization pipeline with progress hook...")
-    diarization = pipeline(audio_path, hook=hook)
-    logger.info("Diarization pipeline finished.")
-    return diarization
\ No newline at end of file
+    diarization, elapsed = _apply_pipeline(pipeline, audio)
+    logger.info(f"Diarization pipeline finished in {elapsed:.2f}s. Registry stats: {registry.stats()}")
+    return diarization
+
+
+def _window_input(audio, start, end):
+    """Builds an in-memory pyannote input for a slice of an AudioBuffer."""
+    samples = audio.view(start, end).astype(np.float32) / 32768.0
+    return {"waveform": torch.from_numpy(samples).unsqueeze(0), "sample_rate": audio.sample_rate}
+
+
+class SpeakerCentroids:
+    """Running mean embedding of every global speaker, to recognise speakers across all windows."""
+
+    def __init__(self, threshold=STITCH_THRESHOLD):
+        self.threshold = threshold
+        self._sums = {}
+        self._counts = {}
+
+    @staticmethod
+    def _normalize(vector):
+        if vector is None or not np.all(np.isfinite(vector)):
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def add(self, label, vector):
+        vector = self._normalize(vector)
+        if vector is None:
+            return
+        if label in self._sums and len(self._sums[label]) != len(vector):
+            return
+        self._sums[label] = self._sums.get(label, 0.0) + vector
+        self._counts[label] = self._counts.get(label, 0) + 1
+
+    def match(self, embeddings, exclude=()):
+        """Maps local labels to the closest known speakers within the threshold, one local label each."""
+        candidates = []
+        for local, vector in embeddings.items():
+            vector = self._normalize(vector)
+            if vector is None:
+                continue
+            for label, total in self._sums.items():
+                if label in exclude or len(total) != len(vector):
+                    continue
+                distance = 1.0 - float(vector @ (total / np.linalg.norm(total)))
+                if distance <= self.threshold:
+                    candidates.append((distance, local, label))
+        mapping, used = {}, set(exclude)
+        for _, local, label in sorted(candidates, key=lambda candidate: candidate[0]):
+            if local not in mapping and label not in used:
+                mapping[local] = label
+                used.add(label)
+        return mapping
+
+
+def _label_embeddings(diarization, centroids):
+    # Centroids returned by the pipeline are ordered like diarization.labels()
+    return {
+        label: np.asarray(centroids[index], dtype=np.float32)
+        for index, label in enumerate(diarization.labels())
+        if centroids is not None and index < len(centroids)
+    }
+
+
+def _link_labels(local_turns, previous_turns, overlap_start, overlap_end, next_label, embeddings=None,
+                 speakers=None):
+    """Maps window-local speaker labels to global ones by co-activity in the overlap region.
+
+    Local speakers that were silent in the overlap are matched against every
+    speaker seen so far by their `embeddings` when `speakers` (SpeakerCentroids)
+    is given. Returns the mapping and the updated counter for new global labels.
+    """
+    overlaps = {}
+    for l_start, l_end, local in local_turns:
+        for p_start, p_end, known in previous_turns:
+            shared = min(l_end, p_end, overlap_end) - max(l_start, p_start, overlap_start)
+            if shared > 0:
+                overlaps[(local, known)] = overlaps.get((local, known), 0.0) + shared
+
+    mapping = {}
+    used = set()
+    for (local, known), _ in sorted(overlaps.items(), key=lambda item: item[1], reverse=True):
+        if local not in mapping and known not in used:
+            mapping[local] = known
+            used.add(known)
+
+    if speakers is not None and embeddings:
+        unlinked = {local: vector for local, vector in embeddings.items() if local not in mapping}
+        mapping.update(speakers.match(unlinked, exclude=used))
+
+    for _, _, local in local_turns:
+        if local not in mapping:
+            mapping[local] = f"SPEAKER_{next_label:02d}"
+            next_label += 1
+    return mapping, next_label
+
+
+def _window_bounds(duration, window, overlap):
+    """Splits `duration` into overlapping windows.
+
+    Returns (window_start, window_end, own_start, own_end) per window, where the
+    owned spans tile the file: each window owns the audio up to the middle of
+    its overlap with the next one.
+    """
+    if not 0 <= overlap * 2 < window:
+        raise ValueError("Diarization window overlap must be less than half of the window")
+    step = window - overlap
+    bounds = []
+    window_start = own_start = 0.0
+    while True:
+        window_end = min(window_start + window, duration)
+        if window_end >= duration:
+            bounds.append((window_start, window_end, own_start, duration))
+            return bounds
+        own_end = (window_start + step + window_end) / 2
+        bounds.append((window_start, window_end, own_start, own_end))
+        own_start = own_end
+        window_start += step
+
+
+def diarize_streaming(audio, window=None, overlap=None, model_name=None, device=None):
+    """Diarizes an AudioBuffer over rolling windows and yields finalized (start, end, speaker) turns.
+
+    Consecutive windows overlap by `overlap` seconds; speakers are linked across
+    windows by how much they talk at the same time in the overlap and, when the
+    pipeline returns speaker embeddings, a speaker silent in the overlap is
+    matched against the running centroids of every speaker seen so far. Each
+    window only emits turns up to the middle of its overlap with the next one.
+    Turns are therefore final as soon as they are yielded.
+    """
+    window = window or STREAM_WINDOW_SECONDS
+    overlap = STREAM_OVERLAP_SECONDS if overlap is None else overlap
+    bounds = _window_bounds(audio.duration, window, overlap)
+
+    pipeline = registry.get(model_name, device)
+    with_embeddings = _supports_embeddings(pipeline)
+    speakers = SpeakerCentroids(STITCH_THRESHOLD)
+    previous_turns = []
+    next_label = 0
+
+    for window_start, window_end, own_start, own_end in bounds:
+        logger.info(f"Diarizing window {window_start:.1f}s - {window_end:.1f}s of {audio.duration:.1f}s")
+        audio_input = _window_input(audio, window_start, window_end)
+        embeddings = None
+        if with_embeddings:
+            diarization, centroids = _apply_pipeline(pipeline, audio_input, return_embeddings=True)[0]
+            embeddings = _label_embeddings(diarization, centroids)
+        else:
+            diarization, _ = _apply_pipeline(pipeline, audio_input)
+        local_turns = [
+            (window_start + turn.start, window_start + turn.end, speaker)
+            for turn, _, speaker in diarization.itertracks(yield_label=True)
+        ]
+        mapping, next_label = _link_labels(local_turns, previous_turns, window_start, window_start + overlap,
+                                           next_label, embeddings, speakers)
+        for local, vector in (embeddings or {}).items():
+            if local in mapping:
+                speakers.add(mapping[local], vector)
+        turns = [(start, end, mapping[speaker]) for start, end, speaker in local_turns]
+
+        for start, end, speaker in turns:
+            start, end = max(start, own_start), min(end, own_end)
+            if end > start:
+                yield start, end, speaker
+        previous_turns = turns
+
+
+def parallel_workers(duration, device=None):
+    """Number of processes to diarize a file of `duration` seconds with, 0 for a single pass."""
+    if PARALLEL_WORKERS < 2 or duration < PARALLEL_MIN_SECONDS:
+        return 0
+    # CUDA cannot be used from forked processes, and a GPU is fast enough on its own
+    if str(device or default_device()) != "cpu":
+        return 0
+    return PARALLEL_WORKERS
+
+
+def _supports_embeddings(pipeline):
+    try:
+        return "return_embeddings" in inspect.signature(pipeline.apply).parameters
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+
+# Audio of the running parallel diarization; pool processes inherit it through fork
+_pool_audio = None
+
+
+def _init_window_process(threads):
+    # Split the cores between the pool processes instead of oversubscribing them
+    torch.set_num_threads(threads)
+
+
+def _diarize_window(window_start, window_end, model_name, device):
+    """Runs in a pool process: diarizes one window of the shared audio.
+
+    Returns its turns (in file time) and the embedding of each local speaker,
+    or None when the pipeline cannot return embeddings.
+    """
+    pipeline = registry.get(model_name, device)
+    # Only this window is converted to float; the samples themselves are shared with the parent
+    audio_input = _window_input(_pool_audio, window_start, window_end)
+    embeddings = None
+    if _supports_embeddings(pipeline):
+        diarization, centroids = _apply_pipeline(pipeline, audio_input, return_embeddings=True)[0]
+        embeddings = _label_embeddings(diarization, centroids)
+    else:
+        diarization, _ = _apply_pipeline(pipeline, audio_input)
+    turns = [
+        (window_start + turn.start, window_start + turn.end, speaker)
+        for turn, _, speaker in diarization.itertracks(yield_label=True)
+    ]
+    return turns, embeddings
+
+
+def _cluster_speakers(vectors, windows, threshold):
+    """Average-linkage clustering of per-window speaker embeddings by cosine distance.
+
+    Two speakers of the same window are never merged. Speakers without a usable
+    embedding stay on their own. Returns a cluster index per vector.
+    """
+    count = len(vectors)
+    dimension = next((len(vector) for vector in vectors if vector is not None), 0)
+    matrix = np.zeros((count, dimension), dtype=np.float64)
+    usable = np.zeros(count, dtype=bool)
+    for index, vector in enumerate(vectors):
+        if vector is None or len(vector) != dimension or not np.all(np.isfinite(vector)):
+            continue
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            matrix[index] = vector / norm
+            usable[index] = True
+
+    distances = 1.0 - matrix @ matrix.T
+    distances[~usable, :] = np.inf
+    distances[:, ~usable] = np.inf
+    windows = np.asarray(windows)
+    distances[windows[:, None] == windows[None, :]] = np.inf
+
+    sizes = np.ones(count)
+    clusters = list(range(count))
+    while count:
+        first, second = np.unravel_index(np.argmin(distances), distances.shape)
+        if not distances[first, second] <= threshold:
+            break
+        # Lance-Williams update; a cannot-link (inf) survives the merge
+        merged = (sizes[first] * distances[first] + sizes[second] * distances[second]) / (sizes[first] + sizes[second])
+        distances[first, :] = distances[:, first] = merged
+        distances[first, first] = np.inf
+        distances[second, :] = distances[:, second] = np.inf
+        sizes[first] += sizes[second]
+        clusters = [first if cluster == second else cluster for cluster in clusters]
+    return clusters
+
+
+def _stitch_windows(results, bounds, threshold):
+    """Maps every (window, local label) to a global speaker label.
+
+    Uses the speaker embeddings when every window has them, otherwise links
+    labels window by window through their co-activity in the overlaps.
+    """
+    if all(embeddings is not None for _, embeddings in results):
+        keys, vectors, windows = [], [], []
+        for index, (turns, embeddings) in enumerate(results):
+            for label in sorted({speaker for _, _, speaker in turns}):
+                keys.append((index, label))
+                vectors.append(embeddings.get(label))
+                windows.append(index)
+        clusters = _cluster_speakers(vectors, windows, threshold)
+        # Number the global speakers in order of their first turn
+        first_turn = {}
+        for (index, label), cluster in zip(keys, clusters):
+            start = min(start for start, _, speaker in results[index][0] if speaker == label)
+            first_turn[cluster] = min(first_turn.get(cluster, start), start)
+        names = {cluster: f"SPEAKER_{rank:02d}" for rank, cluster in enumerate(sorted(first_turn, key=first_turn.get))}
+        return {key: names[cluster] for key, cluster in zip(keys, clusters)}
+
+    mapping = {}
+    previous_turns = []
+    next_label = 0
+    for index, ((turns, _), (window_start, window_end, _, _)) in enumerate(zip(results, bounds)):
+        overlap_end = bounds[index - 1][1] if index else window_start
+        local_mapping, next_label = _link_labels(turns, previous_turns, window_start, overlap_end, next_label)
+        mapping.update({(index, label): speaker for label, speaker in local_mapping.items()})
+        previous_turns = [(start, end, local_mapping[speaker]) for start, end, speaker in turns]
+    return mapping
+
+
+def diarize_parallel(audio, workers, window=None, overlap=None, model_name=None, device=None):
+    """Diarizes a long AudioBuffer over overlapping windows in `workers` forked processes.
+
+    The processes share the samples copy-on-write and each only converts one
+    window for the model, so the extra memory depends on the window size rather
+    than the file length. Window-local speaker labels are
+    stitched into global ones by clustering their embeddings, and each window
+    contributes the turns of the span it owns. Returns one Annotation.
+    """
+    window = window or STREAM_WINDOW_SECONDS
+    overlap = STREAM_OVERLAP_SECONDS if overlap is None else overlap
+    model_name = model_name or default_model_name()
+    device = device or default_device()
+    global _pool_audio
+    duration = audio.duration
+    bounds = _window_bounds(duration, window, overlap)
+    workers = max(1, min(workers, len(bounds)))
+
+    # Loaded before forking so every process shares the model copy-on-write
+    registry.get(model_name, device)
+    threads = max(1, torch.get_num_threads() // workers)
+    logger.info(f"Diarizing {duration:.1f}s in {len(bounds)} windows with {workers} processes "
+                f"({threads} threads each)")
+
+    started = time.perf_counter()
+    _pool_audio = audio
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_window_process,
+            initargs=(threads,),
+        ) as pool:
+            futures = [
+                pool.submit(_diarize_window, window_start, window_end, model_name, device)
+                for window_start, window_end, _, _ in bounds
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        _pool_audio = None
+
+    mapping = _stitch_windows(results, bounds, STITCH_THRESHOLD)
+    annotation = Annotation()
+    for index, ((turns, _), (_, _, own_start, own_end)) in enumerate(zip(results, bounds)):
+        for track, (start, end, speaker) in enumerate(turns):
+            start, end = max(start, own_start), min(end, own_end)
+            if end > start:
+                annotation[Segment(start, end), f"{index}_{track}"] = mapping[(index, speaker)]
+
+    elapsed = time.perf_counter() - started
+    registry.record_inference(elapsed)
+    logger.info(f"Parallel diarization finished in {elapsed:.2f}s with {len(annotation.labels())} speakers.")
+    return annotation
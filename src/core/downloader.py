@@ -0,0 +1,178 @@
+import hashlib
+import os
+import time
+
+import requests
+
+from .media_decoder import PcmDecoder, is_target_wav_header
+from ..utils.logger import logger
+
+CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", "5"))
+PIPE_TO_FFMPEG = os.getenv("MEDIA_PIPE_TO_FFMPEG", "true").lower() in ("1", "true", "yes")
+
+# (connect, read) timeouts for a single HTTP request
+REQUEST_TIMEOUT = (10, 60)
+# Statuses with which object stores reject an expired signed URL (GCS answers
+# 400 ExpiredToken, S3-compatible stores 403)
+EXPIRED_URL_STATUSES = (400, 403)
+
+
+def _validator(response):
+    # If-Range only accepts a strong validator: a strong ETag, else Last-Modified
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def iter_download(url, chunk_size=CHUNK_SIZE, max_retries=MAX_RETRIES, stats=None, refresh_url=None,
+                  on_restart=None):
+    """Yields the body of `url` in chunks, resuming with HTTP Range after a dropped connection.
+
+    Only one chunk is held in memory at a time. Resumes send If-Range with the
+    ETag or Last-Modified of the first response; when the server answers with
+    the whole body instead (the content changed, or it ignores Range), the
+    download starts over from zero and `on_restart` is called first so the
+    caller can drop what it received. Without a validator the bytes already
+    delivered are skipped instead. When the URL is rejected as expired (a
+    signed URL outliving its expiration), `refresh_url` is called for a new one.
+    """
+    offset = 0
+    attempt = 0
+    validator = None
+    refreshed = False
+    while True:
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            with requests.get(url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT) as response:
+                # A URL that was just signed is not expired, so it is only re-signed once in a row
+                if refresh_url is not None and response.status_code in EXPIRED_URL_STATUSES and not refreshed:
+                    logger.warning(f"Download URL rejected with {response.status_code} at {offset} bytes, "
+                                   f"signing a new one")
+                    url = refresh_url()
+                    refreshed = True
+                    continue
+                response.raise_for_status()
+                refreshed = False
+                skip = 0
+                if offset and response.status_code != 206:
+                    if validator:
+                        logger.warning(f"Server sent the whole body when resuming at {offset} bytes, "
+                                       f"restarting the download")
+                        if on_restart is not None:
+                            on_restart()
+                        offset = 0
+                    else:
+                        skip = offset
+                        logger.warning(f"Server ignored Range request, skipping {skip} already downloaded bytes")
+                if not offset:
+                    validator = _validator(response)
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if not chunk:
+                        continue
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk = chunk[skip:]
+                        skip = 0
+                    offset += len(chunk)
+                    yield chunk
+            return
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            delay = min(2 ** attempt, 30)
+            logger.warning(f"Download interrupted at {offset} bytes ({e}), resuming in {delay}s "
+                           f"(attempt {attempt}/{max_retries})")
+            if stats is not None:
+                stats["resumes"] = stats.get("resumes", 0) + 1
+            time.sleep(delay)
+
+
+def remote_fingerprint(url):
+    """Identifies the remote content by ETag/Last-Modified and size without downloading it.
+
+    Returns None when the server does not expose a validator.
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"HEAD request for {url} failed: {e}")
+        return None
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    if not validator:
+        return None
+    return f"{url}|{validator}|{response.headers.get('Content-Length', '')}"
+
+
+def download_media(url, file_path, decode=False, firestore_ref=None, scratch=None, refresh_url=None):
+    """Streams `url` to `file_path` and, if `decode` is set, into an in-memory ffmpeg decoder at the same time.
+
+    Returns a dict with the number of downloaded bytes, their SHA-256 and the
+    decoded `audio` (an AudioBuffer, or None). Downloads that start with a
+    16 kHz mono PCM WAV header are not decoded at all, and when piped decoding
+    fails (e.g. an MP4 whose index is at the end of the file) the caller still
+    has the complete file on disk and can decode it from there. With a
+    JobScratch, every chunk counts against its quota before it is written.
+    `refresh_url` returns a new URL when a signed `url` has expired.
+    """
+    stats = {"bytes": 0, "resumes": 0, "audio": None}
+    digest = hashlib.sha256()
+    decoder = None
+    decode = decode and PIPE_TO_FFMPEG
+
+    try:
+        with open(file_path, "wb") as f:
+            def restart():
+                # The content changed while resuming: drop everything received so far
+                nonlocal digest, decoder
+                f.seek(0)
+                f.truncate()
+                if scratch is not None:
+                    scratch.release(stats["bytes"])
+                digest = hashlib.sha256()
+                stats["bytes"] = 0
+                if decoder is not None:
+                    decoder.abort()
+                    decoder = None
+
+            for chunk in iter_download(url, stats=stats, refresh_url=refresh_url, on_restart=restart):
+                if decode and stats["bytes"] == 0 and not is_target_wav_header(chunk):
+                    decoder = PcmDecoder()
+                if scratch is not None:
+                    scratch.reserve(len(chunk))
+                f.write(chunk)
+                digest.update(chunk)
+                stats["bytes"] += len(chunk)
+                if decoder is not None:
+                    try:
+                        decoder.write(chunk)
+                    except (BrokenPipeError, OSError):
+                        logger.warning(f"[{firestore_ref}] ffmpeg closed its input early, "
+                                       f"continuing download to disk only")
+                        decoder.abort()
+                        decoder = None
+        if decoder is not None:
+            try:
+                stats["audio"] = decoder.finish()
+            except RuntimeError as e:
+                logger.warning(f"[{firestore_ref}] Piped decoding failed: {e}")
+            decoder = None
+    finally:
+        if decoder is not None:
+            decoder.abort()
+
+    stats["sha256"] = digest.hexdigest()
+    logger.info(f"[{firestore_ref}] Downloaded {stats['bytes']} bytes to {file_path} "
+                f"(resumes: {stats['resumes']}, decoded while downloading: {stats['audio'] is not None})")
+    return stats
@@ -0,0 +1,148 @@
+import io
+import threading
+from collections import deque
+
+import ffmpeg
+
+from .audio_buffer import AudioBuffer, read_wav_format
+from ..utils.logger import logger
+
+# Format every job is decoded to: 16 kHz mono signed 16-bit little-endian PCM
+SAMPLE_RATE = 16000
+
+
+class InvalidMedia(ValueError):
+    """The input itself cannot be transcribed (no audio stream, malformed WAV), so retrying never helps."""
+
+
+def probe_media(path):
+    """Describes the first audio stream of a media file with ffprobe.
+
+    Returns a dict with the container, codec, sample rate, channels and
+    whether the file also has a video stream, or None if ffprobe fails.
+    """
+    try:
+        info = ffmpeg.probe(path)
+    except ffmpeg.Error as e:
+        logger.warning(f"ffprobe failed for {path}: {e.stderr.decode(errors='replace') if e.stderr else e}")
+        return None
+    streams = info.get("streams", [])
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), None)
+    return {
+        "format": info.get("format", {}).get("format_name", ""),
+        "codec": audio.get("codec_name") if audio else None,
+        "sample_rate": int(audio.get("sample_rate", 0)) if audio else 0,
+        "channels": audio.get("channels") if audio else 0,
+        "has_audio": audio is not None,
+        "has_video": any(stream.get("codec_type") == "video" for stream in streams),
+    }
+
+
+def is_target_pcm(info):
+    """True if the probed file is already a 16 kHz mono 16-bit PCM WAV that can be used as is."""
+    return (
+        info is not None
+        and "wav" in info["format"].split(",")
+        and info["codec"] == "pcm_s16le"
+        and info["sample_rate"] == SAMPLE_RATE
+        and info["channels"] == 1
+    )
+
+
+def is_target_wav_header(header):
+    """Same check as `is_target_pcm`, on the first bytes of a file that is still downloading."""
+    try:
+        sample_rate, channels, bits = read_wav_format(io.BytesIO(header))
+    except (ValueError, EOFError):
+        return False
+    return sample_rate == SAMPLE_RATE and channels == 1 and bits == 16
+
+
+class PcmDecoder:
+    """ffmpeg process decoding a file, or bytes written to it, into in-memory PCM.
+
+    Only the first audio stream is selected, so video, subtitle and data
+    streams are never demuxed into the decoder. The output is read from a pipe
+    straight into one buffer; nothing is written to disk.
+    """
+
+    def __init__(self, source="pipe:0"):
+        self._pcm = bytearray()
+        self._stderr_tail = deque(maxlen=50)
+        reads_stdin = source == "pipe:0"
+        self.process = (
+            ffmpeg
+            .input(source)
+            .output("pipe:1", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE,
+                    map="0:a:0", vn=None, sn=None, dn=None)
+            .global_args(*([] if reads_stdin else ["-nostdin"]))
+            .run_async(pipe_stdin=reads_stdin, pipe_stdout=True, pipe_stderr=True)
+        )
+        # Both pipes are drained continuously, otherwise ffmpeg blocks once a pipe buffer fills up
+        self._readers = [
+            threading.Thread(target=self._read_stdout, daemon=True),
+            threading.Thread(target=self._read_stderr, daemon=True),
+        ]
+        for reader in self._readers:
+            reader.start()
+
+    def _read_stdout(self):
+        for chunk in iter(lambda: self.process.stdout.read(1024 * 1024), b""):
+            self._pcm += chunk
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self._stderr_tail.append(line)
+
+    def write(self, chunk):
+        """Feeds input bytes. Raises BrokenPipeError/OSError if ffmpeg stopped reading."""
+        self.process.stdin.write(chunk)
+
+    def close_input(self):
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.stdin = None
+
+    def finish(self):
+        """Waits for ffmpeg and returns the decoded AudioBuffer. Raises RuntimeError if decoding failed."""
+        self.close_input()
+        self.process.wait()
+        for reader in self._readers:
+            reader.join(timeout=30)
+        if self.process.returncode != 0 or not self._pcm:
+            raise RuntimeError(
+                f"ffmpeg decoding failed (code {self.process.returncode}): "
+                f"{b''.join(self._stderr_tail).decode(errors='replace')}"
+            )
+        return AudioBuffer.from_pcm(self._pcm, SAMPLE_RATE)
+
+    def abort(self):
+        self.close_input()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+def decode_media(path, firestore_ref=None):
+    """Returns the audio of a media file on disk as an AudioBuffer, decoding it at most once.
+
+    Files that already are 16 kHz mono PCM WAV are memory-mapped without
+    running ffmpeg; everything else is decoded through a pipe into memory.
+    """
+    info = probe_media(path)
+    if info is not None and not info["has_audio"]:
+        raise InvalidMedia(f"{path} has no audio stream")
+    if is_target_pcm(info):
+        logger.info(f"[{firestore_ref}] Input is already 16 kHz mono PCM, skipping conversion")
+        try:
+            return AudioBuffer.from_wav(path)
+        except (ValueError, EOFError) as e:
+            raise InvalidMedia(str(e)) from e
+
+    if info is not None:
+        logger.info(f"[{firestore_ref}] Decoding {info['codec']} audio ({info['sample_rate']} Hz, "
+                    f"{info['channels']} channels{', audio stream only' if info['has_video'] else ''})")
+    return PcmDecoder(path).finish()
@@ -1,196 +1,406 @@
 import os
-import requests
 import time
-import ffmpeg
 import subprocess
 import shlex
-import glob
+from collections import deque
 from datetime import timedelta, datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from firebase_admin import storage
+import requests
 from urllib.parse import unquote
-from pydub import AudioSegment
 
-from .diarization import diarize_audio
-from .transcription import transcribe_audio
-from ..services.firebase_service import update_firestore
+from .audio_buffer import iter_merged_segments, merge_speaker_turns
+from .checkpoint import JobCheckpoint, open_checkpoint
+from .diarization import (
+    STREAM_WINDOW_SECONDS, default_model_name, diarize_audio, diarize_parallel, diarize_streaming, parallel_workers,
+    pin_cpu_threads,
+)
+from .downloader import download_media, remote_fingerprint
+from .media_decoder import InvalidMedia, decode_media
+from .scratch import JobScratch, ScratchQuotaExceeded
+from .segment_planner import assign_words, plan_requests, request_audio
+from .stages import stage_slot
+from .transcription import get_engine
+from ..services.firebase_service import (
+    flush_firestore, init_firebase, transcript_fields, update_firestore, update_firestore_async,
+)
+from ..services.job_events import JobEvents
+from ..services.result_cache import get_result_cache
 from ..utils.logger import logger
+from ..utils.metrics import (
+    JobTimings, downloaded_bytes, job_peak_rss_bytes, jobs_total, peak_rss_bytes, realtime_factor,
+)
 from ..utils.notification import send_notification
 
-def process_media(media_url, firestore_ref, language, notification=False):
+# Overlap diarization and transcription on files longer than one diarization window
+PIPELINED_MODE = os.getenv("PIPELINED_PROCESSING", "false").lower() in ("1", "true", "yes")
+
+def _transcript_line(speaker, texts):
+    """Formats one transcript line from the {piece index: text} of a segment."""
+    return f"{speaker}: {' '.join(texts[index] for index in sorted(texts))}"
+
+def complete_job(firestore_ref, transcript, metadata, notification, events=None):
+    """Writes the final transcript to Firestore and sends the notification if requested."""
+    logger.info(f"[{firestore_ref}] Updating status to DONE")
+    # Pending write-behind status updates are superseded by the final status and must not land after it
+    flush_firestore(discard=firestore_ref)
+    update_firestore(firestore_ref, {
+        "status": "DONE",
+        **transcript_fields(firestore_ref, transcript),
+        "metadata": metadata,
+        "finished_at": datetime.now(timezone.utc) # Add finish time
+    })
+    if events:
+        events.status("DONE", metadata=metadata)
+
+    # Send notification if requested
+    if notification:
+        # Only queued here; a webhook dispatcher delivers it, so the job never waits on the endpoint
+        if not send_notification(firestore_ref):
+            logger.warning(f"[{firestore_ref}] Failed to queue notification")
+
+def _complete_from_cache(cache, cache_keys, firestore_ref, notification, start_time, events=None,
+                         count_miss=True):
+    """Completes the job from a cached result for the last key in `cache_keys`.
+
+    On a hit the result is also stored under the earlier keys, so the next
+    duplicate is recognised before downloading. Cache failures only log.
+    A miss is counted in the cache stats only with `count_miss`.
+    """
+    try:
+        cached = cache.get(cache_keys[-1], count_miss=count_miss)
+        if cached is None:
+            return False
+        if len(cache_keys) > 1:
+            cache.put(cache_keys[:-1], cached)
+    except Exception as e:
+        logger.warning(f"[{firestore_ref}] Result cache unavailable: {e}")
+        return False
+
+    logger.info(f"[{firestore_ref}] Result cache hit, skipping processing")
+    metadata = dict(cached["metadata"])
+    metadata["processing_time"] = round(time.time() - start_time, 2)
+    metadata["cache_hit"] = True
+    if events:
+        events.transcript(cached["transcript"].splitlines())
+        events.progress(100)
+    complete_job(firestore_ref, cached["transcript"], metadata, notification, events)
+    return True
+
+def _checkpointed_turns(turns, checkpoint):
+    """Passes streamed diarization turns through and stores them once the stream is complete."""
+    recorded = []
+    for turn in turns:
+        recorded.append(turn)
+        yield turn
+    checkpoint.save_diarization(recorded)
+
+def _gated_turns(turns, timings):
+    """Holds a diarization slot from the first streamed turn until the stream is exhausted."""
+    with stage_slot("diarization", timings) as slot:
+        if slot:
+            pin_cpu_threads(*slot)
+        yield from turns
+
+def _retryable(error):
+    """Whether another attempt could succeed; bad input (missing media, no audio, over quota) never does."""
+    if isinstance(error, (ScratchQuotaExceeded, InvalidMedia)):
+        return False
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        return response.status_code >= 500 or response.status_code in (408, 429)
+    return True
+
+def _record_transcripts(checkpoint, request, future):
+    # Runs on the engine thread as soon as a request finishes, in any order
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        checkpoint.record_transcripts(assign_words(future.result(), request))
+    except Exception as e:
+        logger.warning(f"Failed to checkpoint transcript: {e}")
+
+def process_media(media_url, firestore_ref, language, notification=False, queue_wait=None, retries_left=0,
+                  job=None):
+    """Runs one job. Every stage result is checkpointed, so a retry resumes where the last attempt stopped.
+
+    Returns the job metadata when the media was processed (not answered from
+    the cache). Errors are recorded in Firestore and swallowed, except when
+    `retries_left` is positive: then the error is re-raised for the queue to
+    retry the job.
+    Status, progress and finished transcript lines are published to the job's
+    event stream of the RQ `job` as they happen, and kept in the job's meta.
+    """
     start_time = time.time()
-    original_file_name = None
-    wav_file_name = None
+    scratch = None
+    checkpoint = None
+    retrying = False
+    resumed = []
+    events = JobEvents.for_job(job)
+    timings = JobTimings()
+    if queue_wait is not None:
+        timings.stages["queue_wait"] = round(queue_wait, 3)
+
+    cache = get_result_cache()
+    cache_keys = []
+    model_version = default_model_name()
+
+    # The API writes QUEUED behind the request; it must land before this job's first status
+    events.wait_queued_written()
 
     try:
-        logger.info(f"[{firestore_ref}] Updating status to DOWNLOADING")
-        update_firestore(firestore_ref, {"status": "DOWNLOADING"})
-
-        if media_url.startswith('gs://'):
-            bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET')
-            bucket = storage.bucket(bucket_name)
-            blob_path = media_url.replace(f'gs://{bucket_name}/', '')
-            blob = bucket.blob(blob_path)
-            download_url = blob.generate_signed_url(version="v4", expiration=timedelta(minutes=15))
+        checkpoint = open_checkpoint(firestore_ref, job.id if job is not None else None, model_version)
+        audio, manifest = checkpoint.load_audio() if checkpoint else (None, None)
+        if audio is not None:
+            logger.info(f"[{firestore_ref}] Resuming from checkpoint, skipping download and decoding")
+            resumed.append("audio")
+            download_stats = manifest["download"]
+            cache_keys = manifest["cache_keys"]
         else:
-            download_url = media_url
-
-        logger.info(f"[{firestore_ref}] Downloading from {download_url}")
-        response = requests.get(download_url)
-        response.raise_for_status()
-
-        decoded_path = unquote(download_url.split('?')[0])
-        original_file_name = os.path.basename(decoded_path)
-        with open(original_file_name, "wb") as f:
-            f.write(response.content)
-        logger.info(f"[{firestore_ref}] Downloaded to {original_file_name}")
-
-        wav_file_name = f"{os.path.splitext(original_file_name)[0]}.wav"
-        logger.info(f"[{firestore_ref}] Converting {original_file_name} to {wav_file_name} using ffmpeg-python library")
-        
-        try:
-            # Final attempt: combine two fixes:
-            # 1. Add -nostdin as a global parameter.
-            # 2. Use the correct .overwrite_output() method.
-            (
-                ffmpeg
-                .input(original_file_name)
-                .output(wav_file_name, ac=1, ar=16000)
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True, cmd=['ffmpeg', '-nostdin'])
-            )
-            logger.info(f"[{firestore_ref}] Conversion successful")
-        except ffmpeg.Error as e:
-            logger.error(f"[{firestore_ref}] FFMPEG Error: {e.stderr.decode()}", exc_info=True)
-            raise
+            logger.info(f"[{firestore_ref}] Updating status to DOWNLOADING")
+            update_firestore_async(firestore_ref, {"status": "DOWNLOADING"})
+            events.status("DOWNLOADING")
 
-        logger.info(f"[{firestore_ref}] Updating status to PROCESSING")
-        update_firestore(firestore_ref, {"status": "PROCESSING"})
+            if media_url.startswith('gs://'):
+                bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET')
+                init_firebase()
+                bucket = storage.bucket(bucket_name)
+                blob_path = media_url.replace(f'gs://{bucket_name}/', '')
+                # get_blob loads the object metadata, whose MD5 identifies the content for the cache
+                blob = bucket.get_blob(blob_path) or bucket.blob(blob_path)
+                # Called again by the download if it outlives the URL's expiration
+                sign_url = partial(blob.generate_signed_url, version="v4", expiration=timedelta(minutes=15))
+                download_url = sign_url()
+                source_id = f"md5:{blob.md5_hash}" if blob.md5_hash else None
+            else:
+                download_url = media_url
+                sign_url = None
+                source_id = remote_fingerprint(media_url) if cache else None
+
+            # Duplicate submissions are answered from the result cache before downloading
+            if cache and source_id:
+                cache_keys.append(cache.make_key(source_id, language, model_version))
+                # A miss here is only counted once the content hash has missed too
+                if _complete_from_cache(cache, cache_keys, firestore_ref, notification, start_time, events,
+                                        count_miss=False):
+                    jobs_total.labels(status="CACHED").inc()
+                    return
 
-        logger.info(f"[{firestore_ref}] Starting diarization on {wav_file_name}")
-        diarization = diarize_audio(wav_file_name)
-        logger.info(f"[{firestore_ref}] Finished diarization")
+            # Every job downloads into its own scratch directory, so concurrent jobs never share files
+            scratch = JobScratch(firestore_ref)
+            original_file_name = scratch.path(unquote(download_url.split('?')[0]))
+
+            # Stream the download to disk and into an in-memory ffmpeg decoder at the
+            # same time, so decoding overlaps the download and nothing else is written
+            logger.info(f"[{firestore_ref}] Downloading from {download_url}")
+            events.stage("download")
+            # With staged execution this waits while the host's intake slots are busy
+            with stage_slot("intake", timings), timings.stage("download"):
+                download_stats = download_media(download_url, original_file_name, decode=True,
+                                                firestore_ref=firestore_ref, scratch=scratch,
+                                                refresh_url=sign_url)
+            downloaded_bytes.inc(download_stats["bytes"])
+
+            if cache:
+                cache_keys.append(cache.make_key(f"sha256:{download_stats['sha256']}", language, model_version))
+                if _complete_from_cache(cache, cache_keys, firestore_ref, notification, start_time, events):
+                    jobs_total.labels(status="CACHED").inc()
+                    return
+
+            # The whole job works on this one 16 kHz mono buffer; segments are offset lists into it
+            audio = download_stats["audio"]
+            if audio is not None:
+                logger.info(f"[{firestore_ref}] Decoding successful (streamed)")
+            else:
+                logger.info(f"[{firestore_ref}] Probing and decoding {original_file_name}")
+                events.stage("decode")
+                with stage_slot("intake", timings), timings.stage("decode"):
+                    audio = decode_media(original_file_name, firestore_ref)
+
+            # Only a retry resumes from the audio, so the last attempt skips writing it
+            if checkpoint and retries_left > 0:
+                # The checkpoint copy replaces the in-memory buffer, so its memory is paged from disk from now on
+                with timings.stage("checkpoint"):
+                    audio = checkpoint.save_audio(audio, {
+                        "download": {"bytes": download_stats["bytes"], "sha256": download_stats["sha256"]},
+                        "cache_keys": cache_keys,
+                    })
+
+        logger.info(f"[{firestore_ref}] Updating status to PROCESSING")
+        update_firestore_async(firestore_ref, {"status": "PROCESSING"})
+        events.status("PROCESSING")
 
-        logger.info(f"[{firestore_ref}] Starting parallel transcription of {len(diarization)} segments")
         full_transcript_map = {}
         speakers = set()
-        
-        # Load audio for segment slicing after conversion
-        logger.info(f"[{firestore_ref}] Loading converted WAV file for segmentation.")
-        audio_segment = AudioSegment.from_wav(wav_file_name)
-
-        # First, merge consecutive segments from the same speaker
-        merged_segments = []
-        current_speaker = None
-        current_start = None
-        current_end = None
-        temp_audio = None
-
-        for turn, _, speaker in diarization.itertracks(yield_label=True):
-            speakers.add(speaker)
-            if current_speaker != speaker:
-                # Save previous segment if exists
-                if current_speaker is not None and temp_audio is not None:
-                    segment_file_path = f"temp_segment_{current_speaker}_{int(current_start * 1000)}.wav"
-                    temp_audio.export(segment_file_path, format="wav")
-                    merged_segments.append((current_speaker, current_start, current_end, segment_file_path))
-                # Start new segment
-                current_speaker = speaker
-                current_start = turn.start
-                current_end = turn.end
-                temp_audio = audio_segment[int(turn.start * 1000):int(turn.end * 1000)]
-            else:
-                # Extend current segment
-                current_end = turn.end
-                temp_audio = temp_audio + audio_segment[int(turn.start * 1000):int(turn.end * 1000)]
-
-        # Don't forget the last segment
-        if current_speaker is not None and temp_audio is not None:
-            segment_file_path = f"temp_segment_{current_speaker}_{int(current_start * 1000)}.wav"
-            temp_audio.export(segment_file_path, format="wav")
-            merged_segments.append((current_speaker, current_start, current_end, segment_file_path))
-
-        # Use ThreadPoolExecutor for parallel requests with merged segments
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_segment = {}
-            for speaker, start, end, segment_file_path in merged_segments:
-                # Submit task to thread pool
-                future = executor.submit(transcribe_audio, segment_file_path, language)
-                future_to_segment[future] = (speaker, int(start * 1000), segment_file_path)
-            
-            for future in as_completed(future_to_segment):
-                speaker, start_ms, segment_path = future_to_segment[future]
-                try:
-                    response = future.result()
-                    if response.results:
-                        transcript_text = response.results[0].alternatives[0].transcript
+        failed_segments = 0
+
+        events.stage("diarization")
+        diarization = checkpoint.load_diarization() if checkpoint else None
+        if diarization is not None:
+            logger.info(f"[{firestore_ref}] Resuming from checkpoint, skipping diarization")
+            resumed.append("diarization")
+            merged_segments = merge_speaker_turns(diarization)
+            transcription_stage = "transcription"
+        elif PIPELINED_MODE and audio.duration > STREAM_WINDOW_SECONDS:
+            # Diarize over rolling windows and send each finalized turn to
+            # transcription while later audio is still being diarized
+            logger.info(f"[{firestore_ref}] Starting pipelined diarization and transcription")
+            turns = _gated_turns(diarize_streaming(audio), timings)
+            if checkpoint:
+                turns = _checkpointed_turns(turns, checkpoint)
+            merged_segments = iter_merged_segments(turns)
+            transcription_stage = "diarization_transcription"
+        else:
+            workers = parallel_workers(audio.duration)
+            logger.info(f"[{firestore_ref}] Starting diarization of {audio.duration:.1f}s of audio"
+                        + (f" in {workers} processes" if workers else ""))
+            # With staged execution the slot is released before transcription, so the
+            # next job diarizes while this one waits for Speech responses
+            with stage_slot("diarization", timings) as slot:
+                if slot:
+                    pin_cpu_threads(*slot)
+                with timings.stage("diarization"):
+                    if workers:
+                        # Long files: overlapping windows diarized on several cores and stitched
+                        diarization = diarize_parallel(audio, workers)
+                    else:
+                        diarization = diarize_audio(audio)
+            logger.info(f"[{firestore_ref}] Finished diarization")
+            if checkpoint:
+                checkpoint.save_diarization(
+                    (turn.start, turn.end, speaker) for turn, _, speaker in diarization.itertracks(yield_label=True)
+                )
+                # Plan from the stored copy, so a retry plans exactly the same requests
+                diarization = checkpoint.load_diarization()
+            logger.info(f"[{firestore_ref}] Starting parallel transcription of {len(diarization)} segments")
+            # First, merge consecutive segments from the same speaker
+            merged_segments = merge_speaker_turns(diarization)
+            transcription_stage = "transcription"
+
+        # Send requests through the shared transcription engine; the planner packs short
+        # turns together and splits long ones so every request stays synchronous
+        transcription_started = time.perf_counter()
+        events.stage("transcription")
+        engine = get_engine()
+        transcribed = checkpoint.load_transcripts() if checkpoint else {}
+        submitted = []
+        skipped = 0
+        for request in plan_requests(audio, merged_segments):
+            speakers.update(piece.segment.speaker for piece in request.pieces)
+            if all(JobCheckpoint.piece_key(piece) in transcribed for piece in request.pieces):
+                # Transcribed by a previous attempt
+                submitted.append((None, request))
+                skipped += 1
+                continue
+            # PCM bytes are only built once the request gets a concurrency slot
+            future = engine.submit(
+                partial(request_audio, audio, request), language, audio.sample_rate,
+                word_time_offsets=len(request.pieces) > 1,
+            )
+            if checkpoint:
+                future.add_done_callback(partial(_record_transcripts, checkpoint, request))
+            submitted.append((future, request))
+        logger.info(f"[{firestore_ref}] Submitted {len(submitted) - skipped} Speech requests for transcription"
+                    + (f", {skipped} restored from checkpoint" if skipped else ""))
+        if skipped:
+            resumed.append("transcripts")
+
+        # Results are gathered in the same order as the segments. A segment is
+        # streamed once every request holding one of its pieces has been gathered
+        unstreamed = deque()
+        for position, (future, request) in enumerate(submitted):
+            try:
+                if future is None:
+                    results = [(piece, transcribed[JobCheckpoint.piece_key(piece)]) for piece in request.pieces]
+                else:
+                    results = assign_words(future.result(), request)
+                for piece, text in results:
+                    if text:
                         # Save result with timestamp for further sorting
-                        full_transcript_map[start_ms] = f"{speaker}: {transcript_text}"
-                except Exception as exc:
-                    logger.error(f"Segment at {start_ms} generated an exception: {exc}")
-                finally:
-                    # Remove temporary segment file
-                    os.remove(segment_path)
-
-        # Sort transcripts by start time and combine
-        sorted_transcripts = [full_transcript_map[key] for key in sorted(full_transcript_map.keys())]
+                        start_ms = int(piece.segment.start * 1000)
+                        if start_ms not in full_transcript_map:
+                            unstreamed.append(start_ms)
+                        full_transcript_map.setdefault(start_ms, (piece.segment.speaker, {}))[1][piece.index] = text
+            except Exception as exc:
+                failed_segments += 1
+                logger.error(f"Request at {int(request.pieces[0].segment.start * 1000)} generated an exception: {exc}")
+
+            following = (int(submitted[position + 1][1].pieces[0].segment.start * 1000)
+                         if position + 1 < len(submitted) else None)
+            lines = []
+            while unstreamed and (following is None or unstreamed[0] < following):
+                lines.append(_transcript_line(*full_transcript_map[unstreamed.popleft()]))
+            events.transcript(lines)
+            progress = round(100 * (position + 1) / len(submitted), 1)
+            events.progress(progress)
+            # Coalesced by the write-behind writer, so this costs at most one write per flush interval
+            update_firestore_async(firestore_ref, {"progress": progress})
+
+        # Sort transcripts by start time and combine the pieces of each segment
+        sorted_transcripts = []
+        for key in sorted(full_transcript_map.keys()):
+            sorted_transcripts.append(_transcript_line(*full_transcript_map[key]))
         final_transcript_text = "\n".join(sorted_transcripts)
+        timings.record(transcription_stage, time.perf_counter() - transcription_started)
         logger.info(f"[{firestore_ref}] Finished transcription")
 
         processing_time = time.time() - start_time
+        realtime_factor.observe(audio.duration / max(processing_time, 1e-3))
+        peak_rss = peak_rss_bytes()
+        job_peak_rss_bytes.observe(peak_rss)
         metadata = {
-            "duration": len(audio_segment) / 1000,
+            "duration": round(audio.duration, 3),
             "speakers_count": len(speakers),
             "processing_time": round(processing_time, 2),
-            "language": language
+            "language": language,
+            "timings": timings.stages,
+            "downloaded_bytes": download_stats["bytes"],
+            "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
         }
+        if resumed:
+            metadata["resumed"] = resumed
 
-        logger.info(f"[{firestore_ref}] Updating status to DONE")
-        update_firestore(firestore_ref, {
-            "status": "DONE",
-            "transcript": final_transcript_text,
-            "metadata": metadata,
-            "finished_at": datetime.now(timezone.utc) # Add finish time
-        })
+        complete_job(firestore_ref, final_transcript_text, metadata, notification, events)
+        jobs_total.labels(status="DONE").inc()
 
-        # Send notification if requested
-        if notification:
-            logger.info(f"[{firestore_ref}] Sending notification webhook")
-            notification_sent = send_notification(firestore_ref)
-            if notification_sent:
-                logger.info(f"[{firestore_ref}] Notification sent successfully")
-            else:
-                logger.warning(f"[{firestore_ref}] Failed to send notification")
+        # Partial transcripts are not cached, so a resubmission gets a full retry
+        if cache and failed_segments == 0:
+            try:
+                cache.put(cache_keys, {"transcript": final_transcript_text, "metadata": metadata})
+            except Exception as e:
+                logger.warning(f"[{firestore_ref}] Failed to store result in cache: {e}")
+        return metadata
 
     except Exception as e:
+        if retries_left > 0 and _retryable(e):
+            # Keep the checkpoint; the queue runs the job again and it resumes from there
+            retrying = True
+            logger.warning(f"[{firestore_ref}] Attempt failed ({e}), {retries_left} retries left", exc_info=True)
+            jobs_total.labels(status="RETRY").inc()
+            flush_firestore(discard=firestore_ref)
+            update_firestore(firestore_ref, {"status": "RETRYING", "error_message": str(e)})
+            # The next attempt streams the transcript again from the first line
+            events.status("RETRYING", error_message=str(e))
+            raise
+
         logger.error(f"[{firestore_ref}] Error during processing: {e}", exc_info=True)
+        jobs_total.labels(status="ERROR").inc()
+        flush_firestore(discard=firestore_ref)
         update_firestore(firestore_ref, {
             "status": "ERROR", 
             "error_message": str(e),
             "finished_at": datetime.now(timezone.utc) # Add finish time even on error
         })
+        events.status("ERROR", error_message=str(e))
 
         # Send notification even on error if requested
         if notification:
-            logger.info(f"[{firestore_ref}] Sending error notification webhook")
-            notification_sent = send_notification(firestore_ref)
-            if notification_sent:
-                logger.info(f"[{firestore_ref}] Error notification sent successfully")
-            else:
-                logger.warning(f"[{firestore_ref}] Failed to send error notification")
+            if not send_notification(firestore_ref):
+                logger.warning(f"[{firestore_ref}] Failed to queue error notification")
 
     finally:
-        logger.info(f"[{firestore_ref}] Cleaning up temporary files")
-        # Remove main files
-        if original_file_name and os.path.exists(original_file_name):
-            os.remove(original_file_name)
-        if wav_file_name and os.path.exists(wav_file_name):
-            os.remove(wav_file_name)
-        
-        # Find and remove all temporary segments
-        for temp_file in glob.glob("temp_segment_*.wav"):
-            try:
-                os.remove(temp_file)
-                logger.info(f"[{firestore_ref}] Removed temporary segment file: {temp_file}")
-            except OSError as e:
-                logger.error(f"[{firestore_ref}] Error removing temporary file {temp_file}: {e}")
+        if scratch:
+            logger.info(f"[{firestore_ref}] Cleaning up scratch directory {scratch.dir}")
+            scratch.cleanup()
+        if checkpoint and not retrying:
+            checkpoint.clear()
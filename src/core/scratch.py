@@ -0,0 +1,89 @@
+import os
+import re
+import shutil
+import tempfile
+
+from ..utils.logger import logger
+
+# Per-job scratch directories live under this root. JOB_SCRATCH_TMPFS puts them
+# in /dev/shm (RAM-backed, counts against the host's memory) unless a root is given.
+SCRATCH_TMPFS = os.getenv("JOB_SCRATCH_TMPFS", "false").lower() in ("1", "true", "yes")
+SCRATCH_ROOT = os.getenv("JOB_SCRATCH_DIR") or os.path.join(
+    "/dev/shm" if SCRATCH_TMPFS and os.path.isdir("/dev/shm") else tempfile.gettempdir(), "video-transcript-jobs"
+)
+# Most bytes one job may write into its scratch directory
+SCRATCH_QUOTA_BYTES = int(float(os.getenv("JOB_SCRATCH_QUOTA_MB", "4096")) * 1024 * 1024)
+
+_DIR_PATTERN = re.compile(r"^job-(\d+)-")
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def prune_orphans(root=SCRATCH_ROOT):
+    """Removes scratch directories of processes that no longer exist (e.g. a killed work horse)."""
+    if not os.path.isdir(root):
+        return
+    for entry in os.scandir(root):
+        match = _DIR_PATTERN.match(entry.name)
+        if match and entry.is_dir() and not _pid_alive(int(match.group(1))):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            logger.info(f"Removed orphaned scratch directory {entry.path}")
+
+
+class JobScratch:
+    """Private scratch directory of one job, with a byte quota and guaranteed removal.
+
+    The directory name carries the owning process id, so directories left
+    behind by a process that was killed are removed by the next job on the host.
+    Use as a context manager or call `cleanup()` in a finally block.
+    """
+
+    def __init__(self, firestore_ref=None, root=SCRATCH_ROOT, quota_bytes=SCRATCH_QUOTA_BYTES):
+        os.makedirs(root, exist_ok=True)
+        prune_orphans(root)
+        self.firestore_ref = firestore_ref
+        self.quota_bytes = quota_bytes
+        self.used_bytes = 0
+        self.dir = tempfile.mkdtemp(prefix=f"job-{os.getpid()}-", dir=root)
+        free = shutil.disk_usage(self.dir).free
+        if free < quota_bytes:
+            logger.warning(f"[{firestore_ref}] Only {free // (1024 * 1024)} MiB free in {root}, "
+                           f"less than the job quota of {quota_bytes // (1024 * 1024)} MiB")
+
+    def path(self, name):
+        """Returns a path inside the scratch directory; `name` is reduced to a safe file name."""
+        safe = re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(name)).lstrip(".") or "file"
+        return os.path.join(self.dir, safe[-100:])
+
+    def reserve(self, size):
+        """Accounts for `size` more bytes; raises ScratchQuotaExceeded past the quota."""
+        self.used_bytes += size
+        if self.quota_bytes and self.used_bytes > self.quota_bytes:
+            raise ScratchQuotaExceeded(
+                f"Job exceeded its scratch quota of {self.quota_bytes // (1024 * 1024)} MiB"
+            )
+
+    def release(self, size):
+        """Returns `size` bytes to the quota, e.g. after truncating a file."""
+        self.used_bytes = max(0, self.used_bytes - size)
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
@@ -0,0 +1,127 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# Synchronous recognize() accepts up to 60 s of audio; keep a margin for padding and rounding
+SYNC_MAX_SECONDS = float(os.getenv("SPEECH_SYNC_MAX_SECONDS", "55"))
+PACK_SEGMENTS = os.getenv("SPEECH_PACK_SEGMENTS", "true").lower() in ("1", "true", "yes")
+PACK_PADDING_SECONDS = float(os.getenv("SPEECH_PACK_PADDING_SECONDS", "0.6"))
+# How far back from the length limit to look for a quiet point when splitting a long turn
+SPLIT_SEARCH_SECONDS = float(os.getenv("SPEECH_SPLIT_SEARCH_SECONDS", "8"))
+ENERGY_FRAME_SECONDS = 0.02
+
+# A part of a merged Segment that fits into one sync request.
+# `index` orders the pieces of the same segment, `ranges` are offsets into the AudioBuffer.
+Piece = namedtuple("Piece", ["segment", "index", "ranges", "duration"])
+
+# One Speech request: its pieces and where each of them starts inside the request audio
+PlannedRequest = namedtuple("PlannedRequest", ["pieces", "offsets", "duration"])
+
+
+def _slice_ranges(ranges, start, end):
+    """Returns the real (start, end) ranges covering [start, end) of the ranges laid end to end."""
+    result = []
+    position = 0.0
+    for range_start, range_end in ranges:
+        length = range_end - range_start
+        lo, hi = max(start, position), min(end, position + length)
+        if hi > lo:
+            result.append((range_start + lo - position, range_start + hi - position))
+        position += length
+        if position >= end:
+            break
+    return result
+
+
+def _quietest_point(audio, ranges, search_start, search_end):
+    """Returns the offset (within the concatenated ranges) of the lowest-energy frame in a window."""
+    samples = np.frombuffer(audio.pcm_bytes(_slice_ranges(ranges, search_start, search_end)), dtype="<i2")
+    frame = max(1, int(ENERGY_FRAME_SECONDS * audio.sample_rate))
+    frames = len(samples) // frame
+    if frames == 0:
+        return search_end
+    energy = np.square(samples[:frames * frame].astype(np.float32)).reshape(frames, frame).mean(axis=1)
+    quietest = int(np.argmin(energy))
+    return search_start + (quietest + 0.5) * frame / audio.sample_rate
+
+
+def split_segment(audio, segment, max_seconds=SYNC_MAX_SECONDS):
+    """Splits a merged Segment into Pieces no longer than `max_seconds`, cutting at quiet points."""
+    total = audio.ranges_duration(segment.ranges)
+    pieces = []
+    position = 0.0
+    while total - position > max_seconds:
+        search_start = position + max(max_seconds - SPLIT_SEARCH_SECONDS, max_seconds / 2)
+        cut = _quietest_point(audio, segment.ranges, search_start, position + max_seconds)
+        pieces.append(Piece(segment, len(pieces), _slice_ranges(segment.ranges, position, cut), cut - position))
+        position = cut
+    pieces.append(Piece(segment, len(pieces), _slice_ranges(segment.ranges, position, total), total - position))
+    return pieces
+
+
+def plan_requests(audio, segments, max_seconds=SYNC_MAX_SECONDS, padding=PACK_PADDING_SECONDS, pack=PACK_SEGMENTS):
+    """Turns merged Segments into sync-sized Speech requests.
+
+    Long turns are split at low-energy points, and consecutive short turns are
+    packed into one request separated by `padding` seconds of silence. Works on
+    a stream of segments and yields each request as soon as it is full.
+    Pieces without audio (zero-length turns, or a split that ends exactly at
+    the end of its turn) are skipped.
+    """
+    pieces, offsets, duration = [], [], 0.0
+    for segment in segments:
+        for piece in split_segment(audio, segment, max_seconds):
+            if not piece.ranges or piece.duration <= 0:
+                continue
+            needed = piece.duration + (padding if pieces else 0.0)
+            if pieces and (not pack or duration + needed > max_seconds):
+                yield PlannedRequest(pieces, offsets, duration)
+                pieces, offsets, duration = [], [], 0.0
+                needed = piece.duration
+            offsets.append(duration + needed - piece.duration)
+            pieces.append(piece)
+            duration += needed
+    if pieces:
+        yield PlannedRequest(pieces, offsets, duration)
+
+
+def request_audio(audio, request, padding=PACK_PADDING_SECONDS):
+    """Builds the LINEAR16 payload of a planned request, with silence between pieces."""
+    if len(request.pieces) == 1:
+        return audio.pcm_bytes(request.pieces[0].ranges)
+    silence = bytes(2 * int(round(padding * audio.sample_rate)))
+    return silence.join(audio.pcm_bytes(piece.ranges) for piece in request.pieces)
+
+
+def _seconds(value):
+    if hasattr(value, "total_seconds"):
+        return value.total_seconds()
+    return value.seconds + value.nanos * 1e-9
+
+
+def assign_words(response, request):
+    """Splits a Speech response back into text per piece.
+
+    Single-piece requests use the transcripts as they are; packed requests are
+    split by word time offsets, each word going to the piece it falls in (or the
+    nearest one, for words recognised inside the padding).
+    """
+    if len(request.pieces) == 1:
+        text = " ".join(result.alternatives[0].transcript.strip()
+                        for result in response.results if result.alternatives)
+        return [(request.pieces[0], text)]
+
+    words = [[] for _ in request.pieces]
+    for result in response.results:
+        if not result.alternatives:
+            continue
+        for word in result.alternatives[0].words:
+            middle = (_seconds(word.start_time) + _seconds(word.end_time)) / 2
+            distances = [
+                0.0 if offset <= middle <= offset + piece.duration
+                else min(abs(middle - offset), abs(middle - offset - piece.duration))
+                for piece, offset in zip(request.pieces, request.offsets)
+            ]
+            words[distances.index(min(distances))].append(word.word)
+    return [(piece, " ".join(piece_words)) for piece, piece_words in zip(request.pieces, words)]
@@ -0,0 +1,113 @@
+import fcntl
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from ..utils.logger import logger
+
+# Jobs each worker slot keeps in flight. Above 1 the supervisor runs that many
+# RQ workers per slot and the stages of their jobs are gated host-wide, so one
+# job downloads while another diarizes and a third waits on Speech
+WORKER_JOBS_PER_SLOT = max(1, int(os.getenv("WORKER_JOBS_PER_SLOT", "1")))
+# Jobs downloading and decoding at once on the host (empty = one per worker slot)
+STAGE_INTAKE_SLOTS = os.getenv("STAGE_INTAKE_SLOTS")
+# Longest a job waits for a stage slot; after that it runs the stage without one,
+# so waiting never eats more than this of the job timeout (which includes it)
+STAGE_WAIT_MAX_SECONDS = float(os.getenv("STAGE_WAIT_MAX_SECONDS", "900"))
+# Gated stages a job passes through, each adding at most STAGE_WAIT_MAX_SECONDS of waiting
+GATED_STAGES = ("intake", "diarization")
+# Where the slot lock files live; must be local to the host
+STAGE_LOCK_DIR = os.getenv("STAGE_LOCK_DIR") or os.path.join(tempfile.gettempdir(), "video-transcript-stages")
+
+# Stages that are gated, by name; empty unless configure_stages() was called
+_gates = {}
+
+
+class StageGate:
+    """Host-wide limit on the jobs in one stage, shared by every worker process.
+
+    Each slot is a lock file held with flock, so the slot of a process that
+    dies (e.g. a work horse killed on timeout) is released by the kernel.
+    Waiters poll for a free slot; they are not served in arrival order.
+    """
+
+    def __init__(self, name, slots, directory=STAGE_LOCK_DIR):
+        self.name = name
+        self.slots = max(1, slots)
+        self.directory = directory
+
+    def _path(self, index):
+        return os.path.join(self.directory, f"{self.name}-{index}.lock")
+
+    def _try_acquire(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for index in range(self.slots):
+            fd = os.open(self._path(index), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return index, fd
+            except BlockingIOError:
+                os.close(fd)
+        return None, None
+
+    @contextmanager
+    def slot(self, timeout=STAGE_WAIT_MAX_SECONDS):
+        """Waits for a free slot and holds it; yields the slot's index, or None after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            index, fd = self._try_acquire()
+            if fd is not None or time.monotonic() >= deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+        try:
+            yield index
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+def configure_stages(slots, jobs_per_slot=WORKER_JOBS_PER_SLOT):
+    """Gates the CPU-heavy stages for `slots` worker slots; call before forking the workers.
+
+    Does nothing when every slot runs a single job, since then no two jobs of a
+    slot can compete for a stage.
+    """
+    _gates.clear()
+    if jobs_per_slot <= 1:
+        return
+    intake = int(STAGE_INTAKE_SLOTS) if STAGE_INTAKE_SLOTS else slots
+    _gates["intake"] = StageGate("intake", intake)
+    _gates["diarization"] = StageGate("diarization", slots)
+    logger.info(f"Staged execution: {slots * jobs_per_slot} jobs in flight, "
+                f"{intake} downloading and {slots} diarizing at once")
+
+
+def stage_wait_budget(jobs_per_slot=WORKER_JOBS_PER_SLOT):
+    """Seconds of a job's timeout reserved for waiting on stage slots (0 without staged execution)."""
+    return STAGE_WAIT_MAX_SECONDS * len(GATED_STAGES) if jobs_per_slot > 1 else 0
+
+
+@contextmanager
+def stage_slot(name, timings=None):
+    """Holds a slot of stage `name` and yields (index, slots), or None when the stage is not gated.
+
+    The wait for the slot is recorded in `timings` as "<name>_wait". After
+    STAGE_WAIT_MAX_SECONDS without a free slot the stage runs without one.
+    """
+    gate = _gates.get(name)
+    if gate is None:
+        yield None
+        return
+    started = time.perf_counter()
+    with gate.slot() as index:
+        if timings is not None:
+            timings.record(f"{name}_wait", time.perf_counter() - started)
+        if index is None:
+            logger.warning(f"No {name} slot free after {STAGE_WAIT_MAX_SECONDS:.0f}s, running the stage without one")
+            yield None
+        else:
+            yield index, gate.slots
@@ -1,66 +1,266 @@
 from google.cloud import speech
 from google.cloud import storage
+import asyncio
+import importlib
 import os
-from pydub import AudioSegment
+import random
+import threading
+import time
+import uuid
 from ..utils.logger import logger
+from .audio_encoding import SPEECH_AUDIO_ENCODING, encode_audio
+from ..services.rate_limiter import AdaptiveConcurrency, RedisTokenBucket
+from ..utils.metrics import (
+    segment_audio_seconds, speech_concurrency_limit, speech_rate_limit_wait_seconds, speech_request_bytes,
+    speech_retries, speech_rpc_errors, speech_rpc_seconds,
+)
+
+# Most Speech requests a worker process keeps in flight at once. The actual
+# limit adapts between SPEECH_MIN_CONCURRENCY and this: it grows while calls
+# succeed and halves when Speech reports overload
+SPEECH_CONCURRENCY = int(os.getenv("SPEECH_CONCURRENCY", "10"))
+SPEECH_MIN_CONCURRENCY = int(os.getenv("SPEECH_MIN_CONCURRENCY", "1"))
+# Attempts per request when Speech is overloaded (RESOURCE_EXHAUSTED / UNAVAILABLE);
+# retries wait a random time up to SPEECH_RETRY_BASE_SECONDS * 2^attempt, capped
+SPEECH_MAX_ATTEMPTS = int(os.getenv("SPEECH_MAX_ATTEMPTS", "6"))
+SPEECH_RETRY_BASE_SECONDS = float(os.getenv("SPEECH_RETRY_BASE_SECONDS", "1"))
+SPEECH_RETRY_MAX_SECONDS = float(os.getenv("SPEECH_RETRY_MAX_SECONDS", "32"))
+# Errors meaning Speech is overloaded or over quota, by gRPC status name
+OVERLOAD_ERRORS = ("RESOURCE_EXHAUSTED", "UNAVAILABLE")
+
+_storage_client = None
+_storage_client_pid = None
+_storage_lock = threading.Lock()
+
+def get_storage_client():
+    """Returns the process-wide Storage client, creating it on first use.
+
+    Clients are not shared across fork() (RQ forks a work horse per job), so a
+    new one is created when the process id changes.
+    """
+    global _storage_client, _storage_client_pid
+    with _storage_lock:
+        if _storage_client is None or _storage_client_pid != os.getpid():
+            _storage_client = storage.Client()
+            _storage_client_pid = os.getpid()
+        return _storage_client
+
+def upload_to_gcs(content, bucket_name):
+    """Uploads in-memory audio to Google Cloud Storage and returns its gs:// URI."""
+    bucket = get_storage_client().bucket(bucket_name)
 
-def upload_to_gcs(file_path, bucket_name):
-    """Uploads a file to Google Cloud Storage and returns its gs:// URI."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    
     # Use a unique name for the file in storage
-    destination_blob_name = f"temp_transcription_segments/{os.path.basename(file_path)}"
+    destination_blob_name = f"temp_transcription_segments/{uuid.uuid4().hex}.raw"
     blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_filename(file_path)
-    
+    blob.upload_from_string(content, content_type="application/octet-stream")
+
     gcs_uri = f"gs://{bucket_name}/{destination_blob_name}"
-    logger.info(f"File {file_path} uploaded to {gcs_uri}")
+    logger.info(f"Audio segment ({len(content)} bytes) uploaded to {gcs_uri}")
     return gcs_uri, destination_blob_name
 
 def delete_from_gcs(bucket_name, blob_name):
     """Deletes a file from Google Cloud Storage."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(blob_name)
     blob.delete()
     logger.info(f"Blob {blob_name} deleted.")
 
-def transcribe_audio(audio_path, language_code="en-US"):
-    client = speech.SpeechClient()
-    
-    # Determine audio duration
-    audio_segment = AudioSegment.from_wav(audio_path)
-    duration_seconds = len(audio_segment) / 1000.0
-
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz=16000,
-        language_code=language_code,
-    )
-
-    # If audio is shorter than 60 seconds, use synchronous method
-    if duration_seconds < 60:
-        with open(audio_path, "rb") as audio_file:
-            content = audio_file.read()
+
+class GoogleSpeechBackend:
+    """Speech backend using one async gRPC client (and channel) per process.
+
+    Set SPEECH_EMULATOR_HOST to point it at a local fake Speech server over an
+    insecure channel.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    def _get_client(self):
+        # Async clients are bound to the event loop they are created in, so this
+        # is only called from the engine's loop thread
+        if self._client is None:
+            emulator_host = os.getenv("SPEECH_EMULATOR_HOST")
+            if emulator_host:
+                import grpc
+                from google.cloud.speech_v1.services.speech.transports import SpeechGrpcAsyncIOTransport
+                transport = SpeechGrpcAsyncIOTransport(channel=grpc.aio.insecure_channel(emulator_host))
+                self._client = speech.SpeechAsyncClient(transport=transport)
+            else:
+                self._client = speech.SpeechAsyncClient()
+        return self._client
+
+    async def recognize(self, config, content):
         audio = speech.RecognitionAudio(content=content)
-        response = client.recognize(config=config, audio=audio)
-        return response
+        return await self._get_client().recognize(config=config, audio=audio)
+
+    async def long_running_recognize(self, config, uri, timeout):
+        audio = speech.RecognitionAudio(uri=uri)
+        operation = await self._get_client().long_running_recognize(config=config, audio=audio)
+        return await operation.result(timeout=timeout)
+
+
+def is_overloaded(error):
+    """Whether a Speech error means "slow down" rather than a bad request."""
+    code = getattr(error, "grpc_status_code", None)
+    if code is not None:
+        return code.name in OVERLOAD_ERRORS
+    # Custom backends may raise plain exceptions carrying the status name
+    return any(name in str(error) for name in OVERLOAD_ERRORS)
+
+
+def retry_delay(attempt, base=SPEECH_RETRY_BASE_SECONDS, cap=SPEECH_RETRY_MAX_SECONDS):
+    """Seconds to wait before retry number `attempt` (1-based): exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def _load_backend():
+    """Instantiates the backend named by SPEECH_BACKEND ("module:Class"), Google by default."""
+    backend_path = os.getenv("SPEECH_BACKEND")
+    if not backend_path:
+        return GoogleSpeechBackend()
+    module_name, class_name = backend_path.split(":")
+    return getattr(importlib.import_module(module_name), class_name)()
 
-    # Otherwise, use asynchronous method
-    else:
+
+class TranscriptionEngine:
+    """Runs Speech requests on an asyncio loop in a background thread.
+
+    `submit` can be called from any thread and returns a concurrent.futures.Future,
+    so callers can keep producing requests (e.g. while diarization is still
+    running) and collect the results in whatever order they need. Every request
+    takes a token from the bucket shared by all workers (the project quota) and
+    then one of at most `concurrency` slots, a limit that adapts to overload
+    errors. The audio payload of a request is only built (and encoded as
+    `encoding`) once it gets its first slot; overloaded requests are retried
+    with jittered backoff.
+    """
+
+    def __init__(self, backend=None, concurrency=SPEECH_CONCURRENCY, encoding=SPEECH_AUDIO_ENCODING,
+                 rate_limiter=None):
+        self.backend = backend or _load_backend()
+        self.concurrency = concurrency
+        self.encoding = encoding
+        self._loop = asyncio.new_event_loop()
+        self._limit = AdaptiveConcurrency(concurrency, minimum=SPEECH_MIN_CONCURRENCY)
+        self._rate_limiter = rate_limiter or RedisTokenBucket()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="transcription-engine", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        speech_concurrency_limit.set(self._limit.limit)
+        self._ready.set()
+        self._loop.run_forever()
+
+    def submit(self, content, language_code="en-US", sample_rate=16000, word_time_offsets=False):
+        """Schedules a transcription. `content` is PCM bytes or a callable returning them."""
+        coroutine = self.transcribe(content, language_code, sample_rate, word_time_offsets)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _payload(self, content, sample_rate):
+        # Runs in a worker thread, so building and compressing audio never blocks the loop
+        if callable(content):
+            content = content()
+        # Determine audio duration from the PCM size (2 bytes per sample)
+        duration_seconds = len(content) / (2 * sample_rate)
+        payload, encoding = encode_audio(content, sample_rate, self.encoding)
+        return duration_seconds, payload, encoding
+
+    async def transcribe(self, content, language_code="en-US", sample_rate=16000, word_time_offsets=False):
+        payload = None
+        for attempt in range(1, SPEECH_MAX_ATTEMPTS + 1):
+            speech_rate_limit_wait_seconds.observe(await self._rate_limiter.acquire())
+            await self._limit.acquire()
+            healthy = None
+            try:
+                if payload is None:
+                    payload = await asyncio.to_thread(self._payload, content, sample_rate)
+                response = await self._request(*payload, language_code, sample_rate, word_time_offsets)
+                healthy = True
+                return response
+            except Exception as e:
+                if not is_overloaded(e):
+                    raise
+                healthy = False
+                if attempt == SPEECH_MAX_ATTEMPTS:
+                    raise
+                delay = retry_delay(attempt)
+                speech_retries.labels(error=type(e).__name__).inc()
+                logger.warning(f"Speech overloaded ({e}), retry {attempt} in {delay:.1f}s")
+            finally:
+                await self._limit.release(healthy)
+                speech_concurrency_limit.set(self._limit.limit)
+            await asyncio.sleep(delay)
+
+    async def _request(self, duration_seconds, content, encoding, language_code, sample_rate, word_time_offsets):
+        config = speech.RecognitionConfig(
+            encoding=getattr(speech.RecognitionConfig.AudioEncoding, encoding),
+            sample_rate_hertz=sample_rate,
+            language_code=language_code,
+            enable_word_time_offsets=word_time_offsets,
+        )
+
+        segment_audio_seconds.observe(duration_seconds)
+        speech_request_bytes.labels(encoding=encoding).observe(len(content))
+
+        # If audio is shorter than 60 seconds, use synchronous method
+        if duration_seconds < 60:
+            return await self._timed("recognize", self.backend.recognize(config, content))
+
+        # Otherwise, use asynchronous method
         logger.info(f"Audio segment is longer than 60s ({duration_seconds}s). Using long-running recognition.")
         bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET')
-        gcs_uri, blob_name = upload_to_gcs(audio_path, bucket_name)
-        
-        audio = speech.RecognitionAudio(uri=gcs_uri)
-        
-        operation = client.long_running_recognize(config=config, audio=audio)
-        logger.info("Waiting for long-running transcription operation to complete...")
-        response = operation.result(timeout=900) # 15 minute timeout for the operation
-        
-        # Delete temporary file from storage
-        delete_from_gcs(bucket_name, blob_name)
-        
-        return response
+        gcs_uri, blob_name = await asyncio.to_thread(upload_to_gcs, content, bucket_name)
+        try:
+            logger.info("Waiting for long-running transcription operation to complete...")
+            # 15 minute timeout for the operation
+            return await self._timed(
+                "long_running_recognize", self.backend.long_running_recognize(config, gcs_uri, timeout=900),
+            )
+        finally:
+            # Delete temporary file from storage
+            await asyncio.to_thread(delete_from_gcs, bucket_name, blob_name)
+
+    @staticmethod
+    async def _timed(method, call):
+        started = time.perf_counter()
+        try:
+            return await call
+        except Exception as e:
+            speech_rpc_errors.labels(method=method, error=type(e).__name__).inc()
+            raise
+        finally:
+            speech_rpc_seconds.labels(method=method).observe(time.perf_counter() - started)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Returns the process-wide transcription engine (recreated after fork)."""
+    global _engine, _engine_pid
+    with _engine_lock:
+        if _engine is None or _engine_pid != os.getpid():
+            _engine = TranscriptionEngine()
+            _engine_pid = os.getpid()
+        return _engine
+
+def set_engine(engine):
+    """Replaces the process-wide engine, e.g. with one using a fake backend."""
+    global _engine, _engine_pid
+    with _engine_lock:
+        _engine = engine
+        _engine_pid = os.getpid()
+
+def transcribe_audio(audio_content, language_code="en-US", sample_rate=16000, word_time_offsets=False):
+    """Transcribes raw mono LINEAR16 PCM bytes (sent in the engine's encoding) and waits for the response."""
+    return get_engine().submit(audio_content, language_code, sample_rate, word_time_offsets).result()
@@ -0,0 +1,39 @@
+"""Redis connection and job queue shared by the API and the workers.
+
+Kept free of processing imports: the API enqueues tasks by name, so it never
+loads the modules that run them.
+"""
+import os
+
+from dotenv import load_dotenv
+from redis import Redis
+from rq import Queue
+
+ # Load environment variables before reading them
+load_dotenv()
+
+# Import path of the task that processes one media file; resolved by the worker only
+PROCESS_MEDIA_TASK = "src.tasks.process_media_task"
+
+# Jobs are routed by audio duration (seconds) to one queue per size class;
+# workers take the shorter classes first
+SHORT_MAX_SECONDS = float(os.getenv("QUEUE_SHORT_MAX_SECONDS", "600"))
+MEDIUM_MAX_SECONDS = float(os.getenv("QUEUE_MEDIUM_MAX_SECONDS", "3600"))
+SIZE_CLASSES = (("short", SHORT_MAX_SECONDS), ("medium", MEDIUM_MAX_SECONDS), ("long", float("inf")))
+
+redis_conn = Redis.from_url(os.getenv('REDIS_URL'))
+# Jobs enqueued before size classes existed, or by other clients, stay on the default queue
+q = Queue(connection=redis_conn)
+size_class_queues = {name: Queue(f"transcribe-{name}", connection=redis_conn) for name, _ in SIZE_CLASSES}
+
+
+def size_class(duration):
+    """Size class of a job with `duration` seconds of audio; unknown durations count as long."""
+    if duration is None:
+        return "long"
+    return next((name for name, limit in SIZE_CLASSES if duration < limit), SIZE_CLASSES[-1][0])
+
+
+def all_queues():
+    """Every queue workers listen to, in order of preference."""
+    return [*size_class_queues.values(), q]
@@ -0,0 +1,141 @@
+import math
+import os
+import subprocess
+from datetime import timedelta
+
+from rq.worker_registration import WORKERS_BY_QUEUE_KEY
+
+from ..core.stages import stage_wait_budget
+from ..queues import SHORT_MAX_SECONDS, MEDIUM_MAX_SECONDS, all_queues, redis_conn, size_class_queues
+from ..utils.logger import logger
+
+# Job timeout: JOB_TIMEOUT_BASE plus this many seconds per second of audio, capped at
+# JOB_TIMEOUT_MAX. Jobs of unknown duration get DEFAULT_JOB_TIMEOUT. With staged
+# execution the longest possible wait for stage slots is added on top.
+JOB_TIMEOUT_BASE = int(os.getenv("JOB_TIMEOUT_BASE", "600"))
+JOB_TIMEOUT_PER_AUDIO_SECOND = float(os.getenv("JOB_TIMEOUT_PER_AUDIO_SECOND", "1.0"))
+JOB_TIMEOUT_MAX = int(os.getenv("JOB_TIMEOUT_MAX", "14400"))
+DEFAULT_JOB_TIMEOUT = 7200
+# Read the duration of submitted media from its container header with ffprobe
+PROBE_DURATION = os.getenv("ADMISSION_PROBE_DURATION", "true").lower() in ("1", "true", "yes")
+PROBE_TIMEOUT = float(os.getenv("ADMISSION_PROBE_TIMEOUT", "5"))
+# New jobs whose estimated completion is further away than this are rejected (0 admits everything)
+MAX_ETA_SECONDS = float(os.getenv("ADMISSION_MAX_ETA_SECONDS", "86400"))
+# Seconds of audio one worker processes per second, until finished jobs have measured it
+DEFAULT_SPEED = float(os.getenv("ADMISSION_DEFAULT_SPEED", "2.0"))
+
+STATS_KEY = "admission:stats"
+# Weight of the newest observation in the moving averages kept in STATS_KEY
+EWMA_WEIGHT = 0.2
+# Assumed mean duration per class until jobs with a known duration were admitted
+_DEFAULT_MEANS = {"short": SHORT_MAX_SECONDS / 2, "medium": (SHORT_MAX_SECONDS + MEDIUM_MAX_SECONDS) / 2,
+                  "long": MEDIUM_MAX_SECONDS * 2}
+
+
+def job_timeout(duration):
+    """RQ timeout for a job with `duration` seconds of audio."""
+    if duration is None:
+        return int(DEFAULT_JOB_TIMEOUT + stage_wait_budget())
+    return int(min(JOB_TIMEOUT_MAX, JOB_TIMEOUT_BASE + duration * JOB_TIMEOUT_PER_AUDIO_SECOND) + stage_wait_budget())
+
+
+def _signed_url(media_url):
+    from .firebase_service import init_firebase
+    from firebase_admin import storage
+
+    init_firebase()
+    bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET')
+    blob = storage.bucket(bucket_name).blob(media_url.replace(f'gs://{bucket_name}/', ''))
+    return blob.generate_signed_url(version="v4", expiration=timedelta(minutes=15))
+
+
+def probe_duration(media_url):
+    """Reads the duration of remote media from its container header; None when it cannot be read.
+
+    ffprobe only fetches the ranges it needs, so this costs a few small
+    requests rather than a download.
+    """
+    if not PROBE_DURATION:
+        return None
+    try:
+        url = _signed_url(media_url) if media_url.startswith("gs://") else media_url
+        completed = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", url],
+            capture_output=True, text=True, timeout=PROBE_TIMEOUT,
+        )
+        duration = float(completed.stdout.strip())
+        return duration if math.isfinite(duration) and duration >= 0 else None
+    except Exception as e:
+        logger.warning(f"Could not probe the duration of {media_url}: {e}")
+        return None
+
+
+class Backlog:
+    """Snapshot of the queued work, for estimating when new jobs would finish.
+
+    The queued audio of each size class is its queue length times the mean
+    duration of the jobs admitted to it; capacity is the measured speed of a
+    job times the number of RQ workers serving this app's queues. With staged
+    execution every slot runs WORKER_JOBS_PER_SLOT of them, so that is slots
+    times jobs per slot, and the measured speed already includes the stage
+    waits. Reading it costs one Redis round trip.
+    """
+
+    def __init__(self, connection=redis_conn):
+        self.connection = connection
+        with connection.pipeline(transaction=False) as pipe:
+            for queue in size_class_queues.values():
+                pipe.llen(queue.key)
+            pipe.hgetall(STATS_KEY)
+            # Workers of other apps on the same Redis are not in these per-queue sets
+            pipe.sunion([WORKERS_BY_QUEUE_KEY % queue.name for queue in all_queues()])
+            *lengths, stats, workers = pipe.execute()
+        workers = len(workers)
+        stats = {key.decode(): float(value) for key, value in stats.items()}
+        self.means = {name: stats.get(f"mean:{name}", _DEFAULT_MEANS[name]) for name in size_class_queues}
+        self.seconds = {name: length * self.means[name] for name, length in zip(size_class_queues, lengths)}
+        # Before any worker has registered, assume one is starting
+        self.speed = stats.get("speed", DEFAULT_SPEED) * max(1, workers)
+        self._admitted = {}
+
+    def eta(self, name, duration):
+        """Seconds until a new job of class `name` would be finished.
+
+        Counts the queued audio of its own class and of every class that is served before it.
+        """
+        names = list(size_class_queues)
+        ahead = sum(self.seconds[other] for other in names[:names.index(name) + 1])
+        own = duration if duration is not None else self.means[name]
+        return (ahead + own) / self.speed
+
+    def admits(self, eta):
+        return not MAX_ETA_SECONDS or eta <= MAX_ETA_SECONDS
+
+    def add(self, name, duration):
+        """Counts an admitted job in the snapshot; `save` stores the updated class means."""
+        self.seconds[name] += duration if duration is not None else self.means[name]
+        if duration is not None:
+            self.means[name] += EWMA_WEIGHT * (duration - self.means[name])
+            self._admitted[f"mean:{name}"] = self.means[name]
+
+    def save(self):
+        if not self._admitted:
+            return
+        try:
+            self.connection.hset(STATS_KEY, mapping=self._admitted)
+        except Exception as e:
+            logger.warning(f"Failed to store admission statistics: {e}")
+
+
+def record_throughput(audio_seconds, processing_seconds, connection=redis_conn):
+    """Updates the moving average of how many seconds of audio a worker processes per second."""
+    if audio_seconds <= 0 or processing_seconds <= 0:
+        return
+    try:
+        current = connection.hget(STATS_KEY, "speed")
+        speed = audio_seconds / processing_seconds
+        if current is not None:
+            speed = float(current) + EWMA_WEIGHT * (speed - float(current))
+        connection.hset(STATS_KEY, "speed", speed)
+    except Exception as e:
+        logger.warning(f"Failed to store worker throughput: {e}")
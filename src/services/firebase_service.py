@@ -1,15 +1,299 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+import atexit
 import os
+import threading
+from ..utils.logger import logger
 
-cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH'))
-firebase_admin.initialize_app(cred, {
-    'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
-})
+# Firestore accepts at most 500 writes per batch
+BATCH_LIMIT = 500
+# How often the write-behind writer flushes pending status updates (seconds)
+FLUSH_INTERVAL = float(os.getenv("FIRESTORE_FLUSH_INTERVAL", "0.2"))
+# Transcripts larger than this (UTF-8 bytes) are stored outside the main document,
+# which is limited to 1 MiB in total
+TRANSCRIPT_INLINE_LIMIT = int(os.getenv("TRANSCRIPT_INLINE_LIMIT", str(800 * 1024)))
+# "chunks" (subcollection documents) or "storage" (one Storage object)
+TRANSCRIPT_OFFLOAD = os.getenv("TRANSCRIPT_OFFLOAD", "chunks")
+TRANSCRIPT_CHUNK_BYTES = 900 * 1024
+# Chunk documents per batched write; a commit is limited to 10 MiB
+CHUNKS_PER_BATCH = 8
+TRANSCRIPT_PREVIEW_CHARS = 1000
 
-db = firestore.client()
+_db = None
+_init_lock = threading.Lock()
+
+def init_firebase():
+    """Initializes the Firebase app on first use and returns the Firestore client.
+
+    Deferred, and the Firebase SDK imported only here, so processes that never
+    write to Firestore do not pay for it at startup.
+    """
+    global _db
+    with _init_lock:
+        if _db is None:
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH'))
+                firebase_admin.initialize_app(cred, {
+                    'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
+                })
+            _db = firestore.client()
+        return _db
+
+def _document(doc_ref):
+    doc_path = doc_ref.split('/')
+    return init_firebase().collection(doc_path[0]).document(doc_path[1])
 
 def update_firestore(doc_ref, data):
     # Update Firestore document with provided data
-    doc_path = doc_ref.split('/')
-    db.collection(doc_path[0]).document(doc_path[1]).set(data, merge=True)
+    _document(doc_ref).set(data, merge=True)
+
+def update_firestore_batch(updates):
+    """Merges many (doc_ref, data) updates using batched writes of up to 500 documents."""
+    for offset in range(0, len(updates), BATCH_LIMIT):
+        batch = init_firebase().batch()
+        for doc_ref, data in updates[offset:offset + BATCH_LIMIT]:
+            batch.set(_document(doc_ref), data, merge=True)
+        batch.commit()
+
+def _merge(target, data):
+    # Nested dicts are merged the same way set(merge=True) does it
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class StatusWriter:
+    """Write-behind Firestore writer.
+
+    Updates are coalesced per document in memory and flushed from a background
+    thread in batched writes, at most every `interval` seconds. Failed writes
+    are logged and retried up to `max_attempts` times, one `interval` apart.
+    `on_commit` callbacks run once the update they were registered with has
+    been committed, or dropped after its last attempt, never while a retry is
+    still pending.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, max_attempts=3):
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._attempts = {}
+        self._callbacks = {}
+        # Documents whose pending updates were discarded; a failed in-flight write of them is not retried
+        self._discarded = set()
+        self._condition = threading.Condition()
+        self._requested = 0
+        self._flushed = 0
+        self._thread = threading.Thread(target=self._run, name="firestore-writer", daemon=True)
+        self._thread.start()
+
+    def update(self, doc_ref, data, on_commit=None):
+        with self._condition:
+            self._discarded.discard(doc_ref)
+            _merge(self._pending.setdefault(doc_ref, {}), data)
+            if on_commit is not None:
+                self._callbacks.setdefault(doc_ref, []).append(on_commit)
+            if len(self._pending) >= BATCH_LIMIT:
+                self._condition.notify_all()
+
+    def discard(self, doc_ref):
+        """Drops the pending updates of `doc_ref`, e.g. before a synchronous write supersedes them.
+
+        Their `on_commit` callbacks run right away, as for a dropped update.
+        """
+        with self._condition:
+            self._pending.pop(doc_ref, None)
+            self._attempts.pop(doc_ref, None)
+            self._discarded.add(doc_ref)
+            callbacks = self._callbacks.pop(doc_ref, [])
+        self._run_callbacks(callbacks)
+
+    def flush(self, timeout=30):
+        """Blocks until everything queued so far has been committed or dropped. Returns False on timeout."""
+        with self._condition:
+            self._requested += 1
+            target = self._requested
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._flushed >= target, timeout)
+
+    def _run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Firestore writer callback failed: {e}", exc_info=True)
+
+    def _run(self):
+        retried = set()
+        while True:
+            with self._condition:
+                # After a failed write, the retry waits a full interval even if a flush is waiting
+                self._condition.wait_for(
+                    lambda: (self._requested > self._flushed and not retried) or len(self._pending) >= BATCH_LIMIT,
+                    timeout=self.interval,
+                )
+                pending, self._pending = self._pending, {}
+                callbacks = {doc_ref: self._callbacks.pop(doc_ref) for doc_ref in pending
+                             if doc_ref in self._callbacks}
+                target = self._requested
+
+            retried = self._write(pending) if pending else set()
+            with self._condition:
+                # Callbacks of a retried update wait for its next attempt
+                for doc_ref in retried & callbacks.keys():
+                    self._callbacks[doc_ref] = callbacks.pop(doc_ref) + self._callbacks.get(doc_ref, [])
+            for doc_callbacks in callbacks.values():
+                self._run_callbacks(doc_callbacks)
+
+            # A flush is only done once none of its updates is still waiting for a retry
+            if not retried:
+                with self._condition:
+                    self._flushed = max(self._flushed, target)
+                    self._condition.notify_all()
+
+    def _write(self, pending):
+        """Writes `pending` and returns the documents whose update was queued again for a retry.
+
+        Each group of BATCH_LIMIT documents is one commit, so only the documents
+        of a failed commit are retried.
+        """
+        retried = set()
+        items = list(pending.items())
+        for offset in range(0, len(items), BATCH_LIMIT):
+            retried |= self._write_group(dict(items[offset:offset + BATCH_LIMIT]))
+        return retried
+
+    def _write_group(self, pending):
+        retried = set()
+        try:
+            update_firestore_batch(list(pending.items()))
+            for doc_ref in pending:
+                self._attempts.pop(doc_ref, None)
+        except Exception as e:
+            logger.error(f"Failed to flush {len(pending)} Firestore updates: {e}", exc_info=True)
+            with self._condition:
+                for doc_ref, data in pending.items():
+                    if doc_ref in self._discarded:
+                        continue
+                    attempts = self._attempts.get(doc_ref, 0) + 1
+                    if attempts >= self.max_attempts:
+                        self._attempts.pop(doc_ref, None)
+                        logger.error(f"[{doc_ref}] Dropping Firestore update after {attempts} attempts")
+                        continue
+                    self._attempts[doc_ref] = attempts
+                    # Newer updates queued in the meantime take precedence
+                    self._pending[doc_ref] = _merge(data, self._pending.get(doc_ref, {}))
+                    retried.add(doc_ref)
+        return retried
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+def get_status_writer():
+    """Returns the process-wide write-behind writer (recreated after fork)."""
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = StatusWriter()
+            _writer_pid = os.getpid()
+        return _writer
+
+def update_firestore_async(doc_ref, data, on_commit=None):
+    """Queues a merge update for the write-behind writer and returns immediately."""
+    get_status_writer().update(doc_ref, data, on_commit)
+
+def flush_firestore(timeout=30, discard=None):
+    """Waits until queued status updates are written; no-op if nothing was queued in this process.
+
+    The pending updates of document `discard` are dropped first, for a final
+    synchronous write that supersedes them.
+    """
+    if _writer is not None and _writer_pid == os.getpid():
+        if discard is not None:
+            _writer.discard(discard)
+        return _writer.flush(timeout)
+    return True
+
+atexit.register(flush_firestore)
+
+
+def _split_transcript(transcript, limit=TRANSCRIPT_CHUNK_BYTES):
+    """Splits a transcript into chunks of at most `limit` UTF-8 bytes, preferring line breaks."""
+    chunks, current, size = [], [], 0
+    for line in transcript.splitlines(keepends=True):
+        encoded = len(line.encode("utf-8"))
+        if current and size + encoded > limit:
+            chunks.append("".join(current))
+            current, size = [], 0
+        # A single line longer than the limit is cut by characters (4 bytes max each)
+        while encoded > limit:
+            step = limit // 4
+            chunks.append(line[:step])
+            line = line[step:]
+            encoded = len(line.encode("utf-8"))
+        current.append(line)
+        size += encoded
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def _write_chunks(doc_ref, chunks):
+    """Writes the transcript chunks in batched writes and deletes chunks left by a longer earlier transcript."""
+    db = init_firebase()
+    collection = _document(doc_ref).collection("transcript_chunks")
+    for offset in range(0, len(chunks), CHUNKS_PER_BATCH):
+        batch = db.batch()
+        for index, chunk in enumerate(chunks[offset:offset + CHUNKS_PER_BATCH], start=offset):
+            batch.set(collection.document(f"{index:05d}"), {"index": index, "text": chunk})
+        batch.commit()
+
+    stale = [snapshot.reference for snapshot in collection.where("index", ">=", len(chunks)).stream()]
+    for offset in range(0, len(stale), BATCH_LIMIT):
+        batch = db.batch()
+        for reference in stale[offset:offset + BATCH_LIMIT]:
+            batch.delete(reference)
+        batch.commit()
+    if stale:
+        logger.info(f"[{doc_ref}] Deleted {len(stale)} transcript chunks of an earlier, longer transcript")
+
+def transcript_fields(doc_ref, transcript):
+    """Returns the fields that store `transcript` on the main document.
+
+    Small transcripts are stored inline. Larger ones are written to a
+    `transcript_chunks` subcollection (or a Storage object) and the main
+    document only gets a pointer, a preview and the size.
+    """
+    init_firebase()
+    from firebase_admin import firestore, storage
+
+    size = len(transcript.encode("utf-8"))
+    if size <= TRANSCRIPT_INLINE_LIMIT:
+        return {
+            "transcript": transcript,
+            "transcript_preview": firestore.DELETE_FIELD,
+            "transcript_storage": firestore.DELETE_FIELD,
+        }
+
+    if TRANSCRIPT_OFFLOAD == "storage":
+        path = f"transcripts/{doc_ref}.txt"
+        blob = storage.bucket().blob(path)
+        blob.upload_from_string(transcript, content_type="text/plain; charset=utf-8")
+        pointer = {"type": "storage", "bucket": blob.bucket.name, "path": path, "bytes": size}
+    else:
+        chunks = _split_transcript(transcript)
+        _write_chunks(doc_ref, chunks)
+        pointer = {"type": "chunks", "collection": "transcript_chunks", "count": len(chunks), "bytes": size}
+
+    logger.info(f"[{doc_ref}] Transcript of {size} bytes stored outside the document ({pointer['type']})")
+    return {
+        "transcript": firestore.DELETE_FIELD,
+        "transcript_preview": transcript[:TRANSCRIPT_PREVIEW_CHARS],
+        "transcript_storage": pointer,
+    }
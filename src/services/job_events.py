@@ -0,0 +1,166 @@
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from redis import Redis
+
+from ..utils.logger import logger
+
+# Progress of every job is appended to a Redis stream that /api/jobs/<id>/stream
+# replays and follows. Streams expire this long after the last event.
+EVENTS_PREFIX = "job-events"
+EVENTS_TTL_SECONDS = int(os.getenv("JOB_EVENTS_TTL_SECONDS", "3600"))
+EVENTS_MAXLEN = 100000
+# Statuses after which a job publishes nothing more
+FINAL_STATUSES = ("DONE", "ERROR")
+# Least seconds between progress updates of the RQ job meta
+META_PROGRESS_INTERVAL = 1.0
+# The API marks a job once its QUEUED status reached Firestore (or was given up),
+# and the job waits up to this long for the mark before writing statuses of its own
+QUEUED_MARK_PREFIX = "job-queued-written"
+QUEUED_MARK_TTL_SECONDS = 7 * 24 * 3600
+QUEUED_WRITE_WAIT_SECONDS = float(os.getenv("QUEUED_WRITE_WAIT_SECONDS", "10"))
+
+_connection = None
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        _connection = Redis.from_url(os.getenv('REDIS_URL'))
+    return _connection
+
+
+def _key(job_id):
+    return f"{EVENTS_PREFIX}:{job_id}"
+
+
+class JobEvents:
+    """Publishes the status, progress and transcript lines of one job.
+
+    Events go to the job's stream; with an RQ `job`, status, stage and progress
+    are also kept in its meta for /api/jobs/<id>. A no-op without a job id
+    (e.g. when `process_media` runs outside RQ). Publishing never fails the
+    job; Redis errors are logged.
+    """
+
+    def __init__(self, job_id, connection=None, job=None):
+        self.job_id = job_id
+        self.connection = connection
+        self.job = job
+        self._meta_saved_at = 0.0
+
+    @classmethod
+    def for_job(cls, job):
+        """Events of an RQ job (or of no job, when `job` is None)."""
+        return cls(job.id if job is not None else None, job=job)
+
+    def _save_meta(self, force=True, **fields):
+        if self.job is None:
+            return
+        self.job.meta.update(fields, updated_at=datetime.now(timezone.utc).isoformat())
+        now = time.monotonic()
+        if not force and now - self._meta_saved_at < META_PROGRESS_INTERVAL:
+            return
+        try:
+            self.job.save_meta()
+            self._meta_saved_at = now
+        except Exception as e:
+            logger.warning(f"Failed to save meta of job {self.job_id}: {e}")
+
+    def wait_queued_written(self, timeout=QUEUED_WRITE_WAIT_SECONDS):
+        """Waits until the API's QUEUED write is done, so it cannot land after (and overwrite) this job's statuses."""
+        if not self.job_id:
+            return True
+        deadline = time.monotonic() + timeout
+        try:
+            connection = self.connection or _get_connection()
+            while not connection.exists(f"{QUEUED_MARK_PREFIX}:{self.job_id}"):
+                if time.monotonic() >= deadline:
+                    logger.warning(f"QUEUED status of job {self.job_id} not written after {timeout:.0f}s, going on")
+                    return False
+                time.sleep(0.1)
+        except Exception as e:
+            logger.warning(f"Failed to check the QUEUED status of job {self.job_id}: {e}")
+            return False
+        return True
+
+    def publish(self, event, data):
+        if not self.job_id:
+            return
+        try:
+            connection = self.connection or _get_connection()
+            key = _key(self.job_id)
+            with connection.pipeline(transaction=False) as pipe:
+                pipe.xadd(key, {"event": event, "data": json.dumps(data, default=str)},
+                          maxlen=EVENTS_MAXLEN, approximate=True)
+                pipe.expire(key, EVENTS_TTL_SECONDS)
+                pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to publish {event} event of job {self.job_id}: {e}")
+
+    def status(self, status, **fields):
+        self.publish("status", {"status": status, **fields})
+        meta = {"status": status}
+        if "error_message" in fields:
+            meta["error_message"] = fields["error_message"]
+        self._save_meta(**meta)
+
+    def stage(self, stage):
+        """Records the processing stage the job has entered (meta only)."""
+        self._save_meta(stage=stage)
+
+    def progress(self, percent):
+        self.publish("progress", {"progress": round(percent, 1)})
+        self._save_meta(force=percent >= 100, progress=round(percent, 1))
+
+    def transcript(self, lines):
+        if lines:
+            self.publish("transcript", {"lines": lines})
+
+
+def publish_queued(job_ids, connection=None):
+    """Publishes the QUEUED status of many jobs in one pipeline."""
+    if not job_ids:
+        return
+    data = json.dumps({"status": "QUEUED"})
+    try:
+        with (connection or _get_connection()).pipeline(transaction=False) as pipe:
+            for job_id in job_ids:
+                pipe.xadd(_key(job_id), {"event": "status", "data": data}, maxlen=EVENTS_MAXLEN, approximate=True)
+                pipe.expire(_key(job_id), EVENTS_TTL_SECONDS)
+            pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to publish QUEUED events of {len(job_ids)} jobs: {e}")
+
+
+def mark_queued_written(job_id, connection=None):
+    """Records that the QUEUED status of a job is written; runs as a write-behind on_commit callback."""
+    (connection or _get_connection()).set(f"{QUEUED_MARK_PREFIX}:{job_id}", 1, ex=QUEUED_MARK_TTL_SECONDS)
+
+
+def iter_job_events(job_id, last_id="0", block_seconds=15, connection=None):
+    """Yields (event id, event, data) for a job, replaying from `last_id` and then following.
+
+    Yields (None, None, None) after `block_seconds` without events so callers
+    can send keep-alives, and returns after a final status event.
+    """
+    connection = connection or _get_connection()
+    key = _key(job_id)
+    while True:
+        response = connection.xread({key: last_id}, count=100, block=block_seconds * 1000)
+        if not response:
+            yield None, None, None
+            continue
+        for entry_id, fields in response[0][1]:
+            last_id = entry_id
+            event = fields[b"event"].decode()
+            data = fields[b"data"].decode()
+            yield entry_id.decode(), event, data
+            if event == "status" and json.loads(data).get("status") in FINAL_STATUSES:
+                return
+
+
+def job_events_exist(job_id, connection=None):
+    return bool((connection or _get_connection()).exists(_key(job_id)))
@@ -0,0 +1,215 @@
+import asyncio
+import os
+import random
+import time
+
+from redis import asyncio as redis_asyncio
+
+from ..utils.logger import logger
+
+# Speech requests per minute allowed across all workers and hosts: the project
+# quota, minus some headroom for other clients (0 disables the shared limit)
+SPEECH_QUOTA_PER_MINUTE = float(os.getenv("SPEECH_QUOTA_PER_MINUTE", "900"))
+# Requests that may go out at once after an idle period
+SPEECH_QUOTA_BURST = int(os.getenv("SPEECH_QUOTA_BURST", "20"))
+# Seconds the shared concurrency limit is kept without changes; after that new
+# processes start again at the maximum
+SPEECH_LIMIT_TTL_SECONDS = int(os.getenv("SPEECH_LIMIT_TTL_SECONDS", "600"))
+BUCKET_KEY = "speech-rate:bucket"
+LIMIT_KEY = "speech-rate:concurrency"
+
+# Refills the bucket for the time since the last call and takes one token.
+# Returns "0" on success, otherwise the seconds until a token is available.
+# Uses the Redis clock, so hosts with skewed clocks share one consistent bucket.
+_ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+# Applies a change of the concurrency limit to the shared state and returns the
+# resulting limit. A decrease (ARGV[2] == "1") multiplies the stored limit by
+# the backoff unless another process decreased it within the cooldown; an
+# increase to ARGV[1] is dropped within the cooldown after a decrease.
+_UPDATE_SCRIPT = """
+local proposed, decrease = tonumber(ARGV[1]), ARGV[2] == '1'
+local backoff, minimum, cooldown = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'limit', 'decreased')
+local limit = tonumber(state[1]) or proposed
+local settled = now - (tonumber(state[2]) or 0) >= cooldown
+if decrease and settled then
+    limit = math.max(minimum, limit * backoff)
+    redis.call('HSET', KEYS[1], 'decreased', tostring(now))
+elseif not decrease and settled then
+    limit = proposed
+end
+redis.call('HSET', KEYS[1], 'limit', tostring(limit))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[6]))
+return tostring(limit)
+"""
+
+
+class RedisTokenBucket:
+    """Token bucket in Redis shared by every worker, refilled at the Speech quota's rate.
+
+    Must be used from a single event loop (the async Redis client is bound to
+    it). Fails open: while Redis is unreachable, requests are only limited by
+    each process's own concurrency limit.
+    """
+
+    def __init__(self, per_minute=SPEECH_QUOTA_PER_MINUTE, burst=SPEECH_QUOTA_BURST, key=BUCKET_KEY, url=None):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.key = key
+        self._url = url or os.getenv('REDIS_URL')
+        self._script = None
+        self._unavailable = False
+
+    async def acquire(self):
+        """Waits until a request may be sent and returns the seconds waited."""
+        started = time.monotonic()
+        if self.rate <= 0:
+            return 0.0
+        while True:
+            try:
+                if self._script is None:
+                    self._script = redis_asyncio.Redis.from_url(self._url).register_script(_ACQUIRE_SCRIPT)
+                wait = float(await self._script(keys=[self.key], args=[self.rate, self.burst]))
+                if self._unavailable:
+                    logger.info("Speech rate limiter is available again")
+                    self._unavailable = False
+            except Exception as e:
+                if not self._unavailable:
+                    logger.warning(f"Speech rate limiter unavailable, sending without it: {e}")
+                    self._unavailable = True
+                return time.monotonic() - started
+            if wait <= 0:
+                return time.monotonic() - started
+            # Jitter keeps the processes waiting for the same token from retrying in lockstep
+            await asyncio.sleep(wait * random.uniform(1.0, 1.5))
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the requests one process keeps in flight.
+
+    Every successful request raises the limit by 1/limit (about one per
+    round of requests), an overload signal halves it. Decreases are applied at
+    most once per `cooldown` seconds, so the errors of requests that were
+    already in flight count as one signal. Must be used from a single event loop.
+
+    With a Redis `key` the limit is shared by every process: each one starts
+    from the stored limit, re-reads it every `cooldown` seconds and stores its
+    changes, so a backoff outlives the work horse that saw the overload. It
+    fails open to a limit of this process alone while Redis is unreachable.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, backoff=0.5, cooldown=2.0,
+                 key=LIMIT_KEY, url=None, ttl=SPEECH_LIMIT_TTL_SECONDS):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(initial or self.maximum)
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.key = key
+        self.ttl = ttl
+        self._url = url or os.getenv('REDIS_URL')
+        self._redis = None
+        self._script = None
+        self._synced = None
+        self._unavailable = False
+        self._last_decrease = 0.0
+        self._condition = None
+
+    def _clamp(self, limit):
+        return min(self.maximum, max(self.minimum, limit))
+
+    async def _call(self, operation):
+        # Runs one Redis operation, or returns None while Redis is unreachable
+        try:
+            if self._redis is None:
+                self._redis = redis_asyncio.Redis.from_url(self._url)
+                self._script = self._redis.register_script(_UPDATE_SCRIPT)
+            result = await operation()
+            if self._unavailable:
+                logger.info("Shared Speech concurrency limit is available again")
+                self._unavailable = False
+            return result
+        except Exception as e:
+            if not self._unavailable:
+                logger.warning(f"Shared Speech concurrency limit unavailable, using a local one: {e}")
+                self._unavailable = True
+            return None
+
+    async def _sync(self):
+        now = time.monotonic()
+        if self.key is None or (self._synced is not None and now - self._synced < self.cooldown):
+            return
+        self._synced = now
+        stored = await self._call(lambda: self._redis.hget(self.key, "limit"))
+        if stored is not None:
+            self.limit = self._clamp(float(stored))
+
+    async def _store(self, decrease):
+        if self.key is None:
+            return
+        stored = await self._call(lambda: self._script(keys=[self.key], args=[
+            self.limit, "1" if decrease else "0", self.backoff, self.minimum, self.cooldown, self.ttl,
+        ]))
+        if stored is not None:
+            self.limit = self._clamp(float(stored))
+            self._synced = time.monotonic()
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        await self._sync()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, healthy=None):
+        """Frees a slot; `healthy` is True after a success, False on overload and None otherwise."""
+        previous = int(self.limit)
+        decreased = False
+        async with self._condition:
+            self.in_flight -= 1
+            if healthy:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif healthy is False:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    decreased = True
+            self._condition.notify_all()
+        if decreased:
+            if self.key is None:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+            else:
+                await self._store(decrease=True)
+                if self._unavailable:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+            logger.info(f"Speech overloaded, concurrency limit lowered to {int(self.limit)}")
+        elif int(self.limit) != previous:
+            await self._store(decrease=False)
+        else:
+            return
+        # The stored limit may differ from ours; wake the waiters to re-check it
+        async with self._condition:
+            self._condition.notify_all()
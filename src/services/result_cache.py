@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import time
+
+from redis import Redis
+
+from ..utils.logger import logger
+
+# Bump when a change to the processing pipeline should invalidate cached transcripts
+CACHE_VERSION = "1"
+CACHE_PREFIX = "transcript-cache"
+
+ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+
+class ResultCache:
+    """Size-bounded Redis cache of finished transcripts keyed by media identity.
+
+    Every entry is tracked in a sorted set by last access time and its size
+    in a hash, and the least recently used entries are dropped once the stored
+    payloads exceed `max_bytes`. Entries also expire `ttl` seconds after they
+    were stored; their sizes are released when they are evicted or purged.
+    """
+
+    def __init__(self, connection, max_bytes=MAX_BYTES, ttl=TTL_SECONDS):
+        self.connection = connection
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lru_key = f"{CACHE_PREFIX}:lru"
+        self._bytes_key = f"{CACHE_PREFIX}:bytes"
+        self._sizes_key = f"{CACHE_PREFIX}:sizes"
+
+    @staticmethod
+    def make_key(source_id, language, model_version):
+        raw = f"{CACHE_VERSION}|{model_version}|{language}|{source_id}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _entry_key(self, key):
+        return f"{CACHE_PREFIX}:entry:{key}"
+
+    def get(self, key, count_miss=True):
+        """Returns the cached result for `key` or None, counting hits and (with `count_miss`) misses.
+
+        Callers that try several keys for one lookup count the miss only on the last one.
+        """
+        payload = self.connection.get(self._entry_key(key))
+        if payload is None:
+            if count_miss:
+                self.connection.incr(f"{CACHE_PREFIX}:misses")
+            return None
+        pipe = self.connection.pipeline()
+        pipe.incr(f"{CACHE_PREFIX}:hits")
+        pipe.zadd(self._lru_key, {key: time.time()})
+        pipe.execute()
+        return json.loads(payload)
+
+    def put(self, keys, result):
+        """Stores `result` under every key in `keys` and evicts old entries if needed."""
+        payload = json.dumps(result, default=str)
+        size = len(payload.encode("utf-8"))
+        pipe = self.connection.pipeline()
+        pipe.hmget(self._sizes_key, keys)
+        for key in keys:
+            pipe.set(self._entry_key(key), payload, ex=self.ttl)
+            pipe.zadd(self._lru_key, {key: time.time()})
+            pipe.hset(self._sizes_key, key, size)
+        replaced = pipe.execute()[0]
+        # Replaced entries (even expired ones) no longer count towards the size budget
+        self.connection.incrby(self._bytes_key, size * len(keys) - sum(int(value or 0) for value in replaced))
+        self._purge_expired()
+        self._evict()
+
+    def _remove(self, keys):
+        """Deletes entries and returns the bytes they were accounted for."""
+        pipe = self.connection.pipeline()
+        pipe.hmget(self._sizes_key, keys)
+        pipe.hdel(self._sizes_key, *keys)
+        pipe.zrem(self._lru_key, *keys)
+        pipe.delete(*[self._entry_key(key) for key in keys])
+        sizes = pipe.execute()[0]
+        size = sum(int(value or 0) for value in sizes)
+        self.connection.decrby(self._bytes_key, size)
+        return size
+
+    def _purge_expired(self):
+        # The TTL runs from the last put, which is never later than the last
+        # access, so entries not accessed for `ttl` seconds have expired
+        expired = self.connection.zrangebyscore(self._lru_key, "-inf", time.time() - self.ttl)
+        if expired:
+            size = self._remove([key.decode() if isinstance(key, bytes) else key for key in expired])
+            logger.info(f"Purged {len(expired)} expired cached transcripts ({size} bytes)")
+
+    def _evict(self):
+        while int(self.connection.get(self._bytes_key) or 0) > self.max_bytes:
+            oldest = self.connection.zrange(self._lru_key, 0, 0)
+            if not oldest:
+                self.connection.set(self._bytes_key, 0)
+                return
+            key = oldest[0].decode() if isinstance(oldest[0], bytes) else oldest[0]
+            size = self._remove([key])
+            logger.info(f"Evicted cached transcript {key} ({size} bytes)")
+
+    def stats(self):
+        pipe = self.connection.pipeline()
+        pipe.get(f"{CACHE_PREFIX}:hits")
+        pipe.get(f"{CACHE_PREFIX}:misses")
+        pipe.get(self._bytes_key)
+        pipe.zcard(self._lru_key)
+        hits, misses, size, entries = pipe.execute()
+        return {
+            "hits": int(hits or 0),
+            "misses": int(misses or 0),
+            "bytes": int(size or 0),
+            "entries": entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_cache = None
+
+
+def get_result_cache():
+    """Returns the process-wide cache, or None when caching is disabled."""
+    global _cache
+    if not ENABLED:
+        return None
+    if _cache is None:
+        _cache = ResultCache(Redis.from_url(os.getenv('REDIS_URL')))
+    return _cache
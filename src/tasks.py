@@ -1,6 +1,5 @@
-from redis import Redis
-from rq import Queue
-import os
+from rq import get_current_job
+from datetime import datetime
 from dotenv import load_dotenv
 
  # Load environment variables at the very beginning,
@@ -8,15 +7,28 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from .utils.logger import logger
+from .utils.metrics import queue_wait_seconds
 from .core.media_processor import process_media
-
-redis_conn = Redis.from_url(os.getenv('REDIS_URL'))
-q = Queue(connection=redis_conn)
+from .services.admission import record_throughput
+from .queues import q, redis_conn  # noqa: F401 (re-exported for callers that import them from here)
 
 def process_media_task(media_url, firestore_ref, language, notification=False):
     logger.info(f"Starting media processing for {media_url} with notification={notification}")
+    queue_wait = None
+    job = get_current_job()
+    if job is not None and job.enqueued_at is not None:
+        # RQ stores timestamps as naive UTC datetimes
+        queue_wait = max((datetime.utcnow() - job.enqueued_at.replace(tzinfo=None)).total_seconds(), 0.0)
+        queue_wait_seconds.observe(queue_wait)
+    retries_left = (job.retries_left or 0) if job is not None else 0
     try:
-        process_media(media_url, firestore_ref, language, notification)
+        metadata = process_media(media_url, firestore_ref, language, notification, queue_wait=queue_wait,
+                                 retries_left=retries_left, job=job)
+        # Resumed attempts skipped stages, so they would overstate the speed
+        if metadata and not metadata.get("resumed"):
+            record_throughput(metadata["duration"], metadata["processing_time"])
         logger.info(f"Finished media processing for {media_url}")
     except Exception as e:
-        logger.error(f"Error processing {media_url}: {e}", exc_info=True)
+        # Only raised while retries are left; RQ then requeues the job, which resumes from its checkpoint
+        logger.error(f"Error processing {media_url}, retrying: {e}", exc_info=True)
+        raise
@@ -0,0 +1,206 @@
+import fcntl
+import glob
+import os
+import re
+import resource
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+from prometheus_client.mmap_dict import MmapedDict
+
+ # Workers and the API run in different processes. The entry points set
+ # PROMETHEUS_MULTIPROC_DIR (see metrics_dir.py) before this module is imported;
+ # every process then writes its samples there and /metrics aggregates them.
+ # Counters and histograms of exited processes (one per job, since RQ forks a
+ # work horse for each) are merged into one archive file per type.
+ARCHIVED_TYPES = ("counter", "histogram", "summary")
+ARCHIVE_LOCK = ".archive.lock"
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600, 7200)
+
+stage_seconds = Histogram(
+    "transcription_stage_seconds", "Wall time of each processing stage", ["stage"], buckets=STAGE_BUCKETS,
+)
+diarization_step_seconds = Histogram(
+    "diarization_step_seconds", "Wall time of each pyannote pipeline step", ["step"], buckets=STAGE_BUCKETS,
+)
+queue_wait_seconds = Histogram(
+    "job_queue_wait_seconds", "Time between enqueue and start of a job", buckets=STAGE_BUCKETS,
+)
+speech_rpc_seconds = Histogram(
+    "speech_rpc_seconds", "Latency of Speech API calls", ["method"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300, 900),
+)
+speech_rpc_errors = Counter(
+    "speech_rpc_errors", "Failed Speech API calls", ["method", "error"],
+)
+speech_retries = Counter(
+    "speech_retries", "Speech requests retried because Speech was overloaded", ["error"],
+)
+# Summed over live processes: the fleet-wide number of Speech requests allowed in flight
+speech_concurrency_limit = Gauge(
+    "speech_concurrency_limit", "Adaptive limit of in-flight Speech requests", multiprocess_mode="livesum",
+)
+speech_rate_limit_wait_seconds = Histogram(
+    "speech_rate_limit_wait_seconds", "Time Speech requests waited for a token of the shared quota",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+segment_audio_seconds = Histogram(
+    "speech_request_audio_seconds", "Audio duration sent per Speech request",
+    buckets=(1, 2, 5, 10, 20, 30, 45, 55, 60, 120, 300),
+)
+speech_request_bytes = Histogram(
+    "speech_request_bytes", "Size of the audio payload sent per Speech request", ["encoding"],
+    buckets=tuple(2 ** power for power in range(12, 25)),
+)
+downloaded_bytes = Counter("media_downloaded_bytes", "Bytes of media downloaded")
+realtime_factor = Histogram(
+    "job_audio_seconds_per_wall_second", "Seconds of audio processed per second of job wall time",
+    buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+job_peak_rss_bytes = Histogram(
+    "job_peak_rss_bytes", "Peak resident memory of the process that ran a job",
+    buckets=tuple(2 ** power for power in range(27, 37)),
+)
+jobs_total = Counter("jobs", "Finished jobs", ["status"])
+webhook_request_seconds = Histogram(
+    "webhook_request_seconds", "Latency of webhook requests",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+webhook_delivery_seconds = Histogram(
+    "webhook_delivery_seconds", "Time from queueing a notification to its delivery",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600, 14400),
+)
+webhook_deliveries = Counter(
+    "webhook_deliveries", "Notification delivery attempts by outcome (delivered, retry, dead)", ["outcome"],
+)
+
+
+class JobTimings:
+    """Collects per-stage wall times of one job for the histograms and the Firestore metadata."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, elapsed):
+        stage_seconds.labels(stage=name).observe(elapsed)
+        self.stages[name] = round(self.stages.get(name, 0.0) + elapsed, 3)
+
+
+class DiarizationStepTimer:
+    """pyannote hook that records how long each pipeline step took."""
+
+    def __init__(self, on_step=None):
+        self.on_step = on_step
+        self._last = time.perf_counter()
+
+    def __call__(self, step_name, step_artefact, file=None, total=None, completed=None, **kwargs):
+        # Batched steps report progress several times; only the final call ends the step
+        if total is not None and completed is not None and completed < total:
+            return
+        now = time.perf_counter()
+        elapsed, self._last = now - self._last, now
+        diarization_step_seconds.labels(step=step_name).observe(elapsed)
+        if self.on_step:
+            self.on_step(step_name, elapsed)
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _metrics_dir():
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+
+def mark_process_dead(pid):
+    """Drops the live gauges of an exited process (e.g. an RQ work horse) from the aggregate."""
+    if _metrics_dir():
+        multiprocess.mark_process_dead(pid, _metrics_dir())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _archive_lock(directory, exclusive):
+    # Scrapes hold it shared, so they never see samples both archived and in their own file
+    fd = os.open(os.path.join(directory, ARCHIVE_LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def archive_dead_processes():
+    """Merges the counters and histograms of exited processes into the archive files.
+
+    Keeps the number of sample files (and the cost of a scrape) bounded by the
+    running processes, without counters ever going backwards. Live gauges of
+    exited processes are dropped. Returns the number of files merged.
+    """
+    directory = _metrics_dir()
+    if not directory or not os.path.isdir(directory):
+        return 0
+    merged = 0
+    with _archive_lock(directory, exclusive=True):
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            match = re.match(r"^gauge_(live\w+)_(\d+)\.db$", os.path.basename(path))
+            if match and not _alive(int(match.group(2))):
+                os.remove(path)
+        for kind in ARCHIVED_TYPES:
+            dead = [path for path in glob.glob(os.path.join(directory, f"{kind}_*.db"))
+                    if re.match(rf"^{kind}_(\d+)\.db$", os.path.basename(path))
+                    and not _alive(int(os.path.basename(path)[len(kind) + 1:-3]))]
+            if not dead:
+                continue
+            archive = os.path.join(directory, f"{kind}_archive.db")
+            totals = {}
+            for path in ([archive] if os.path.exists(archive) else []) + dead:
+                for key, value, _, _ in MmapedDict.read_all_values_from_file(path):
+                    totals[key] = totals.get(key, 0.0) + value
+            # Written under another name and renamed, so the archive is never half written
+            staging = os.path.join(directory, f".{kind}_archive.tmp")
+            if os.path.exists(staging):
+                os.remove(staging)
+            values = MmapedDict(staging)
+            for key, value in totals.items():
+                values.write_value(key, value, 0.0)
+            values.close()
+            os.replace(staging, archive)
+            for path in dead:
+                os.remove(path)
+            merged += len(dead)
+    return merged
+
+
+def metrics_response():
+    """Returns (body, content type) of the Prometheus exposition for this host."""
+    directory = _metrics_dir()
+    if not directory:
+        return generate_latest(), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    with _archive_lock(directory, exclusive=False):
+        return generate_latest(registry), CONTENT_TYPE_LATEST
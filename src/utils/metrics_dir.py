@@ -0,0 +1,16 @@
+import os
+import tempfile
+
+# The API and the workers run in different processes: each one writes its
+# samples to this directory and /metrics aggregates them. prometheus_client
+# chooses multiprocess mode when it is imported, so the entry points call
+# setup_metrics_dir() before anything imports src.utils.metrics.
+DEFAULT_METRICS_DIR = os.path.join(tempfile.gettempdir(), "video-transcript-metrics")
+
+
+def setup_metrics_dir():
+    """Points prometheus_client at the shared metrics directory, creating it if needed, and returns it."""
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR") or DEFAULT_METRICS_DIR
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+    os.makedirs(directory, exist_ok=True)
+    return directory
@@ -1,35 +1,242 @@
-import requests
+import json
 import os
+import random
+import signal
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from redis import Redis
+from requests.adapters import HTTPAdapter
+
 from ..utils.logger import logger
+from ..utils.metrics import webhook_deliveries, webhook_delivery_seconds, webhook_request_seconds
+
+# Notifications are queued in Redis by the job and delivered by the dispatcher
+# processes (started by the worker supervisor), so a job never waits on a webhook.
+# Due notifications are in a list, retries in a sorted set scored by due time,
+# claimed ones in a sorted set scored by the end of their lease (an expired
+# lease, e.g. of a dispatcher that died, makes them deliverable again) and
+# notifications that failed for good in a capped dead-letter list.
+READY_KEY = "webhooks:ready"
+RETRY_KEY = "webhooks:retry"
+INFLIGHT_KEY = "webhooks:inflight"
+DEAD_KEY = "webhooks:dead"
+DEAD_MAX = 10000
+
+# Seconds to wait for a webhook endpoint to answer
+NOTIFICATION_TIMEOUT = float(os.getenv("NOTIFICATION_TIMEOUT", "10"))
+# Webhook requests one dispatcher process keeps in flight
+NOTIFICATION_CONCURRENCY = int(os.getenv("NOTIFICATION_CONCURRENCY", "8"))
+# Most notifications sent to one endpoint in one request; above 1, notifications
+# due at the same time are posted together as {"notifications": [...]}
+NOTIFICATION_BATCH_MAX = int(os.getenv("NOTIFICATION_BATCH_MAX", "1"))
+# Delivery attempts before a notification is dead-lettered; retries wait a
+# random time up to NOTIFICATION_RETRY_BASE_SECONDS * 2^attempt, capped
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS", "8"))
+NOTIFICATION_RETRY_BASE_SECONDS = float(os.getenv("NOTIFICATION_RETRY_BASE_SECONDS", "5"))
+NOTIFICATION_RETRY_MAX_SECONDS = float(os.getenv("NOTIFICATION_RETRY_MAX_SECONDS", "3600"))
+# Seconds a claimed notification stays with its dispatcher before others may take it
+NOTIFICATION_LEASE_SECONDS = max(60.0, 4 * NOTIFICATION_TIMEOUT)
+POLL_SECONDS = 0.5
+
+# Claims up to ARGV[3] notifications: expired leases first, then due retries,
+# then the ready list. Claimed ones are leased until ARGV[2].
+_CLAIM_SCRIPT = """
+local now, lease_until, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local items = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now, 'LIMIT', 0, limit)
+if #items < limit then
+    for _, item in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, limit - #items)) do
+        redis.call('ZREM', KEYS[2], item)
+        table.insert(items, item)
+    end
+end
+while #items < limit do
+    local item = redis.call('LPOP', KEYS[1])
+    if not item then break end
+    table.insert(items, item)
+end
+for _, item in ipairs(items) do
+    redis.call('ZADD', KEYS[3], lease_until, item)
+end
+return items
+"""
+
+_connection = None
+
 
-def send_notification(firestore_ref):
-    """Send notification webhook after transcription completion."""
+def _get_connection():
+    global _connection
+    if _connection is None:
+        _connection = Redis.from_url(os.getenv('REDIS_URL'))
+    return _connection
+
+
+def send_notification(firestore_ref, connection=None):
+    """Queues the notification webhook of a finished job; delivery happens in the dispatcher.
+
+    Returns False when it could not be queued (no URL configured or Redis unavailable).
+    """
     notification_url = os.getenv('NOTIFICATION_SERVICE_URL')
-    
+
     if not notification_url:
         logger.error("NOTIFICATION_SERVICE_URL is not set in environment variables")
         return False
-    
-    payload = {
-        "firestore_ref": firestore_ref
-    }
-    
+
+    item = json.dumps({
+        "id": uuid.uuid4().hex,
+        "url": notification_url,
+        "payload": {"firestore_ref": firestore_ref},
+        "attempts": 0,
+        "queued_at": time.time(),
+    })
     try:
-        logger.info(f"[{firestore_ref}] Sending notification to {notification_url}")
-        response = requests.post(
-            notification_url,
-            json=payload,
-            timeout=30,
-            headers={'Content-Type': 'application/json'}
-        )
-        response.raise_for_status()
-        
-        logger.info(f"[{firestore_ref}] Notification sent successfully. Response status: {response.status_code}")
+        (connection or _get_connection()).rpush(READY_KEY, item)
+        logger.info(f"[{firestore_ref}] Notification queued for {notification_url}")
         return True
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"[{firestore_ref}] Failed to send notification: {e}", exc_info=True)
-        return False
     except Exception as e:
-        logger.error(f"[{firestore_ref}] Unexpected error sending notification: {e}", exc_info=True)
+        logger.error(f"[{firestore_ref}] Failed to queue notification: {e}", exc_info=True)
         return False
+
+
+def _retry_delay(attempts):
+    return random.uniform(0, min(NOTIFICATION_RETRY_MAX_SECONDS, NOTIFICATION_RETRY_BASE_SECONDS * 2 ** (attempts - 1)))
+
+
+def _permanent(error):
+    # Client errors other than timeouts and rate limits will not succeed on retry
+    response = getattr(error, "response", None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+
+
+class WebhookDispatcher:
+    """Delivers queued notifications over one pooled keep-alive HTTP session.
+
+    Every notification is delivered at least once: it is only removed from
+    Redis after the endpoint answered 2xx or it was moved to the retry set or
+    the dead-letter list.
+    """
+
+    def __init__(self, connection=None, concurrency=NOTIFICATION_CONCURRENCY, batch_max=NOTIFICATION_BATCH_MAX):
+        self.connection = connection or _get_connection()
+        self.concurrency = max(1, concurrency)
+        self.batch_max = max(1, batch_max)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._claim = self.connection.register_script(_CLAIM_SCRIPT)
+        self._stopping = False
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def claim(self, limit):
+        now = time.time()
+        return [item.decode() for item in self._claim(
+            keys=[READY_KEY, RETRY_KEY, INFLIGHT_KEY], args=[now, now + NOTIFICATION_LEASE_SECONDS, limit],
+        )]
+
+    def _batches(self, items):
+        by_url = defaultdict(list)
+        for item in items:
+            by_url[json.loads(item)["url"]].append(item)
+        for url, claimed in by_url.items():
+            for start in range(0, len(claimed), self.batch_max):
+                yield url, claimed[start:start + self.batch_max]
+
+    def deliver(self, url, items):
+        """Posts one batch to `url` and records the outcome of each notification in Redis."""
+        notifications = [json.loads(item) for item in items]
+        payloads = [notification["payload"] for notification in notifications]
+        refs = ", ".join(str(payload.get("firestore_ref")) for payload in payloads)
+        started = time.perf_counter()
+        error = None
+        try:
+            response = self.session.post(
+                url,
+                json=payloads[0] if len(payloads) == 1 else {"notifications": payloads},
+                timeout=NOTIFICATION_TIMEOUT,
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            error = e
+        finally:
+            webhook_request_seconds.observe(time.perf_counter() - started)
+
+        now = time.time()
+        with self.connection.pipeline() as pipe:
+            pipe.zrem(INFLIGHT_KEY, *items)
+            for notification in notifications:
+                if error is None:
+                    webhook_deliveries.labels(outcome="delivered").inc()
+                    webhook_delivery_seconds.observe(now - notification["queued_at"])
+                    continue
+                notification["attempts"] += 1
+                notification["error"] = str(error)
+                if _permanent(error) or notification["attempts"] >= NOTIFICATION_MAX_ATTEMPTS:
+                    webhook_deliveries.labels(outcome="dead").inc()
+                    notification["failed_at"] = now
+                    pipe.lpush(DEAD_KEY, json.dumps(notification))
+                    pipe.ltrim(DEAD_KEY, 0, DEAD_MAX - 1)
+                else:
+                    webhook_deliveries.labels(outcome="retry").inc()
+                    pipe.zadd(RETRY_KEY, {json.dumps(notification): now + _retry_delay(notification["attempts"])})
+            pipe.execute()
+
+        if error is None:
+            logger.info(f"[{refs}] Notification sent successfully. Response status: {response.status_code}")
+        else:
+            logger.warning(f"[{refs}] Failed to send notification to {url} "
+                           f"(attempt {notifications[0]['attempts']}): {error}")
+
+    def run(self):
+        """Delivers notifications until stopped; in-flight requests are finished first."""
+        logger.info(f"Webhook dispatcher started (PID {os.getpid()})")
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="webhook") as executor:
+            while not self._stopping:
+                claimed = []
+                free = self.concurrency - len(pending)
+                if free > 0:
+                    try:
+                        claimed = self.claim(free * self.batch_max)
+                    except Exception as e:
+                        logger.error(f"Failed to claim notifications: {e}")
+                for url, items in self._batches(claimed):
+                    pending.add(executor.submit(self.deliver, url, items))
+                if pending:
+                    done, pending = wait(pending, timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() is not None:
+                            # Left in the in-flight set; delivered again once the lease expires
+                            logger.error(f"Notification delivery failed: {future.exception()}")
+                elif not claimed:
+                    time.sleep(POLL_SECONDS)
+        self.session.close()
+        logger.info("Webhook dispatcher stopped")
+
+
+def run_dispatcher():
+    """Runs one webhook dispatcher in the current process until SIGTERM or SIGINT."""
+    dispatcher = WebhookDispatcher()
+    signal.signal(signal.SIGTERM, dispatcher.stop)
+    signal.signal(signal.SIGINT, dispatcher.stop)
+    dispatcher.run()
+
+
+def queue_counts(connection=None):
+    """Number of notifications due, waiting for a retry, being delivered and dead-lettered."""
+    with (connection or _get_connection()).pipeline(transaction=False) as pipe:
+        pipe.llen(READY_KEY)
+        pipe.zcard(RETRY_KEY)
+        pipe.zcard(INFLIGHT_KEY)
+        pipe.llen(DEAD_KEY)
+        ready, retry, inflight, dead = pipe.execute()
+    return {"ready": ready, "retry": retry, "in_flight": inflight, "dead": dead}
+
+
+if __name__ == "__main__":
+    run_dispatcher()
@@ -0,0 +1,244 @@
+import multiprocessing
+import os
+import signal
+import time
+from datetime import timezone
+
+from dotenv import load_dotenv
+from rq import Worker
+from rq.job import Job
+from rq.utils import utcparse
+
+ # Load environment variables before importing modules that read them
+load_dotenv()
+
+# Multiprocess metrics must be set up before prometheus_client is imported
+from .utils.metrics_dir import setup_metrics_dir  # noqa: E402
+setup_metrics_dir()
+
+from .core.scratch import prune_orphans
+from .core.stages import WORKER_JOBS_PER_SLOT, configure_stages
+from .queues import all_queues
+from .utils.logger import logger
+from .utils.metrics import archive_dead_processes, mark_process_dead
+
+# Rough resident memory of one worker with the diarization model loaded
+WORKER_MEMORY_MB = int(os.getenv("WORKER_MEMORY_MB", "3000"))
+# Seconds a worker gets to finish its current job on shutdown before it is killed
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "60"))
+# Webhook dispatcher processes per host (0 = they run elsewhere, with `python -m src.utils.notification`)
+NOTIFICATION_DISPATCHERS = int(os.getenv("NOTIFICATION_DISPATCHERS", "1"))
+# A queue whose oldest job has waited this long is served before the shorter size classes
+QUEUE_MAX_WAIT_SECONDS = float(os.getenv("QUEUE_MAX_WAIT_SECONDS", "3600"))
+# Seconds between merges of the metric files of exited work horses into the archive
+METRICS_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("METRICS_ARCHIVE_INTERVAL_SECONDS", "60"))
+
+
+class SizeClassWorker(Worker):
+    """RQ worker that takes jobs from the shortest size class first without starving the others.
+
+    Queues are served in order of preference, except that a queue whose oldest
+    job has waited longer than QUEUE_MAX_WAIT_SECONDS goes first. The order is
+    worked out right before every dequeue, with two Redis round trips.
+    """
+
+    def _waits(self):
+        with self.connection.pipeline(transaction=False) as pipe:
+            for queue in self.queues:
+                pipe.lindex(queue.key, 0)
+            heads = pipe.execute()
+        with self.connection.pipeline(transaction=False) as pipe:
+            # Empty queues get a placeholder so the replies line up with the queues
+            for head in heads:
+                if head:
+                    pipe.hget(Job.key_for(head.decode()), "enqueued_at")
+                else:
+                    pipe.echo("")
+            enqueued = pipe.execute()
+        now = time.time()
+        waits = []
+        for value in enqueued:
+            try:
+                waits.append(now - utcparse(value.decode()).replace(tzinfo=timezone.utc).timestamp())
+            except (AttributeError, ValueError):
+                waits.append(0.0)
+        return waits
+
+    def dequeue_job_and_maintain_ttl(self, *args, **kwargs):
+        try:
+            waits = self._waits()
+            overdue = sorted((-wait, index) for index, wait in enumerate(waits) if wait > QUEUE_MAX_WAIT_SECONDS)
+            first = [self.queues[index] for _, index in overdue]
+            self._ordered_queues = first + [queue for queue in self.queues if queue not in first]
+        except Exception as e:
+            self._ordered_queues = self.queues[:]
+            logger.warning(f"Failed to order queues by waiting time: {e}")
+        return super().dequeue_job_and_maintain_ttl(*args, **kwargs)
+
+    def monitor_work_horse(self, job, queue):
+        horse_pid = self.horse_pid
+        try:
+            super().monitor_work_horse(job, queue)
+        finally:
+            mark_process_dead(horse_pid)
+
+
+def run_worker(slot=0, slots=1):
+    """Runs one RQ worker loop in the current process, as worker `slot` of `slots` on this host."""
+    # Drop the supervisor's handlers inherited through fork; RQ installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        from .core.diarization import pin_cpu_threads
+        pin_cpu_threads(slot, slots)
+    except Exception as e:
+        logger.warning(f"Failed to set diarization CPU threads: {e}")
+    queues = all_queues()
+    worker = SizeClassWorker(queues, connection=queues[0].connection)
+    logger.info(f"Starting worker for queues: {', '.join(worker.queue_names())} (PID {os.getpid()})")
+    worker.work()
+
+
+def _available_memory_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def default_worker_count():
+    """Number of workers from WORKER_COUNT, or derived from the CPUs and memory of the host."""
+    configured = os.getenv("WORKER_COUNT")
+    if configured:
+        return max(1, int(configured))
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    count = cpus
+    memory_mb = _available_memory_mb()
+    if memory_mb is not None:
+        count = min(count, memory_mb // WORKER_MEMORY_MB)
+    return max(1, count)
+
+
+def preload():
+    """Initializes everything workers share before they are forked.
+
+    The task modules (torch, pyannote, the Google clients) are imported, Firebase
+    is initialized and the diarization model is loaded here, so every forked
+    worker shares them copy-on-write instead of loading them on its first job.
+    """
+    from . import tasks  # noqa: F401
+    try:
+        from .services.firebase_service import init_firebase
+        init_firebase()
+    except Exception as e:
+        logger.error(f"Failed to initialize Firebase, it will be initialized on first use: {e}", exc_info=True)
+    try:
+        from .core.diarization import warm_up
+        warm_up()
+    except Exception as e:
+        logger.error(f"Failed to preload diarization pipeline, it will be loaded on first job: {e}", exc_info=True)
+
+
+class WorkerSupervisor:
+    """Forks N model-warm RQ workers, restarts the ones that crash and stops them gracefully.
+
+    With WORKER_JOBS_PER_SLOT above 1, each of the N worker slots runs that many
+    RQ workers, and their jobs share the slots' download and diarization stages.
+    Slots from `count` on run the webhook dispatchers instead of RQ workers.
+    """
+
+    def __init__(self, count=None, jobs_per_slot=WORKER_JOBS_PER_SLOT, dispatchers=NOTIFICATION_DISPATCHERS):
+        self.slots = count or default_worker_count()
+        self.jobs_per_slot = max(1, jobs_per_slot)
+        self.count = self.slots * self.jobs_per_slot
+        self.dispatchers = max(0, dispatchers)
+        self._context = multiprocessing.get_context("fork")
+        self._workers = {}
+        self._failures = {}
+        self._stopping = False
+
+    def _spawn(self, slot):
+        if slot < self.count:
+            # Staged workers are not bound to cores; their jobs are, while they hold a diarization slot
+            args = (slot, self.count) if self.jobs_per_slot == 1 else (0, 1)
+            process = self._context.Process(target=run_worker, args=args, name=f"rq-worker-{slot}")
+        else:
+            from .utils.notification import run_dispatcher
+            process = self._context.Process(target=run_dispatcher, name=f"webhook-dispatcher-{slot - self.count}")
+        process.start()
+        self._workers[slot] = (process, time.monotonic())
+        logger.info(f"Started {process.name} with PID: {process.pid}")
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"Supervisor received signal {signum}, shutting down workers")
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+        configure_stages(self.slots, self.jobs_per_slot)
+        archive_dead_processes()
+        archived_at = time.monotonic()
+        preload()
+        logger.info(f"Starting {self.count} workers and {self.dispatchers} webhook dispatchers")
+        for slot in range(self.count + self.dispatchers):
+            self._spawn(slot)
+
+        while not self._stopping:
+            for slot, (process, started_at) in list(self._workers.items()):
+                if process.is_alive() or self._stopping:
+                    continue
+                # Back off when a worker keeps dying right after start
+                if time.monotonic() - started_at < 30:
+                    self._failures[slot] = self._failures.get(slot, 0) + 1
+                else:
+                    self._failures[slot] = 0
+                delay = min(2 ** self._failures[slot], 60) if self._failures[slot] else 0
+                logger.warning(f"Worker {slot} (PID {process.pid}) exited with code {process.exitcode}, "
+                               f"restarting in {delay}s")
+                mark_process_dead(process.pid)
+                # Scratch files of a job it was running are not removed by the job itself
+                prune_orphans()
+                time.sleep(delay)
+                if not self._stopping:
+                    self._spawn(slot)
+            if time.monotonic() - archived_at >= METRICS_ARCHIVE_INTERVAL_SECONDS:
+                try:
+                    archive_dead_processes()
+                except Exception as e:
+                    logger.error(f"Failed to archive metrics of exited processes: {e}", exc_info=True)
+                archived_at = time.monotonic()
+            time.sleep(1)
+
+        self.stop()
+
+    def stop(self):
+        # SIGTERM makes RQ finish the current job before exiting (warm shutdown)
+        for process, _ in self._workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for slot, (process, _) in self._workers.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {slot} (PID {process.pid}) did not stop in time, killing it")
+                process.kill()
+                process.join()
+            mark_process_dead(process.pid)
+        logger.info("All workers stopped")
+
+
+def run_supervisor():
+    WorkerSupervisor().run()
+
+
+if __name__ == "__main__":
+    run_supervisor()
@@ -1,18 +1,23 @@
 #!/usr/bin/env python3
-"""WSGI entry point for production deployment with Gunicorn."""
+"""WSGI entry point of the API for production deployment with Gunicorn.
+
+The API only enqueues jobs. Workers run separately (`python3 -m src.worker`),
+unless API_EMBEDDED_WORKER=true, which starts them from the API process as
+a single-host deployment.
+"""
 
-import multiprocessing
 import atexit
+import os
 from src.app import app, start_worker, stop_worker
 from src.utils.logger import logger
 
-# Start the worker when the WSGI app is created
-start_worker()
-
-# Register function to stop the worker on exit
-atexit.register(stop_worker)
-
-logger.info("WSGI app initialized with worker process")
+# Start the workers alongside the API on single-host deployments
+if os.getenv("API_EMBEDDED_WORKER", "false").lower() in ("1", "true", "yes"):
+    start_worker()
+    atexit.register(stop_worker)
+    logger.info("WSGI app initialized with worker process")
+else:
+    logger.info("WSGI app initialized without workers")
 
 if __name__ == "__main__":
     app.run()